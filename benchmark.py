@@ -0,0 +1,372 @@
+# 銷售數據處理器的效能測試工具
+"""
+產生模擬 POS 匯出檔（HTML 格式 .xls），並量測處理器各階段的效能
+
+產生模擬資料：
+    python benchmark.py generate bench_data --files 1000 --lines 5 40
+
+量測（結果以 JSON 輸出）：
+    python benchmark.py run bench_data --product 產品代號表.xlsx \
+        --account "掛帳客戶供應商對照表(包含傳票類別).xlsx" --json result.json
+
+與上次的結果比較，處理速度下降超過容許比例時結束代碼為 1：
+    python benchmark.py run bench_data ... --baseline result.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+
+try:
+    import resource
+except ImportError:  # Windows 沒有 resource 模組，改以 tracemalloc 估計記憶體
+    resource = None
+
+import sales_data_processor
+from sales_data_processor import Instrumentation, SalesDataProcessor, configure_logging
+
+
+# 與實際匯出檔相同的欄位
+EXPORT_COLUMNS = [
+    "時間", "品　種", "單位", "單價", "數量", "金額", "折扣率", "備　註", "類別",
+    "點菜員", "收銀員", "發票", "收款", "贈送原因", "口味/作法", "卡號", "禮券編號",
+]
+
+EXPORT_HEADER = """<html xmlns:o="urn:schemas-microsoft-com:office:office" xmlns:x="urn:schemas-microsoft-com:office:excel" xmlns="http://www.w3.org/TR/REC-html40">
+<title></title>
+<STYLE ID="htmldw_stylesheet" TYPE="text/css">
+<!--
+.htmldw564D{}
+.htmldw564E{background-color:#c0dcc0; width:100%}
+.htmldw564F{COLOR:#000000;FONT:9pt "微軟正黑體", sans-serif;FONT-STYLE:normal;FONT-WEIGHT:normal;TEXT-DECORATION:none;TEXT-ALIGN:center;padding:0px;BORDER-STYLE:none}
+.htmldw5660{}
+.htmldw5661{COLOR:#000000;FONT:9pt "微軟正黑體", sans-serif;FONT-STYLE:normal;FONT-WEIGHT:normal;TEXT-DECORATION:none;TEXT-ALIGN:left;padding:0px;BORDER-STYLE:none}
+.htmldw5686{COLOR:#000000;FONT:9pt "微軟正黑體", sans-serif;FONT-STYLE:normal;FONT-WEIGHT:bold;TEXT-DECORATION:none;TEXT-ALIGN:center;padding:0px;BORDER-STYLE:none}
+-->
+</STYLE>
+
+<TABLE CLASS=htmldw564D BORDER=0 WIDTH=1419>
+
+<TR CLASS=htmldw564E>
+""" + "".join(f"    <TH CLASS=htmldw564F WIDTH=55>{name}</TH>\n" for name in EXPORT_COLUMNS) + "</TR>\n"
+
+EXPORT_FOOTER = "</TABLE>\n</html>\n"
+
+# (品名, 單價, 類別)，未指定產品代號表時使用
+DEFAULT_CATALOG = [
+    ("EVIAN(G)", 200, "Soft"), ("COKE(B)", 150, "Soft"), ("Red bull (B)", 200, "Soft"),
+    ("Heineken(G)", 200, "Beer"), ("Old Fashioned", 380, "調酒"), ("調酒shot", 200, "SHOT"),
+    ("Jager (B)", 5000, "JAGER"), ("Jager(G)", 350, "JAGER"), ("V.S.O.P(B)", 6000, "Cognac"),
+    ("Moet(B)", 5500, "Champagne"), ("Ciroc(B)", 6000, "Vodka"), ("Hendrick’s(B)", 5000, "GIN"),
+    ("假日男女門票", 600, "其他"), ("衣帽間", 100, "其他"), ("500手環", 500, "Ring"),
+    ("Aperol Spritz", 380, "調酒"), ("雪碧汽水", 150, "Soft"),
+]
+
+CARD_TENDERS = ["VISA", "Master", "AE", "JCB", "銀聯"]
+ACCOUNT_VENDORS = ["000024", "000047", "000062", "52", "53", "54", "55"]
+
+
+def _row(cells):
+    return "<TR CLASS=htmldw5660>\n" + "".join(
+        f"    <TD NOWRAP CLASS=htmldw5661 WIDTH=55>{cell}</TD>\n" for cell in cells
+    ) + "</TR>\n"
+
+
+def _amount(value, trailing_dot=False):
+    text = f"{value:,}"
+    return text + "." if trailing_dot else text
+
+
+def _line(time_text="", product="", price="", quantity="", amount="", category="",
+          invoice="", payment="", reason=""):
+    return _row([time_text, product, "", price, quantity, amount, "", "", category,
+                 "", "", invoice, payment, reason, "", "", ""])
+
+
+def load_catalog(product_code_file):
+    """從產品代號表取得品名，單價與類別隨機指定"""
+    import pandas as pd
+    names = pd.read_excel(product_code_file, sheet_name='Sheet2')['品名'].dropna().astype(str)
+    rng = random.Random(0)
+    return [(name, rng.choice([100, 150, 200, 350, 380, 600, 5000, 5500]), "其他") for name in names]
+
+
+def generate_receipt(rng, lines, catalog, invoice_serial):
+    """產生一張單據的 HTML 資料列，付款方式涵蓋現金、信用卡、挂帳、多筆付款、公關品與服務費"""
+    kind = rng.choices(
+        ["cash", "card", "account", "multi", "pr"], weights=[30, 35, 15, 15, 5]
+    )[0]
+    minute = rng.randint(0, 59)
+    time_text = f"07/{rng.randint(20, 28):02d} {rng.randint(0, 4):02d}:{minute:02d}:{rng.randint(0, 59):02d}"
+
+    rows = []
+    subtotal = 0
+    for _ in range(lines):
+        product, price, category = rng.choice(catalog)
+        quantity = rng.choice([1, 1, 1, 2, 3, 6, 12])
+        reason = "公關品" if kind == "pr" and rng.random() < 0.5 else ""
+        if reason:
+            price = 0
+        amount = price * quantity
+        subtotal += amount
+        rows.append(_line(time_text, product, _amount(price), f"{quantity}.", _amount(amount),
+                          category, reason=reason))
+    rows.append(_line(product="酒水 小計", amount=_amount(subtotal, True)))
+
+    total = subtotal
+    if rng.random() < 0.7:
+        service_fee = subtotal // 10
+        total += service_fee
+        rows.append(_line(time_text, "[服務費]", amount=_amount(service_fee), category="服務費"))
+        rows.append(_line(product="服務費及負項金額 小計", amount=_amount(service_fee, True)))
+    rows.append(_line(product="本單實收金額合計:", amount=_amount(total, True)))
+
+    if kind == "multi":
+        first = total // 2
+        payments = [(rng.choice(["現金"] + CARD_TENDERS), first), (rng.choice(CARD_TENDERS), total - first)]
+    elif kind == "card":
+        payments = [(rng.choice(CARD_TENDERS), total)]
+    elif kind == "account":
+        payments = [("挂帳", total)]
+    else:
+        payments = [("現金", total)]
+
+    for tender, amount in payments:
+        category = rng.choice(ACCOUNT_VENDORS) if tender == "挂帳" else ""
+        if tender in ("現金", "挂帳"):
+            invoice = "發票金額:0  發票號:"
+        else:
+            invoice = f"發票金額:{amount}  發票號:RL{invoice_serial:08d}"
+        rows.append(_line(time_text, tender, amount=_amount(amount), category=category,
+                          invoice=invoice, payment=f"收款:{amount}溢收0.00"))
+
+    rows.append(_line(product="結帳 小計", amount=_amount(total, True)))
+    rows.append(_line(amount=_amount(total, True)))
+    return "".join(rows)
+
+
+def generate_pos_exports(output_dir, files=100, min_lines=5, max_lines=20, seed=0, catalog=None):
+    """
+    產生模擬 POS 匯出檔，回傳產生的檔案數
+    - 檔名與實際匯出檔相同（4 碼序號 + 月日 + 3 碼序號），可從檔名解析日期
+    - 每張單據的商品列數介於 min_lines 與 max_lines 之間
+    """
+    rng = random.Random(seed)
+    catalog = catalog or DEFAULT_CATALOG
+    os.makedirs(output_dir, exist_ok=True)
+
+    for index in range(files):
+        day = 20 + index % 9
+        name = f"{(5800 + index) % 10000:04d}07{day:02d}{index % 1000:03d}.xls"
+        if files > 10000:
+            # 同一序號可能重複，加上流水號避免覆蓋
+            name = f"{(5800 + index) % 10000:04d}07{day:02d}{index % 1000:03d}_{index}.xls"
+        lines = rng.randint(min_lines, max_lines)
+        body = generate_receipt(rng, lines, catalog, 23100000 + index)
+        with open(os.path.join(output_dir, name), "w", encoding="utf-8-sig") as f:
+            f.write(EXPORT_HEADER + body + EXPORT_FOOTER)
+
+    return files
+
+
+def _peak_memory_mb():
+    """目前為止的程序最大常駐記憶體（MB）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 單位為位元組，Linux 為 KB
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def run_benchmark(folder, product_code_file="", account_query_file="", customer_code_file="",
+                  output_path=None, workers=1, cache_dir=None, trace_memory=False):
+    """
+    量測處理器各階段：對照表載入、檔案掃描、讀取、轉換、寫出
+    - 讀取與轉換逐檔分開計時（由處理器的量測記錄彙總）；workers 不是 1 時另外量測平行處理的整體時間
+    - 平行處理使用另一份量測記錄，結果另列在 pipeline，不計入逐檔量測的讀取、轉換與寫出時間
+    - 回傳可直接寫成 JSON 的結果
+    """
+    # 與命令列批次模式相同，不使用記憶體快取（每個檔案只讀一次，快取只會增加記憶體用量）
+    processor = SalesDataProcessor(workers=workers, cache_dir=cache_dir, memory_cache_bytes=None)
+    processor.product_code_file_path = product_code_file
+    processor.account_query_file_path = account_query_file
+    processor.customer_code_file_path = customer_code_file
+    instrumentation = processor.instrumentation = Instrumentation(trace_memory=trace_memory)
+    stage_rss = {}
+
+    temp_dir = None
+    if output_path is None:
+        temp_dir = tempfile.mkdtemp(prefix="sales_benchmark_")
+        output_path = os.path.join(temp_dir, "output.xlsx")
+
+    try:
+        with instrumentation.stage("load_mappings"):
+            processor.load_reference_data()
+        stage_rss["load_mappings"] = _peak_memory_mb()
+
+        with instrumentation.stage("discover"):
+            files = list(processor.iter_excel_files(folder))
+        stage_rss["discover"] = _peak_memory_mb()
+
+        rows = []
+        special_vendor_dates = []
+        with instrumentation.stage("read_transform"):
+            for file in files:
+                file_rows, file_special_dates = processor.collect_file_statistics(file)
+                rows.extend(file_rows)
+                special_vendor_dates.extend(file_special_dates)
+        stage_rss["read_transform"] = _peak_memory_mb()
+
+        processor.statistics_output_path = output_path
+        processor.write_to_excel(rows, special_vendor_dates)
+        stage_rss["write"] = _peak_memory_mb()
+
+        summary = instrumentation.summary()
+
+        pipeline = None
+        if workers != 1:
+            # process_folder 會再次經過寫出階段並累計每個檔案，改用新的量測記錄，避免重複計算
+            pipeline_instrumentation = processor.instrumentation = Instrumentation(trace_memory=trace_memory)
+            with pipeline_instrumentation.stage("pipeline"):
+                processor.process_folder(folder, output_path)
+            stage_rss["pipeline"] = _peak_memory_mb()
+            pipeline = pipeline_instrumentation.summary()
+    finally:
+        processor.instrumentation = instrumentation
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    totals = summary["totals"]
+    stages = summary["stages"]
+    # 讀取與轉換以逐檔累計的時間呈現
+    read_transform = stages.pop("read_transform")
+    stages["read"] = {"seconds": totals["read_seconds"]}
+    stages["transform"] = {"seconds": totals["transform_seconds"]}
+    if "tracemalloc_peak_mb" in read_transform:
+        stages["read"]["tracemalloc_peak_mb"] = stages["transform"]["tracemalloc_peak_mb"] = \
+            read_transform["tracemalloc_peak_mb"]
+    stage_rss["read"] = stage_rss["transform"] = stage_rss.pop("read_transform")
+    for name, record in stages.items():
+        record.pop("calls", None)
+        record["peak_rss_mb"] = stage_rss.get(name)
+
+    ordered = {name: stages[name] for name in
+               ("load_mappings", "discover", "read", "transform", "write") if name in stages}
+    processing_seconds = sum(ordered[name]["seconds"] for name in ("read", "transform", "write"))
+    result = {
+        "files": len(files),
+        "rows": len(rows),
+        "workers": workers,
+        "stages": ordered,
+        "files_per_sec": round(len(files) / processing_seconds, 2) if processing_seconds else None,
+        "rows_per_sec": round(len(rows) / processing_seconds, 2) if processing_seconds else None,
+        "product_misses": totals["product_misses"],
+        "voucher_misses": totals["voucher_misses"],
+        "peak_rss_mb": _peak_memory_mb(),
+        "python": platform.python_version(),
+        "processor_version": sales_data_processor.__version__,
+    }
+    if pipeline is not None:
+        pipeline_stages = pipeline["stages"]
+        pipeline_seconds = pipeline_stages.pop("pipeline")["seconds"]
+        ordered["pipeline"] = {"seconds": pipeline_seconds, "peak_rss_mb": stage_rss["pipeline"]}
+        # 讀取與轉換時間為各工作程序的累計，可能超過整體時間
+        result["pipeline"] = {
+            "seconds": pipeline_seconds,
+            "files": pipeline["totals"]["files"],
+            "rows": pipeline["totals"]["rows"],
+            "read_seconds": pipeline["totals"]["read_seconds"],
+            "transform_seconds": pipeline["totals"]["transform_seconds"],
+            "stages": {name: record["seconds"] for name, record in pipeline_stages.items()},
+        }
+        if pipeline_seconds:
+            result["pipeline_files_per_sec"] = round(len(files) / pipeline_seconds, 2)
+    return result
+
+
+def compare_with_baseline(result, baseline, tolerance):
+    """處理速度低於基準的 (1 - tolerance) 倍時回傳說明文字，否則回傳 None"""
+    regressions = []
+    for key in ("files_per_sec", "rows_per_sec"):
+        current, previous = result.get(key), baseline.get(key)
+        if current and previous and current < previous * (1 - tolerance):
+            regressions.append(f"{key}: {current} < {previous} (容許 {tolerance:.0%})")
+    return "; ".join(regressions) or None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="銷售數據處理器效能測試")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate = subparsers.add_parser("generate", help="產生模擬 POS 匯出檔")
+    generate.add_argument("output_dir")
+    generate.add_argument("--files", type=int, default=100, help="檔案數（預設 100）")
+    generate.add_argument("--lines", type=int, nargs=2, default=(5, 20), metavar=("MIN", "MAX"),
+                          help="每張單據的商品列數範圍（預設 5 20）")
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--catalog", help="以產品代號表的品名產生商品（預設使用內建品名）")
+
+    run = subparsers.add_parser("run", help="量測處理效能")
+    run.add_argument("folder", nargs="?", help="POS 匯出檔資料夾；未指定時以 --files 產生暫存資料")
+    run.add_argument("--files", type=int, default=100, help="未指定資料夾時產生的檔案數")
+    run.add_argument("--lines", type=int, nargs=2, default=(5, 20), metavar=("MIN", "MAX"))
+    run.add_argument("--product", default="", help="產品代號試算表檔案路徑")
+    run.add_argument("--account", default="", help="查詢挂帳試算表檔案路徑")
+    run.add_argument("--customer", default="", help="客戶供應商代號和傳票類別試算表檔案路徑")
+    run.add_argument("--output", help="統計資料輸出檔案（預設寫到暫存資料夾）")
+    run.add_argument("--workers", type=int, default=1)
+    run.add_argument("--cache-dir")
+    run.add_argument("--tracemalloc", action="store_true", help="以 tracemalloc 記錄各階段的記憶體高峰（會變慢）")
+    run.add_argument("--json", help="將結果寫入 JSON 檔案（預設輸出到標準輸出）")
+    run.add_argument("--baseline", help="上次的結果 JSON，處理速度下降超過容許比例時結束代碼為 1")
+    run.add_argument("--tolerance", type=float, default=0.2, help="容許的速度下降比例（預設 0.2）")
+
+    args = parser.parse_args(argv)
+    # 量測時只輸出警告，避免處理器的日誌影響計時
+    configure_logging(logging.WARNING)
+
+    if args.command == "generate":
+        catalog = load_catalog(args.catalog) if args.catalog else None
+        count = generate_pos_exports(args.output_dir, args.files, args.lines[0], args.lines[1],
+                                     args.seed, catalog)
+        print(f"已產生 {count} 個檔案: {args.output_dir}")
+        return 0
+
+    data_dir = None
+    folder = args.folder
+    if folder is None:
+        data_dir = tempfile.mkdtemp(prefix="sales_benchmark_data_")
+        generate_pos_exports(data_dir, args.files, args.lines[0], args.lines[1])
+        folder = data_dir
+
+    try:
+        result = run_benchmark(folder, args.product, args.account, args.customer, args.output,
+                               args.workers, args.cache_dir, args.tracemalloc)
+    finally:
+        if data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regression = compare_with_baseline(result, json.load(f), args.tolerance)
+        if regression:
+            print(f"效能下降: {regression}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
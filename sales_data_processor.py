@@ -1,14 +1,46 @@
 # 導入必要的函式庫
-import pandas as pd
-import numpy as np
 import datetime
 import re
 import time
 import logging
 import os
 import glob
+import fnmatch
+import posixpath
+import functools
+import contextlib
+import cProfile
+import itertools
+import collections
+import argparse
+import csv
+import json
+import sys
+import heapq
+import operator
+import decimal
+import fractions
+import hashlib
+import io
+import mmap
+import pickle
+import sqlite3
+import threading
+import zlib
 from typing import List, Dict, Union, Optional
-from pathlib import Path
+
+# pandas、lxml、程序池等較重的模組在需要的階段才載入，縮短啟動時間
+# （POS 匯出檔與 .xlsx 對照表都不需要 pandas，只有格式無法辨識時才載入）
+
+
+@functools.lru_cache(maxsize=None)
+def _lxml_etree():
+    """第一次解析 HTML 時才載入 lxml，沒有 lxml 時回傳 None（改用 pandas 讀取）"""
+    try:
+        from lxml import etree
+    except ImportError:
+        return None
+    return etree
 
 # 版本資訊
 __version__ = '1.0.0'
@@ -22,9 +54,2149 @@ logging.basicConfig(
 # 建立logger實例
 logger = logging.getLogger(__name__)
 
-class SalesDataProcessor:
+
+class _JsonLogFormatter(logging.Formatter):
+    """每筆日誌輸出為一行 JSON，量測數據（extra={'metrics': ...}）併入欄位"""
+    
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        metrics = getattr(record, 'metrics', None)
+        if metrics:
+            payload.update(metrics)
+        if record.exc_info:
+            payload['exception'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def configure_logging(level=logging.INFO, json_format=False, log_file=None):
+    """
+    重新設定日誌輸出
+    - level 為日誌層級（DEBUG 會列出每個檔案的量測明細）
+    - json_format 為 True 時每筆日誌輸出一行 JSON，方便其他程式解析
+    - 指定 log_file 時同時寫入該檔案，標準錯誤仍照常輸出
+    """
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    for handler in handlers:
+        if json_format:
+            handler.setFormatter(_JsonLogFormatter())
+        else:
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.basicConfig(level=level, handlers=handlers, force=True)
+
+# 處理流程會用到的 POS 匯出檔欄位
+POS_EXPORT_COLUMNS = ["品　種", "時間", "單價", "類別", "數量", "金額", "發票", "贈送原因"]
+
+# pandas 預設視為空值的字串
+_PANDAS_NA_VALUES = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None",
+    "n/a", "nan", "null"
+}
+
+# 與 pandas.read_html 相同的空白壓縮規則
+_HTML_WHITESPACE_RE = re.compile(r"[\r\n]+|\s{2,}")
+# pandas 判斷儲存格是否為可移除千分位的數字
+_THOUSANDS_NUMBER_RE = re.compile(r"^[\-\+]?([0-9]+,|[0-9])*(\.[0-9]*)?([0-9]?(E|e)\-?[0-9]+)?$")
+_INT_CELL_RE = re.compile(r"[+-]?[0-9]+")
+_FLOAT_CELL_RE = re.compile(r"[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?")
+# pandas 會另外轉型、這裡不模擬的值
+_UNSUPPORTED_CELL_RE = re.compile(r"[+-]?(inf|infinity|nan)|true|false", re.IGNORECASE)
+
+
+# 發票欄位的擷取規則
+_INVOICE_NUMBER_RE = re.compile(r"發票號:(\w+)")
+_INVOICE_AMOUNT_RE = re.compile(r"發票金額:(\d+)")
+
+
+# 標準化商品名稱的字元轉換表
+_PRODUCT_NAME_TRANSLATION = str.maketrans({
+    " ": None, "\u3000": None,              # 半形空格、全形空格
+    "（": "(", "）": ")",                     # 中文括號轉英文
+    "\u200b": None, "\u200e": None, "\u202c": None,  # 隱藏字元
+})
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize_product_name(name):
+    """
+    標準化商品名稱：
+    - 移除所有空白（半形、全形）
+    - 將中文括號替換為英文括號
+    - 去除不可見字元
+    - 轉為小寫（便於比對）
+    同一品名會在每張單據重複出現，結果以有上限的快取保存
+    """
+    return name.strip().translate(_PRODUCT_NAME_TRANSLATION).lower()
+
+
+def normalize_product_names(names):
+    """
+    批次標準化整欄商品名稱
+    - pandas Series 以向量化字串操作處理，空值維持空值
+    - 其他可迭代物件回傳 list，None 維持 None
+    """
+    pd = sys.modules.get('pandas')  # 尚未載入 pandas 時不可能是 Series
+    if pd is not None and isinstance(names, pd.Series):
+        return names.str.strip().str.translate(_PRODUCT_NAME_TRANSLATION).str.lower()
+    return [None if name is None else normalize_product_name(name) for name in names]
+
+
+# 付款方式與對應的品種關鍵字（不分大小寫），依優先順序排列：
+# 同一張單據出現多種付款方式的關鍵字時，單筆品種取排在前面的付款方式
+DEFAULT_PAYMENT_METHODS = {
+    "現金": ["現金"],
+    "挂帳": ["挂帳"],
+    "信用卡": ["VISA", "MASTER", "AE", "JCB", "銀聯"],
+    "匯款": ["匯款", "訂金"],
+}
+# 付款方式的傳票類別與金額欄（cash 寫入付現金額、card 寫入刷卡金額、None 兩欄都不填）
+# 挂帳的傳票類別優先依掛帳對照表，查不到客戶代號時才使用這裡的設定
+DEFAULT_PAYMENT_ROUTING = {
+    "現金": ("S998", "cash"),
+    "挂帳": ("S996", None),
+    "信用卡": ("S997", "card"),
+    "匯款": ("S996", None),
+}
+DEFAULT_VOUCHER_TYPE = "S996"
+PAYMENT_AMOUNT_COLUMNS = (None, "cash", "card")
+_SERVICE_FEE_KEY = normalize_product_name("[服務費]")
+
+
+class PaymentClassifier:
+    """
+    付款方式分類器：所有付款關鍵字只編譯一次，合併為單一正規表示式
+    - 品種包含某個關鍵字時判定為該付款方式，包含多個時取優先順序較前的付款方式
+    - 標準化後的品種等於任一關鍵字（或 skip_keywords）時為付款或結帳列，不列入商品資料
+    - 新增付款方式只需在 payment_methods 加入付款方式與關鍵字（批次設定檔的 payment_methods）
+    - 每種付款方式可設定為關鍵字列表，或 {'keywords', 'voucher_type', 'amount'}（傳票類別與金額欄）；
+      未設定的部分沿用 DEFAULT_PAYMENT_ROUTING，新的付款方式預設為 S996、不填付現或刷卡金額
+    """
+    
+    CACHE_SIZE = 65536
+    
+    def __init__(self, payment_methods=None, skip_keywords=()):
+        self.payment_methods = {}
+        # 付款方式 → (傳票類別, 金額欄)
+        self.routing = {}
+        for method, entry in (payment_methods or DEFAULT_PAYMENT_METHODS).items():
+            voucher_type, amount = DEFAULT_PAYMENT_ROUTING.get(method, (DEFAULT_VOUCHER_TYPE, None))
+            if isinstance(entry, dict):
+                keywords = entry.get('keywords', [])
+                voucher_type = entry.get('voucher_type', voucher_type)
+                amount = entry.get('amount', amount)
+            else:
+                keywords = entry
+                if method not in DEFAULT_PAYMENT_ROUTING:
+                    logger.warning(f"付款方式 {method} 未設定傳票類別與金額欄，使用 {DEFAULT_VOUCHER_TYPE}、不填付現或刷卡金額")
+            if amount not in PAYMENT_AMOUNT_COLUMNS:
+                raise ValueError(f"付款方式 {method} 的金額欄只能是 cash、card 或 null: {amount}")
+            self.payment_methods[method] = list(keywords)
+            self.routing[method] = (voucher_type, amount)
+        self.skip_keywords = list(skip_keywords)
+        
+        # 關鍵字 → 優先順序；以前瞻比對找出每個位置的關鍵字（包含重疊的關鍵字）
+        self._methods = list(self.payment_methods)
+        self._priority = {}
+        for priority, keywords in enumerate(self.payment_methods.values()):
+            for keyword in keywords:
+                self._priority.setdefault(keyword.lower(), priority)
+        alternation = "|".join(re.escape(keyword) for keyword in self._priority)
+        self._pattern = re.compile(f"(?=({alternation}))") if alternation else None
+        
+        self._skip = frozenset(normalize_product_names(
+            [keyword for keywords in self.payment_methods.values() for keyword in keywords]
+            + self.skip_keywords
+        ))
+        self._cache = {}
+    
+    def __reduce__(self):
+        # 傳送到工作程序時只傳設定，由工作程序重新編譯
+        return PaymentClassifier, (self.config(), self.skip_keywords)
+    
+    def config(self):
+        """完整的付款方式設定 {付款方式: {'keywords', 'voucher_type', 'amount'}}"""
+        return {
+            method: {'keywords': keywords, 'voucher_type': self.routing[method][0], 'amount': self.routing[method][1]}
+            for method, keywords in self.payment_methods.items()
+        }
+    
+    def voucher_type(self, method):
+        """付款方式的傳票類別（多種付款與挂帳由呼叫端另外處理）"""
+        return self.routing.get(method, (DEFAULT_VOUCHER_TYPE, None))[0]
+    
+    def amount_column(self, method):
+        """付款方式的金額寫入付現金額（cash）、刷卡金額（card）或都不填（None）"""
+        return self.routing.get(method, (DEFAULT_VOUCHER_TYPE, None))[1]
+    
+    def detect(self, product):
+        """判斷單筆品種的付款方式，不是付款方式時回傳 None"""
+        method = self._cache.get(product, False)
+        if method is not False:
+            return method
+        
+        method = None
+        if self._pattern is not None:
+            priorities = [self._priority[m.group(1)] for m in self._pattern.finditer(product.lower())]
+            if priorities:
+                method = self._methods[min(priorities)]
+        
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[product] = method
+        return method
+    
+    def is_skipped(self, product_key):
+        """標準化後的品種是否為付款或結帳列"""
+        return product_key in self._skip
+    
+    def classify(self, products, normalized_products):
+        """
+        一次分類整欄品種，回傳 (出現的付款方式集合, 略過遮罩)
+        - 略過遮罩為每列是否為付款或結帳列（品種為空時為 False）
+        """
+        detect = self.detect
+        skip = self._skip
+        methods = set()
+        skip_mask = []
+        for product, key in zip(products, normalized_products):
+            if product is None:
+                skip_mask.append(False)
+                continue
+            method = detect(product)
+            if method is not None:
+                methods.add(method)
+            skip_mask.append(key in skip)
+        return methods, skip_mask
+
+
+class PosTable(dict):
+    """POS 匯出檔的欄位資料：{欄位名稱: 字串列表}，空值為 None，另記錄資料列數"""
+    
+    def __init__(self, columns, row_count):
+        super().__init__(columns)
+        self.row_count = row_count
+    
+    def select(self, columns):
+        """只含指定欄位的 PosTable（欄位資料共用，不複製）"""
+        return PosTable({name: self[name] for name in columns if name in self}, self.row_count)
+
+
+class SourceFile:
+    """
+    只讀取一次的來源檔案
+    - 第一次取用內容時整個讀入記憶體，大檔改以 mmap 對應；之後的格式判斷、雜湊與解析都使用同一份內容
+    - 依開頭位元組判斷格式：html、biff（舊版 .xls）、ooxml（.xlsx/.xlsm），無法判斷時為 None
+    - 使用 mmap 時以 close() 或 with 釋放
+    """
+    
+    MMAP_THRESHOLD = 16 * 1024 * 1024
+    OLE2_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+    ZIP_MAGIC = b'PK\x03\x04'
+    
+    def __init__(self, path):
+        self.path = path
+        # 壓縮檔內的檔案為 (壓縮檔路徑, 成員名稱)，一般檔案為 None
+        self.member = InputArchive.split(path)
+        self._data = None
+        self._stat = None
+        self._mmap = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def stat(self):
+        """檔案狀態；已讀取內容時為讀取當時的狀態"""
+        if self._stat is None:
+            if self.member is not None:
+                archive_path, name = self.member
+                self._stat = InputArchive.open(archive_path).stat(name)
+            else:
+                self._stat = os.stat(self.path)
+        return self._stat
+    
+    @property
+    def data(self):
+        """檔案內容（bytes 或 mmap）"""
+        if self._data is None and self.member is not None:
+            # 壓縮檔內的檔案直接解壓縮到記憶體，不寫到磁碟
+            archive_path, name = self.member
+            archive = InputArchive.open(archive_path)
+            self._stat = archive.stat(name)
+            self._data = archive.read(name)
+        elif self._data is None:
+            with open(self.path, 'rb') as f:
+                self._stat = os.fstat(f.fileno())
+                if self._stat.st_size >= self.MMAP_THRESHOLD:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._data = self._mmap
+                else:
+                    self._data = f.read()
+        return self._data
+    
+    @property
+    def kind(self):
+        return self.sniff(self.data[:20])
+    
+    @classmethod
+    def sniff(cls, head):
+        """依檔案開頭的位元組判斷格式"""
+        head = head[:20]
+        if head.startswith(cls.OLE2_MAGIC):
+            return 'biff'
+        if head.startswith(cls.ZIP_MAGIC):
+            return 'ooxml'
+        head = head.lower()
+        if b'<html' in head or b'<!doctype' in head:
+            return 'html'
+        return None
+    
+    def stream(self):
+        """以檔案物件形式提供內容給 pandas、openpyxl 等解析器（mmap 內容會複製一份）"""
+        return io.BytesIO(self.data)
+    
+    def open(self):
+        """不整個讀入內容，以檔案物件從頭逐段讀取（只需檔案開頭時使用）"""
+        if self.member is not None:
+            archive_path, name = self.member
+            return InputArchive.open(archive_path).open_member(name)
+        return open(self.path, 'rb')
+    
+    def digest(self):
+        """內容雜湊（與 ParsedFileCache.file_digest 相同）"""
+        return hashlib.blake2b(self.data, digest_size=20).hexdigest()
+    
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._data = None
+
+
+# 壓縮檔內檔案的狀態（與 os.stat 結果相同的欄位名稱）
+ArchiveMemberStat = collections.namedtuple('ArchiveMemberStat', ['st_size', 'st_mtime', 'st_mtime_ns'])
+
+
+class InputArchive:
+    """
+    以壓縮檔（.zip、.tar.gz）代替資料夾作為輸入，不需先解壓縮到磁碟
+    - 壓縮檔內的檔案路徑寫成「壓縮檔路徑/成員名稱」，與資料夾內的檔案一樣傳遞、快取與記錄
+    - 檔案大小為解壓縮後的大小，修改時間以壓縮檔的修改時間代表
+    - 每個程序各自開啟（分岔出的工作程序不共用檔案位置），壓縮檔變更時重新開啟
+    - .tar.gz 只能循序解壓縮，依檔案在壓縮檔內的順序讀取最快
+    """
+    
+    SUFFIXES = ('.zip', '.tar.gz', '.tgz')
+    _SUFFIX_RE = re.compile(r'\.(?:zip|tar\.gz|tgz)(?=[\\/])', re.IGNORECASE)
+    
+    # 絕對路徑 → 已開啟的 InputArchive（只在開啟的程序內使用）
+    _opened = {}
+    _opened_pid = None
+    _opened_lock = threading.Lock()
+    
+    def __init__(self, path, st=None):
+        import tarfile
+        import zipfile
+        self.path = path
+        st = st or os.stat(path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self._zip = None
+        self._tar = None
+        self._lock = threading.Lock()
+        try:
+            if path.lower().endswith('.zip'):
+                self._zip = zipfile.ZipFile(path)
+                infos = [(info.filename, info, info.file_size)
+                         for info in self._zip.infolist() if not info.is_dir()]
+            else:
+                self._tar = tarfile.open(path, 'r:gz')
+                infos = [(info.name, info, info.size) for info in self._tar.getmembers() if info.isfile()]
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+            self.close()
+            raise ValueError(f"無法讀取壓縮檔 {path}: {str(e)}") from e
+        # 正規化的成員名稱 → (ZipInfo 或 TarInfo, 解壓縮後大小)，依壓縮檔內的順序
+        self._members = {posixpath.normpath(name): (info, size) for name, info, size in infos}
+    
+    @classmethod
+    def is_archive(cls, path):
+        """路徑是否為可當作輸入資料夾的壓縮檔"""
+        return path.lower().endswith(cls.SUFFIXES) and os.path.isfile(path)
+    
+    @classmethod
+    def split(cls, path):
+        """將壓縮檔內的檔案路徑拆成 (壓縮檔路徑, 成員名稱)，不是壓縮檔內的檔案時回傳 None"""
+        for m in cls._SUFFIX_RE.finditer(path):
+            archive_path = path[:m.end()]
+            if os.path.isfile(archive_path):
+                name = path[m.end():].lstrip('\\/').replace(os.sep, '/')
+                return archive_path, posixpath.normpath(name)
+        return None
+    
+    @classmethod
+    def open(cls, path):
+        """取得已開啟的壓縮檔（同一程序內共用，大小或修改時間變更時重新開啟）"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with cls._opened_lock:
+            if cls._opened_pid != os.getpid():
+                cls._opened = {}
+                cls._opened_pid = os.getpid()
+            archive = cls._opened.get(path)
+            if archive is None or (archive.size, archive.mtime_ns) != (st.st_size, st.st_mtime_ns):
+                if archive is not None:
+                    archive.close()
+                archive = cls._opened[path] = cls(path, st)
+        return archive
+    
+    def names(self):
+        """壓縮檔內所有檔案的成員名稱（含子資料夾），依壓縮檔內的順序"""
+        return list(self._members)
+    
+    def _info(self, name):
+        try:
+            return self._members[name]
+        except KeyError:
+            raise FileNotFoundError(f"壓縮檔 {self.path} 內沒有 {name}") from None
+    
+    def stat(self, name):
+        """壓縮檔內檔案的狀態"""
+        _, size = self._info(name)
+        return ArchiveMemberStat(size, self.mtime, self.mtime_ns)
+    
+    def read(self, name):
+        """解壓縮並讀取整個檔案"""
+        info, _ = self._info(name)
+        with self._lock:
+            if self._zip is not None:
+                return self._zip.read(info)
+            return self._tar.extractfile(info).read()
+    
+    def open_member(self, name):
+        """以檔案物件讀取壓縮檔內的檔案：.zip 逐段解壓縮；.tar.gz 先整個讀入，避免多個執行緒交錯移動檔案位置"""
+        info, _ = self._info(name)
+        if self._zip is not None:
+            with self._lock:
+                return self._zip.open(info)
+        return io.BytesIO(self.read(name))
+    
+    def close(self):
+        for archive in (self._zip, self._tar):
+            if archive is not None:
+                archive.close()
+
+
+class ParsedFileCache:
+    """
+    POS 匯出檔解析結果的磁碟快取（SQLite）
+    - 以路徑、檔案大小、修改時間與內容雜湊識別檔案，檔案未變更時直接取用解析結果
+    - 快取的是對照前的欄位資料，產品代號表或掛帳表更新後不需重新解析
+    - 超過容量上限時，依最後使用時間淘汰最舊的項目
+    - 解析結果以內建型別（{欄位名稱: 列表}, 資料列數）儲存，不依賴類別所在的模組名稱，
+      以 python sales_data_processor.py 執行（模組為 __main__）與其他程式可共用同一個快取
+    """
+    
+    # 解析邏輯或儲存格式變更時調整版本號，讓舊的快取失效
+    VERSION = 2
+    
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_path = os.path.join(cache_dir, "parsed_files.sqlite3")
+        self._conn = None
+    
+    def __getstate__(self):
+        # 資料庫連線不能跨程序傳遞，由各程序自行重新連線
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+    
+    def _connect(self):
+        """開啟（必要時建立）快取資料庫"""
+        if self._conn is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # 逐檔處理時由讀取執行緒使用，同一時間只有一個執行緒存取
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            # WAL 模式讓平行處理的工作程序可以同時讀寫
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " path TEXT, columns TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT,"
+                " PRIMARY KEY (path, columns))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tables ("
+                " digest TEXT, columns TEXT, data BLOB, nbytes INTEGER, last_used REAL,"
+                " PRIMARY KEY (digest, columns))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tables_last_used ON tables (last_used)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    def _columns_key(self, columns):
+        return f"v{self.VERSION}|" + "|".join(columns)
+    
+    @staticmethod
+    def file_digest(file_path):
+        """計算檔案內容雜湊"""
+        with SourceFile(file_path) as source:
+            return source.digest()
+    
+    def lookup(self, file_path, columns, source=None):
+        """
+        查詢快取，回傳 (解析結果, 內容雜湊)
+        - 路徑、大小、修改時間都相同時不重新計算雜湊，也不讀取檔案內容
+        - 未命中時解析結果為 None，雜湊供 store 使用
+        - source 為已開啟的 SourceFile 時，雜湊與之後的解析共用同一份內容
+        """
+        conn = self._connect()
+        columns_key = self._columns_key(columns)
+        path = os.path.abspath(file_path)
+        if source is None:
+            source = SourceFile(path)
+        st = source.stat()
+        
+        row = conn.execute(
+            "SELECT size, mtime_ns, digest FROM files WHERE path = ? AND columns = ?",
+            (path, columns_key)
+        ).fetchone()
+        
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            digest = row[2]
+        else:
+            # 檔案可能被覆寫或只是更新了修改時間，以內容雜湊判斷（記錄讀取內容時的檔案狀態）
+            digest = source.digest()
+            st = source.stat()
+            conn.execute(
+                "INSERT OR REPLACE INTO files (path, columns, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?)",
+                (path, columns_key, st.st_size, st.st_mtime_ns, digest)
+            )
+        
+        blob = conn.execute(
+            "SELECT data FROM tables WHERE digest = ? AND columns = ?",
+            (digest, columns_key)
+        ).fetchone()
+        
+        if blob is None:
+            conn.commit()
+            return None, digest
+        
+        try:
+            table_columns, row_count = pickle.loads(blob[0])
+            table = PosTable(table_columns, row_count)
+        except Exception as e:
+            # 損壞或無法還原的項目視為未命中並移除，之後重新解析寫入
+            logger.warning(f"解析快取項目無法讀取，重新解析 {file_path}: {str(e)}")
+            conn.execute("DELETE FROM tables WHERE digest = ? AND columns = ?", (digest, columns_key))
+            conn.commit()
+            return None, digest
+        
+        conn.execute(
+            "UPDATE tables SET last_used = ? WHERE digest = ? AND columns = ?",
+            (time.time(), digest, columns_key)
+        )
+        conn.commit()
+        return table, digest
+    
+    def store(self, digest, columns, table):
+        """寫入解析結果，並在超過容量上限時淘汰最久未使用的項目"""
+        conn = self._connect()
+        data = pickle.dumps((dict(table), table.row_count), protocol=pickle.HIGHEST_PROTOCOL)
+        conn.execute(
+            "INSERT OR REPLACE INTO tables (digest, columns, data, nbytes, last_used) VALUES (?, ?, ?, ?, ?)",
+            (digest, self._columns_key(columns), data, len(data), time.time())
+        )
+        self._evict(conn)
+        conn.commit()
+    
+    def _evict(self, conn):
+        """淘汰最久未使用的項目，直到總容量低於上限"""
+        total = conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM tables").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        for digest, columns_key, nbytes in conn.execute(
+            "SELECT digest, columns, nbytes FROM tables ORDER BY last_used"
+        ).fetchall():
+            conn.execute("DELETE FROM tables WHERE digest = ? AND columns = ?", (digest, columns_key))
+            total -= nbytes
+            if total <= self.max_bytes:
+                break
+        
+        # 移除已沒有對應解析結果的檔案記錄
+        conn.execute(
+            "DELETE FROM files WHERE NOT EXISTS ("
+            " SELECT 1 FROM tables WHERE tables.digest = files.digest AND tables.columns = files.columns)"
+        )
+    
+    def invalidate(self, file_path=None):
+        """讓指定檔案的快取失效；未指定檔案時清空整個快取"""
+        conn = self._connect()
+        if file_path is None:
+            conn.execute("DELETE FROM files")
+            conn.execute("DELETE FROM tables")
+        else:
+            path = os.path.abspath(file_path)
+            conn.execute(
+                "DELETE FROM tables WHERE EXISTS ("
+                " SELECT 1 FROM files WHERE files.path = ?"
+                " AND files.digest = tables.digest AND files.columns = tables.columns)",
+                (path,)
+            )
+            conn.execute("DELETE FROM files WHERE path = ?", (path,))
+        conn.commit()
+        if file_path is None:
+            conn.execute("VACUUM")
+    
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class ParsedTableLRU:
+    """
+    程序內的解析結果記憶體快取，依最近使用淘汰
+    - 以路徑、檔案大小與修改時間識別檔案，檔案變更後自動失效
+    - 每個檔案保留一份解析結果，要求的欄位是已解析欄位的子集時直接取用
+    - 總容量以估計的位元組數計算，超過上限時淘汰最久未使用的項目
+    - 記錄命中、未命中與淘汰次數，供調整容量參考
+    """
+    
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # 絕對路徑 → (大小, 修改時間, PosTable, 估計位元組數)，依使用順序排列
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    @staticmethod
+    def table_bytes(table):
+        """估計 PosTable 佔用的記憶體（列表與儲存格字串）"""
+        return sum(sys.getsizeof(column) + sum(map(sys.getsizeof, column)) for column in table.values())
+    
+    def get(self, file_path, st, columns):
+        """檔案狀態相同且包含所有要求的欄位時回傳只含這些欄位的 PosTable，否則回傳 None"""
+        path = os.path.abspath(file_path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if (entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns
+                    or not all(name in entry[2] for name in columns)):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+        return entry[2].select(columns)
+    
+    def put(self, file_path, st, table):
+        """存入解析結果（取代同一檔案的舊結果），超過容量上限時淘汰最久未使用的項目"""
+        nbytes = self.table_bytes(table)
+        if nbytes > self.max_bytes:
+            return
+        path = os.path.abspath(file_path)
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.total_bytes -= old[3]
+            self._entries[path] = (st.st_size, st.st_mtime_ns, table, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, _, _, evicted_bytes) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.evictions += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+    
+    def stats(self):
+        """命中統計（可直接寫成 JSON）"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+        }
+    
+    def log_stats(self):
+        stats = self.stats()
+        hit_rate = f"{stats['hit_rate']:.0%}" if stats['hit_rate'] is not None else "-"
+        logger.info(
+            f"記憶體快取: 命中 {stats['hits']} 次、未命中 {stats['misses']} 次（命中率 {hit_rate}）、"
+            f"淘汰 {stats['evictions']} 次；{stats['entries']} 個檔案 "
+            f"{stats['bytes'] / 1024 / 1024:.1f}/{stats['max_bytes'] / 1024 / 1024:.0f} MB",
+            extra={'metrics': {'table_cache': stats}}
+        )
+
+
+class ProductCandidateIndex:
+    """
+    產品名稱的字元 n-gram（二字、三字）倒排索引
+    - 對查不到產品代號的品名，依 n-gram 重疊程度（Dice 係數）列出最接近的候選產品
+    - 建立時只走一次所有品名，五萬筆以上的產品表也能在一兩秒內完成
+    """
+    
+    GRAM_SIZES = (2, 3)
+    
+    def __init__(self, product_mapping):
+        self._names = list(product_mapping)
+        self._codes = [product_mapping[name] for name in self._names]
+        self._name_grams = []
+        postings = {}
+        for index, name in enumerate(self._names):
+            grams = self.grams(name)
+            self._name_grams.append(grams)
+            for gram in grams:
+                posting = postings.get(gram)
+                if posting is None:
+                    postings[gram] = [index]
+                else:
+                    posting.append(index)
+        self._postings = postings
+        # 出現在太多品名中的 n-gram（如容量單位）只用於計分，不用於挑選候選
+        self._common_limit = max(64, len(self._names) // 20)
+    
+    def __len__(self):
+        return len(self._names)
+    
+    def state(self):
+        """以內建型別表示的索引內容（存入對照表快照）"""
+        return dict(self.__dict__)
+    
+    @classmethod
+    def from_state(cls, state):
+        """由 state() 的內容還原索引，不重新建立"""
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        return index
+    
+    @classmethod
+    def grams(cls, name):
+        """取得已標準化品名的 n-gram 集合，品名短於兩字時以整個品名為 n-gram"""
+        if len(name) < cls.GRAM_SIZES[0]:
+            return frozenset([name]) if name else frozenset()
+        return frozenset(
+            name[start:start + size]
+            for size in cls.GRAM_SIZES
+            for start in range(len(name) - size + 1)
+        )
+    
+    def candidates(self, name, k=5):
+        """
+        回傳與品名最接近的前 k 個候選 [(產品代號, 標準化品名, 分數)]，分數介於 0 到 1
+        """
+        query = self.grams(normalize_product_name(str(name)))
+        usable = [gram for gram in query if gram in self._postings]
+        if not usable or k <= 0:
+            return []
+        
+        selective = [gram for gram in usable if len(self._postings[gram]) <= self._common_limit] or usable
+        hits = {}
+        for gram in selective:
+            for index in self._postings[gram]:
+                hits[index] = hits.get(index, 0) + 1
+        
+        # 先依共同 n-gram 數粗篩，再以完整 n-gram 集合計算 Dice 係數
+        shortlist = heapq.nlargest(k * 8, hits, key=hits.__getitem__)
+        query_size = len(query)
+        scored = []
+        for index in shortlist:
+            grams = self._name_grams[index]
+            score = 2 * len(query & grams) / (query_size + len(grams))
+            scored.append((score, -index))
+        
+        return [
+            (self._codes[-negative_index], self._names[-negative_index], round(score, 3))
+            for score, negative_index in heapq.nlargest(k, scored)
+        ]
+
+
+class ReferenceData:
+    """
+    產品、掛帳與客戶供應商對照表的編譯快照
+    - 以來源檔案的內容雜湊為鍵存成 pickle，之後執行時直接載入
+    - 快照只含內建型別，不依賴類別所在的模組名稱（以 python sales_data_processor.py 執行時為 __main__），
+      命令列與其他程式可共用同一份快照
+    - 提供以標準化品名、掛帳帳號與客戶代號查詢的介面
+    - 品名的 n-gram 候選索引在第一次使用時才建立（需要候選報表時），已建立的索引一併存入快照
+    """
+    
+    # 對照表載入邏輯變更時調整版本號，讓舊的快照失效
+    VERSION = 4
+    
+    def __init__(self, product_mapping, account_mapping, customer_mapping, build_index=False):
+        self.product_mapping = product_mapping
+        self.account_mapping = account_mapping
+        self.customer_mapping = customer_mapping
+        # 產品數多時建立索引需要數秒，不輸出候選報表時不建立
+        self._product_index = ProductCandidateIndex(product_mapping) if build_index else None
+        # 數字代號去掉前導零後的索引，讓 '000001' 與 '001' 都能查到
+        self._customers_by_number = {
+            code.lstrip('0') or '0': code for code in customer_mapping if code.isdigit()
+        }
+    
+    @property
+    def product_index(self):
+        """品名的 n-gram 候選索引（第一次使用時建立）"""
+        if self._product_index is None:
+            self._product_index = ProductCandidateIndex(self.product_mapping)
+        return self._product_index
+    
+    @property
+    def has_product_index(self):
+        """是否已建立候選索引"""
+        return self._product_index is not None
+    
+    @classmethod
+    def source_key(cls, paths, sources=None):
+        """
+        依來源檔案路徑與內容雜湊產生快照鍵值「來源組合_內容」（sources 為對應的 SourceFile，可與載入共用內容）
+        - 來源組合只由檔案路徑決定，同一組對照表更新後只取代自己的舊快照
+        """
+        paths_digest = hashlib.blake2b(digest_size=8)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"v{cls.VERSION}".encode())
+        for path, source in zip(paths, sources or [None] * len(paths)):
+            paths_digest.update(b"\0")
+            digest.update(b"\0")
+            if path and os.path.isfile(path):
+                paths_digest.update(os.path.abspath(path).encode('utf-8'))
+                digest.update(os.path.abspath(path).encode('utf-8'))
+                digest.update((source or SourceFile(path)).digest().encode())
+            else:
+                paths_digest.update(b"-")
+                digest.update(b"-")
+        return f"{paths_digest.hexdigest()}_{digest.hexdigest()}"
+    
+    @classmethod
+    def load(cls, snapshot_path):
+        with open(snapshot_path, 'rb') as f:
+            state = pickle.load(f)
+        if not isinstance(state, dict) or state.get('version') != cls.VERSION:
+            raise ValueError(f"不是對照表快照: {snapshot_path}")
+        reference = cls(state['product_mapping'], state['account_mapping'], state['customer_mapping'])
+        if state['product_index'] is not None:
+            reference._product_index = ProductCandidateIndex.from_state(state['product_index'])
+        return reference
+    
+    def save(self, snapshot_path):
+        """
+        寫入快照（先寫暫存檔再取代），並移除同一組來源檔案過期的快照
+        - 快照檔名為 reference_來源組合_內容.pickle，共用快取資料夾的其他設定（不同對照表）的快照不受影響
+        """
+        snapshot_dir = os.path.dirname(snapshot_path)
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+        temp_path = snapshot_path + ".tmp"
+        state = {
+            'version': self.VERSION,
+            'product_mapping': self.product_mapping,
+            'account_mapping': self.account_mapping,
+            'customer_mapping': self.customer_mapping,
+            'product_index': None if self._product_index is None else self._product_index.state(),
+        }
+        with open(temp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, snapshot_path)
+        
+        prefix = os.path.basename(snapshot_path).rsplit('_', 1)[0]
+        for old_path in glob.glob(os.path.join(snapshot_dir or ".", f"{glob.escape(prefix)}_*.pickle")):
+            if os.path.abspath(old_path) != os.path.abspath(snapshot_path):
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+    
+    def product_code(self, name, default=None):
+        """以品名查詢產品代號（先標準化品名）"""
+        return self.product_mapping.get(normalize_product_name(str(name)), default)
+    
+    def voucher_type(self, account_id, default=None):
+        """以掛帳帳號查詢傳票類別（帳號補滿六位）"""
+        return self.account_mapping.get(str(account_id).strip().zfill(6), default)
+    
+    def customer(self, code, default=None):
+        """以客戶供應商代號查詢資料，回傳 {'short_name', 'full_name', 'voucher_type'}"""
+        code = str(code).strip()
+        if code in self.customer_mapping:
+            return self.customer_mapping[code]
+        if code.isdigit():
+            matched = self._customers_by_number.get(code.lstrip('0') or '0')
+            if matched is not None:
+                return self.customer_mapping[matched]
+        return default
+
+
+def _excel_cell_value(value):
+    """與 pandas 讀取 openpyxl 儲存格相同：整數值的浮點數轉為整數"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _pandas_like_excel_column(values):
+    """
+    將唯讀模式讀到的一欄儲存格轉為與 pandas 讀取後 str(value) 相同的字串，空值為 None
+    - 整欄都是數字時 pandas 會轉為數值欄位（受空白列影響），此時回傳 None 交由 pandas 處理
+    """
+    column = []
+    numeric = True
+    for value in values:
+        if value is None or (isinstance(value, str) and value in _PANDAS_NA_VALUES):
+            column.append(None)
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            numeric = False
+        elif isinstance(value, str):
+            stripped = value.strip()
+            if _INT_CELL_RE.fullmatch(stripped) or _FLOAT_CELL_RE.fullmatch(stripped):
+                if stripped != value:
+                    return None
+            else:
+                numeric = False
+        column.append(str(value))
+    
+    if numeric and any(value is not None for value in column):
+        return None
+    return column
+
+
+def _is_pos_export_head(head):
+    """檔案開頭（前 1024 位元組）是否為 POS 系統匯出的格式（Office HTML + htmldw 樣式表）"""
+    if b'<html' not in head[:20].lower():
+        return False
+    return b'urn:schemas-microsoft-com:office' in head and b'htmldw' in head
+
+
+class _UnrecognizedPosExport(Exception):
+    """POS 匯出檔格式不符預期，交回 pandas 處理"""
+
+
+def _html_cell_text(cell):
+    """取得儲存格文字，規則與 pandas.read_html 相同（<br> 視為換行、忽略註解）"""
+    if len(cell) == 0:
+        text = cell.text or ""
+    else:
+        parts = [cell.text or ""]
+        
+        def collect(node):
+            for child in node:
+                if child.tag == "br":
+                    parts.append("\n")
+                elif isinstance(child.tag, str):
+                    parts.append(child.text or "")
+                    collect(child)
+                parts.append(child.tail or "")
+        
+        collect(cell)
+        text = "".join(parts)
+    return _HTML_WHITESPACE_RE.sub(" ", text.strip())
+
+
+def _pandas_like_column(cells):
+    """
+    將一欄原始文字轉為與 pandas 讀取後 str(value).strip() 相同的字串，空值為 None
+    - 移除數字的千分位逗號
+    - 整欄皆為數字時依 pandas 規則轉為整數或浮點數字串
+    """
+    values = []
+    for cell in cells:
+        if "," in cell and _THOUSANDS_NUMBER_RE.match(cell):
+            cell = cell.replace(",", "")
+        if cell in _PANDAS_NA_VALUES:
+            values.append(None)
+            continue
+        if _UNSUPPORTED_CELL_RE.fullmatch(cell):
+            raise _UnrecognizedPosExport(f"無法判斷的儲存格: {cell}")
+        values.append(cell)
+    
+    numbers = []
+    has_float = False
+    for value in values:
+        if value is None:
+            has_float = True
+            numbers.append(None)
+        elif _INT_CELL_RE.fullmatch(value):
+            number = int(value)
+            if not -2 ** 63 <= number < 2 ** 63:
+                raise _UnrecognizedPosExport(f"超出整數範圍: {value}")
+            numbers.append(number)
+        elif _FLOAT_CELL_RE.fullmatch(value):
+            has_float = True
+            numbers.append(float(value))
+        else:
+            # 含有文字，整欄維持字串
+            return values
+    
+    if not any(number is not None for number in numbers):
+        return values
+    if has_float:
+        return [None if number is None else str(float(number)) for number in numbers]
+    return [str(number) for number in numbers]
+
+
+
+class TaxEngine:
+    """
+    含稅金額的稅額計算：金額解析為整數（有小數時為 Decimal），以整數與分數運算，結果不受浮點誤差影響
+    - 稅額 = 含稅金額 × 稅率 ÷ (1 + 稅率)，取整方式為四捨六入五成雙（與 Python round 相同）
+    - 稅率可設定（預設 5%），以字串或 Decimal 指定
+    """
+    
+    DEFAULT_RATE = '0.05'
+    
+    def __init__(self, rate=DEFAULT_RATE):
+        try:
+            self.rate = decimal.Decimal(str(rate))
+        except decimal.InvalidOperation:
+            raise ValueError(f"稅率格式不正確: {rate}")
+        if not self.rate.is_finite() or self.rate < 0:
+            raise ValueError(f"稅率格式不正確: {rate}")
+        rate_fraction = fractions.Fraction(self.rate)
+        self._tax_fraction = rate_fraction / (1 + rate_fraction)
+        self._tax_numerator = self._tax_fraction.numerator
+        self._tax_denominator = self._tax_fraction.denominator
+    
+    @staticmethod
+    def parse_amount(text):
+        """解析金額文字（可含千分位逗號），沒有小數部分時回傳 int，否則回傳 Decimal，無法解析時回傳 None"""
+        if text is None:
+            return None
+        text = text.replace(",", "")
+        # 常見的「1200」「1200.0」「1200.」直接以整數解析
+        whole, _, fraction_digits = text.partition(".")
+        if not fraction_digits.strip("0"):
+            try:
+                return int(whole)
+            except ValueError:
+                pass
+        try:
+            value = decimal.Decimal(text)
+        except decimal.InvalidOperation:
+            return None
+        if not value.is_finite():
+            return None
+        integral = value.to_integral_value()
+        return int(integral) if integral == value else value
+    
+    def parse_amounts(self, texts):
+        """整欄解析金額文字，每個值與 parse_amount 相同（int 或 Decimal，無法解析時為 None）"""
+        parse = self.parse_amount
+        return [parse(text) for text in texts]
+    
+    def tax(self, amount):
+        """含稅金額的稅額（整數）"""
+        if amount.__class__ is int:
+            # 整數金額直接以整數除法取整（五成雙）
+            quotient, remainder = divmod(amount * self._tax_numerator, self._tax_denominator)
+            twice = remainder * 2
+            if twice > self._tax_denominator or (twice == self._tax_denominator and quotient & 1):
+                quotient += 1
+            return quotient
+        return round(fractions.Fraction(amount) * self._tax_fraction)
+    
+    def split(self, amounts):
+        """
+        批次計算整欄金額，回傳 (取整後的金額, 稅額) 兩個整數列表
+        - 金額為 None 的位置兩者皆為 None
+        """
+        tax = self.tax
+        rounded = []
+        taxes = []
+        for amount in amounts:
+            if amount is None:
+                rounded.append(None)
+                taxes.append(None)
+            else:
+                rounded.append(amount if amount.__class__ is int else round(amount))
+                taxes.append(tax(amount))
+        return rounded, taxes
+
+
+class StatisticsRow:
+    """
+    一筆統計資料（每個商品一列）
+    - 以 __slots__ 儲存，數量、未稅單價、未稅金額、稅額與總稅額為整數，付現／刷卡金額為整數（有小數時為 Decimal），
+      沒有值時為 None
+    - 文字欄位沒有值時為空字串；含稅總金額為補零到 8 位的文字
+    - 仍可依原本 17 欄清單的索引取值（row[1] 為產品代號）
+    """
+    
+    __slots__ = (
+        'sales_order',      # B 銷貨單號
+        'product_code',     # E 產品代號
+        'sales_date',       # G 銷貨日期
+        'payment_method',   # R 付款方式
+        'vendor_code',      # C 客供商代號
+        'voucher_type',     # Z 傳票類別
+        'quantity',         # F 數量
+        'tax_code',         # S 稅別
+        'cash_amount',      # T 付現金額
+        'card_amount',      # U 刷卡金額
+        'total_amount',     # V 含稅總金額
+        'untaxed_price',    # AA 未稅單價
+        'untaxed_amount',   # AB 未稅金額
+        'tax_amount',       # AC 稅額
+        'invoice_number',   # AK 發票號碼
+        'remarks',          # AW 備註
+        'total_tax',        # W 總稅額
+    )
+    
+    def __init__(self, sales_order, product_code, sales_date, payment_method, vendor_code, voucher_type,
+                 quantity, tax_code, cash_amount, card_amount, total_amount, untaxed_price, untaxed_amount,
+                 tax_amount, invoice_number, remarks, total_tax):
+        self.sales_order = sales_order
+        self.product_code = product_code
+        self.sales_date = sales_date
+        self.payment_method = payment_method
+        self.vendor_code = vendor_code
+        self.voucher_type = voucher_type
+        self.quantity = quantity
+        self.tax_code = tax_code
+        self.cash_amount = cash_amount
+        self.card_amount = card_amount
+        self.total_amount = total_amount
+        self.untaxed_price = untaxed_price
+        self.untaxed_amount = untaxed_amount
+        self.tax_amount = tax_amount
+        self.invoice_number = invoice_number
+        self.remarks = remarks
+        self.total_tax = total_tax
+    
+    def __reduce__(self):
+        # 傳回工作程序結果時只序列化欄位值
+        return StatisticsRow, tuple(self)
+    
+    def __getitem__(self, index):
+        return getattr(self, self.__slots__[index])
+    
+    def __len__(self):
+        return len(self.__slots__)
+    
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+    
+    def __eq__(self, other):
+        if not isinstance(other, StatisticsRow):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+    
+    def __repr__(self):
+        return f"StatisticsRow{tuple(self)!r}"
+
+
+# 統計資料輸出欄位：(Excel 欄位索引, StatisticsRow 欄位, 欄位名稱)
+STATISTICS_OUTPUT_COLUMNS = [
+    (1, 'sales_order', '銷貨單號'),         # B欄
+    (2, 'vendor_code', '客供商代號'),       # C欄
+    (4, 'product_code', '產品代號'),        # E欄
+    (5, 'quantity', '數量'),                # F欄
+    (6, 'sales_date', '銷貨日期'),          # G欄
+    (18, 'tax_code', '稅別'),               # S欄
+    (21, 'total_amount', '總含稅金額'),     # V欄
+    (22, 'total_tax', '總稅額'),            # W欄
+    (25, 'voucher_type', '傳票類別'),       # Z欄
+    (26, 'untaxed_price', '未稅單價'),      # AA欄
+    (27, 'untaxed_amount', '未稅金額'),     # AB欄
+    (28, 'tax_amount', '稅額'),             # AC欄
+    (36, 'invoice_number', '發票號碼'),     # AK欄
+    (48, 'remarks', '備註M250'),            # AW欄
+]
+# 依輸出欄位順序取出 StatisticsRow 的欄位值
+_statistics_output_values = operator.attrgetter(*(field for _, field, _ in STATISTICS_OUTPUT_COLUMNS))
+STATISTICS_SHEET_WIDTH = 49
+
+
+class StatisticsWriter:
+    """
+    統計資料的串流寫出器，依輸出檔案副檔名決定格式
+    - .xlsx：openpyxl 唯寫模式逐列寫出，版面與原本相同（第一列空白、B 到 AW 欄）
+      超過每個工作表的列數上限時換到續頁工作表（統計資料(2)、統計資料(3)…）
+    - .csv：以欄位名稱為標題的 UTF-8（含 BOM）檔案，指定列數上限時換到續檔（名稱_2.csv…）
+    - .parquet：以批次寫出的字串欄位（需要 pyarrow）
+    - 特殊客供商記錄等附加表格在 .xlsx 中為另一個工作表，其他格式另存為「名稱_工作表.副檔名」
+    - 先寫到同資料夾的暫存檔（.~檔名），全部完成後才取代輸出檔案，中途失敗不會留下不完整的檔案
+    """
+    
+    EXCEL_MAX_ROWS = 1048576
+    PARQUET_BATCH_ROWS = 65536
+    
+    def __init__(self, output_path, max_rows=None):
+        self.output_path = output_path
+        self.format = os.path.splitext(output_path)[1].lower().lstrip('.')
+        if self.format == 'xlsm':
+            raise ValueError("不支援輸出 .xlsm，請改用 .xlsx")
+        if self.format not in ('xlsx', 'csv', 'parquet'):
+            raise ValueError(f"不支援的輸出格式: {output_path}（支援 .xlsx、.csv、.parquet）")
+        if self.format == 'parquet':
+            # 開始處理前先確認，避免讀完所有檔案才發現無法寫出
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError("輸出檔名為 .parquet 時需要安裝 pyarrow（pip install pyarrow），或改用 .xlsx、.csv 輸出檔名")
+        
+        if self.format == 'xlsx':
+            # 第一列保留空白，每個工作表最多 EXCEL_MAX_ROWS - 1 筆資料
+            limit = self.EXCEL_MAX_ROWS - 1
+            self.max_rows = min(max_rows, limit) if max_rows else limit
+        else:
+            self.max_rows = max_rows or None
+        
+        self.row_count = 0
+        self.output_paths = []
+        self._temp_paths = []
+        self._part = 0
+        self._part_rows = 0
+        self._workbook = None
+        self._sheet = None
+        self._file = None
+        self._csv = None
+        self._parquet = None
+        self._batch = []
+        self._extra_tables = []
+        self._row_buffer = [None] * STATISTICS_SHEET_WIDTH
+        self._excel_indexes = [excel_index for excel_index, _, _ in STATISTICS_OUTPUT_COLUMNS]
+        self._open_part()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            try:
+                self.close()
+            except BaseException:
+                self.abort()
+                raise
+        else:
+            self.abort()
+    
+    def _temp_path(self, path):
+        """登記一個輸出檔案，回傳寫入用的暫存檔路徑"""
+        directory, name = os.path.split(path)
+        temp_path = os.path.join(directory, ".~" + name)
+        self.output_paths.append(path)
+        self._temp_paths.append(temp_path)
+        return temp_path
+    
+    def _part_path(self, suffix):
+        stem, ext = os.path.splitext(self.output_path)
+        return f"{stem}_{suffix}{ext}"
+    
+    def _open_part(self):
+        """開啟下一個工作表或續檔"""
+        self._part += 1
+        self._part_rows = 0
+        
+        if self.format == 'xlsx':
+            if self._workbook is None:
+                import openpyxl
+                self._workbook = openpyxl.Workbook(write_only=True)
+            title = '統計資料' if self._part == 1 else f'統計資料({self._part})'
+            self._sheet = self._workbook.create_sheet(title)
+            self._sheet.append([])
+        elif self.format == 'csv':
+            if self._file is not None:
+                self._file.close()
+            path = self.output_path if self._part == 1 else self._part_path(self._part)
+            self._file = open(self._temp_path(path), 'w', encoding='utf-8-sig', newline='')
+            self._csv = csv.writer(self._file)
+            self._csv.writerow([name for _, _, name in STATISTICS_OUTPUT_COLUMNS])
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([(name, pa.string()) for _, _, name in STATISTICS_OUTPUT_COLUMNS])
+            self._parquet = pq.ParquetWriter(self._temp_path(self.output_path), schema)
+    
+    def write_row(self, row):
+        """寫出一筆統計列（StatisticsRow）"""
+        if self.max_rows and self._part_rows >= self.max_rows:
+            self._open_part()
+        
+        if self.format == 'xlsx':
+            # 重複使用同一個整列緩衝區，數值以文字寫出（與原本的儲存格格式相同）
+            row_out = self._row_buffer
+            for excel_index, value in zip(self._excel_indexes, _statistics_output_values(row)):
+                if value is None or value == "":
+                    row_out[excel_index] = None
+                else:
+                    row_out[excel_index] = value if value.__class__ is str else str(value)
+            self._sheet.append(row_out)
+        elif self.format == 'csv':
+            self._csv.writerow(_statistics_output_values(row))
+        else:
+            self._batch.append(row)
+            if len(self._batch) >= self.PARQUET_BATCH_ROWS:
+                self._flush_parquet()
+        
+        self._part_rows += 1
+        self.row_count += 1
+    
+    @property
+    def part_count(self):
+        """統計資料分成的工作表（.xlsx）或檔案（.csv）數"""
+        return self._part
+    
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+    
+    def _flush_parquet(self):
+        import pyarrow as pa
+        columns = {
+            name: pa.array([None if value is None else str(value) for value in values], type=pa.string())
+            for (_, _, name), values in zip(
+                STATISTICS_OUTPUT_COLUMNS, zip(*map(_statistics_output_values, self._batch))
+            )
+        }
+        self._parquet.write_table(pa.table(columns))
+        self._batch = []
+    
+    def add_table(self, name, columns, rows):
+        """加入附加表格（如特殊客供商記錄），於關閉時寫出"""
+        self._extra_tables.append((name, list(columns), [list(row) for row in rows]))
+    
+    def close(self):
+        """寫出附加表格並關閉檔案，回傳所有輸出檔案路徑"""
+        if self.format == 'xlsx':
+            for name, columns, rows in self._extra_tables:
+                sheet = self._workbook.create_sheet(name)
+                sheet.append(columns)
+                for row in rows:
+                    sheet.append([None if value == "" else value for value in row])
+            self._workbook.save(self._temp_path(self.output_path))
+            self._workbook = None
+        else:
+            if self.format == 'csv':
+                self._file.close()
+                self._file = None
+            else:
+                if self._batch:
+                    self._flush_parquet()
+                self._parquet.close()
+                self._parquet = None
+            for name, columns, rows in self._extra_tables:
+                import pandas as pd
+                temp_path = self._temp_path(self._part_path(name))
+                df = pd.DataFrame(rows, columns=columns)
+                if self.format == 'csv':
+                    df.to_csv(temp_path, index=False, encoding='utf-8-sig')
+                else:
+                    df.astype(str).to_parquet(temp_path, index=False)
+        
+        for temp_path, path in zip(self._temp_paths, self.output_paths):
+            os.replace(temp_path, path)
+        self._temp_paths = []
+        return self.output_paths
+    
+    def abort(self):
+        """發生錯誤時關閉已開啟的檔案並移除暫存檔"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._parquet is not None:
+            self._parquet.close()
+            self._parquet = None
+        self._workbook = None
+        for temp_path in self._temp_paths:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        self._temp_paths = []
+
+
+class HistoryStore:
+    """
+    歷次統計資料的彙總資料庫（SQLite）
+    - 每次輸出的統計資料同時寫入，以期間（輸出檔名，如 0722-0728）為單位，重新處理同一期間時取代舊資料
+    - 銷貨日期、產品代號、客供商代號與傳票類別建有索引，query() 依條件查詢並回傳 DataFrame
+    - 數量與金額欄位以數值儲存，代號、日期與補零的總含稅金額維持文字
+    """
+    
+    # 以數值儲存的欄位，其餘欄位為文字
+    NUMERIC_COLUMNS = frozenset(['數量', '未稅單價', '未稅金額', '稅額', '總稅額'])
+    INDEXED_COLUMNS = ['銷貨日期', '產品代號', '客供商代號', '傳票類別']
+    INSERT_BATCH_ROWS = 5000
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = None
+        self.columns = [name for _, _, name in STATISTICS_OUTPUT_COLUMNS]
+    
+    def __getstate__(self):
+        # 資料庫連線不能跨程序傳遞，由各程序自行重新連線
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+    
+    def _connect(self):
+        """開啟（必要時建立）資料庫"""
+        if self._conn is None:
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            column_defs = ", ".join(
+                f'"{name}" {"NUMERIC" if name in self.NUMERIC_COLUMNS else "TEXT"}' for name in self.columns
+            )
+            conn.execute(f"CREATE TABLE IF NOT EXISTS sales (期間 TEXT, {column_defs})")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sales_period ON sales (期間)")
+            for index, name in enumerate(self.INDEXED_COLUMNS):
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_sales_{index} ON sales ("{name}")')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    @staticmethod
+    def period_of(output_path):
+        """以輸出檔名（不含副檔名）作為期間名稱"""
+        return os.path.splitext(os.path.basename(output_path))[0]
+    
+    def record(self, period, rows):
+        """
+        逐列產生 rows，同時將其記錄為該期間的資料（供寫出檔案時順便記錄）
+        - 先暫存於暫存資料表，全部取用完畢後才在一個短交易中取代該期間的舊資料
+        - rows 未取用完畢（處理中斷）時不變更資料庫
+        """
+        conn = self._connect()
+        placeholders = ", ".join("?" * (len(self.columns) + 1))
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS staging AS SELECT * FROM sales WHERE 0")
+        conn.execute("DELETE FROM temp.staging")
+        
+        batch = []
+        for row in rows:
+            batch.append([period] + [
+                None if value == "" else value
+                for value in _statistics_output_values(row)
+            ])
+            if len(batch) >= self.INSERT_BATCH_ROWS:
+                conn.executemany(f"INSERT INTO temp.staging VALUES ({placeholders})", batch)
+                batch = []
+            yield row
+        if batch:
+            conn.executemany(f"INSERT INTO temp.staging VALUES ({placeholders})", batch)
+        
+        self._replace_period(conn, period)
+    
+    def _replace_period(self, conn, period):
+        """以暫存資料表的內容取代該期間的資料"""
+        with conn:
+            conn.execute("DELETE FROM sales WHERE 期間 = ?", (period,))
+            conn.execute("INSERT INTO sales SELECT * FROM temp.staging")
+        conn.execute("DELETE FROM temp.staging")
+        conn.commit()
+    
+    def import_workbooks(self, paths):
+        """
+        匯入既有的統計資料檔案（.xlsx，版面與 write_to_excel 輸出相同），回傳 {期間: 筆數}
+        - 讀取「統計資料」及其續頁工作表，期間為檔名
+        - 無法讀取、沒有統計資料工作表或沒有資料列的檔案略過並記錄警告，不會清除該期間已有的資料
+        """
+        import pandas as pd
+        conn = self._connect()
+        placeholders = ", ".join("?" * (len(self.columns) + 1))
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS staging AS SELECT * FROM sales WHERE 0")
+        imported = {}
+        
+        for path in paths:
+            period = self.period_of(path)
+            try:
+                sheets = pd.read_excel(path, sheet_name=None, header=None, dtype=str)
+            except Exception as e:
+                logger.warning(f"無法讀取 {path}，略過匯入 {period}: {str(e)}")
+                continue
+            sheets = {name: df for name, df in sheets.items() if name.startswith('統計資料')}
+            if not sheets:
+                logger.warning(f"{path} 沒有統計資料工作表，略過匯入 {period}")
+                continue
+            conn.execute("DELETE FROM temp.staging")
+            count = 0
+            for sheet_name, df in sheets.items():
+                # 第一列為空白列，與輸出版面相同
+                df = df.iloc[1:].reindex(columns=range(STATISTICS_SHEET_WIDTH))
+                df = df.dropna(how='all')
+                values = df[[excel_index for excel_index, _, _ in STATISTICS_OUTPUT_COLUMNS]]
+                values = values.astype(object).where(values.notna(), None)
+                rows = [[period] + row for row in values.values.tolist()]
+                conn.executemany(f"INSERT INTO temp.staging VALUES ({placeholders})", rows)
+                count += len(rows)
+            if count == 0:
+                # 空的輸出檔案不取代已記錄的資料
+                conn.execute("DELETE FROM temp.staging")
+                logger.warning(f"{path} 的統計資料沒有資料列，略過匯入 {period}（保留彙總庫中的資料）")
+                continue
+            self._replace_period(conn, period)
+            imported[period] = count
+        
+        return imported
+    
+    @staticmethod
+    def _roc_date(value):
+        """日期轉為與銷貨日期相同的民國年格式（114/06/01）"""
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return f"{value.year - 1911:03d}/{value.month:02d}/{value.day:02d}"
+        return str(value)
+    
+    def query(self, start_date=None, end_date=None, product_code=None, vendor_code=None,
+              voucher_type=None, period=None):
+        """
+        依條件查詢統計資料，回傳 DataFrame（依寫入順序）
+        - 日期可用民國年字串（'114/06/01'）或 datetime.date，區間包含起訖日
+        - 代號條件可以是單一值或清單
+        """
+        conditions = []
+        params = []
+        if start_date is not None:
+            conditions.append("銷貨日期 >= ?")
+            params.append(self._roc_date(start_date))
+        if end_date is not None:
+            conditions.append("銷貨日期 <= ?")
+            params.append(self._roc_date(end_date))
+        for name, value in (('產品代號', product_code), ('客供商代號', vendor_code),
+                            ('傳票類別', voucher_type), ('期間', period)):
+            if value is None:
+                continue
+            values = [value] if isinstance(value, str) else list(value)
+            conditions.append(f'"{name}" IN ({", ".join("?" * len(values))})')
+            params.extend(values)
+        
+        statement = "SELECT * FROM sales"
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+        return self.sql(statement + " ORDER BY rowid", params)
+    
+    def sql(self, statement, params=()):
+        """執行自訂 SQL 查詢（資料表為 sales），回傳 DataFrame"""
+        import pandas as pd
+        return pd.read_sql_query(statement, self._connect(), params=params)
+    
+    def periods(self):
+        """列出已記錄的期間與筆數"""
+        return self.sql("SELECT 期間, COUNT(*) AS 筆數 FROM sales GROUP BY 期間 ORDER BY 期間")
+    
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class RollupAggregator:
+    """
+    統計資料的彙總：依銷貨日期、產品代號、客供商代號與傳票類別累計筆數、數量與未稅金額
+    - 資料列寫出時逐列累計（consume），不需另外讀取整份統計資料
+    - 各欄位值先編成整數代號，四個代號組成一個整數作為雜湊彙總的鍵
+    - 「彙總明細」保留四個欄位組合的結果，可從輸出檔案讀回（load）再合併（merge），
+      每週的結果可直接合併成每月，不需重新處理原始檔案
+    """
+    
+    DIMENSIONS = [
+        ('sales_date', '銷貨日期'),
+        ('product_code', '產品代號'),
+        ('vendor_code', '客供商代號'),
+        ('voucher_type', '傳票類別'),
+    ]
+    MEASURES = ['筆數', '數量', '未稅金額']
+    DETAIL_SHEET = '彙總明細'
+    # 組合鍵中每個欄位代號佔用的位元數
+    CODE_BITS = 32
+    
     def __init__(self):
-        """初始化銷售數據處理器"""
+        # 各欄位：值 → 代號，以及代號 → 值
+        self._codes = [{} for _ in self.DIMENSIONS]
+        self._values = [[] for _ in self.DIMENSIONS]
+        # 組合鍵 → 群組編號，各群組的累計值依編號存放
+        self._groups = {}
+        self._counts = []
+        self._quantities = []
+        self._amounts = []
+        self._dimension_getter = operator.attrgetter(*(field for field, _ in self.DIMENSIONS))
+    
+    def __len__(self):
+        return len(self._groups)
+    
+    def _group(self, key_values):
+        """取得欄位值組合的群組編號（新的組合時建立）"""
+        key = 0
+        for codes, values, value in zip(self._codes, self._values, key_values):
+            if value is None:
+                value = ""
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(values)
+                values.append(value)
+            key = (key << self.CODE_BITS) | code
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = len(self._counts)
+            self._counts.append(0)
+            self._quantities.append(0)
+            self._amounts.append(0)
+        return group
+    
+    def add(self, key_values, count=1, quantity=0, amount=0):
+        """累計一個欄位值組合（依 DIMENSIONS 順序）"""
+        group = self._group(key_values)
+        self._counts[group] += count
+        self._quantities[group] += quantity
+        self._amounts[group] += amount
+    
+    def consume(self, rows):
+        """逐列累計並原樣產生資料列（數量無法解析、金額空白時以 0 計）"""
+        group_of = self._group
+        dimension_getter = self._dimension_getter
+        counts, quantities, amounts = self._counts, self._quantities, self._amounts
+        for row in rows:
+            group = group_of(dimension_getter(row))
+            counts[group] += 1
+            quantity = row.quantity
+            if type(quantity) is int:
+                quantities[group] += quantity
+            amount = row.untaxed_amount
+            if amount is not None:
+                amounts[group] += amount
+            yield row
+    
+    def merge(self, other):
+        """併入另一份彙總結果"""
+        for key_values, count, quantity, amount in other.iter_groups():
+            self.add(key_values, count, quantity, amount)
+        return self
+    
+    def iter_groups(self):
+        """依建立順序產生 (欄位值組合, 筆數, 數量, 未稅金額)"""
+        mask = (1 << self.CODE_BITS) - 1
+        shifts = [self.CODE_BITS * position for position in reversed(range(len(self.DIMENSIONS)))]
+        for key, group in self._groups.items():
+            key_values = tuple(values[(key >> shift) & mask] for values, shift in zip(self._values, shifts))
+            yield key_values, self._counts[group], self._quantities[group], self._amounts[group]
+    
+    def detail_rows(self):
+        """彙總明細：依欄位值排序的 [銷貨日期, 產品代號, 客供商代號, 傳票類別, 筆數, 數量, 未稅金額]"""
+        return sorted(list(key_values) + [count, quantity, amount]
+                      for key_values, count, quantity, amount in self.iter_groups())
+    
+    def summary_rows(self, position):
+        """依單一欄位（DIMENSIONS 中的位置）彙總，依欄位值排序的 [欄位值, 筆數, 數量, 未稅金額]"""
+        totals = {}
+        for key_values, count, quantity, amount in self.iter_groups():
+            total = totals.get(key_values[position])
+            if total is None:
+                totals[key_values[position]] = [count, quantity, amount]
+            else:
+                total[0] += count
+                total[1] += quantity
+                total[2] += amount
+        return [[value] + total for value, total in sorted(totals.items())]
+    
+    def tables(self):
+        """輸出用的附加表格 [(名稱, 欄位名稱, 資料列)]：各欄位的彙總與彙總明細"""
+        tables = [
+            (f'依{name}彙總', [name] + self.MEASURES, self.summary_rows(position))
+            for position, (_, name) in enumerate(self.DIMENSIONS)
+        ]
+        tables.append((self.DETAIL_SHEET, [name for _, name in self.DIMENSIONS] + self.MEASURES, self.detail_rows()))
+        return tables
+    
+    @classmethod
+    def load(cls, path):
+        """
+        從輸出檔案讀回彙總明細
+        - .xlsx 讀取「彙總明細」工作表；.csv、.parquet 讀取旁邊的「檔名_彙總明細」檔案
+        """
+        stem, ext = os.path.splitext(path)
+        ext = ext.lower()
+        if ext == '.xlsx':
+            import openpyxl
+            workbook = openpyxl.load_workbook(path, read_only=True)
+            try:
+                if cls.DETAIL_SHEET not in workbook.sheetnames:
+                    raise ValueError(f"沒有「{cls.DETAIL_SHEET}」工作表: {path}")
+                table = [list(row) for row in workbook[cls.DETAIL_SHEET].iter_rows(values_only=True)]
+            finally:
+                workbook.close()
+        elif ext == '.csv':
+            with open(f"{stem}_{cls.DETAIL_SHEET}{ext}", 'r', encoding='utf-8-sig', newline='') as f:
+                table = list(csv.reader(f))
+        elif ext == '.parquet':
+            import pandas as pd
+            df = pd.read_parquet(f"{stem}_{cls.DETAIL_SHEET}{ext}")
+            table = [list(df.columns)] + df.values.tolist()
+        else:
+            raise ValueError(f"不支援的檔案格式: {path}")
+        
+        columns = [name for _, name in cls.DIMENSIONS] + cls.MEASURES
+        if not table or [str(name) for name in table[0]] != columns:
+            raise ValueError(f"「{cls.DETAIL_SHEET}」的欄位不符: {path}")
+        
+        rollup = cls()
+        width = len(cls.DIMENSIONS)
+        for row in table[1:]:
+            if all(value is None or value == "" for value in row):
+                continue
+            key_values = ["" if value is None else str(value) for value in row[:width]]
+            count, quantity, amount = (int(value) if value not in (None, "") else 0 for value in row[width:])
+            rollup.add(key_values, count, quantity, amount)
+        return rollup
+
+
+class PartialResult:
+    """
+    分片處理的部分結果檔案（pickle 串流）
+    - 依序為標頭、各檔的 (資料夾內序號, 檔名, 輸出資料列, 特殊客供商記錄)、結尾的檔案數
+    - 資料列以欄位值的 tuple 儲存，不依賴寫出時的模組名稱（直接執行時為 __main__）
+    - 標頭記錄分片編號、分片數與整個資料夾依相對路徑排序的檔案清單，序號為排序後的位置；
+      不依賴資料夾的列舉順序，複製到不同電腦的資料夾也能合併
+    - 逐檔讀寫，部分結果不整批留在記憶體
+    """
+    
+    FORMAT = 'sales-data-partial'
+    # 檔案內容變更時調整版本號，不合併不同版本的部分結果
+    VERSION = 2
+    
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            header = pickle.load(self._file)
+        except (EOFError, pickle.UnpicklingError):
+            header = None
+        if not isinstance(header, dict) or header.get('format') != self.FORMAT:
+            self.close()
+            raise ValueError(f"不是分片處理的部分結果: {path}")
+        if header.get('version') != self.VERSION:
+            self.close()
+            raise ValueError(f"部分結果版本不符（{header.get('version')}）: {path}")
+        self.header = header
+        self.shard = header['shard']
+        self.shards = header['shards']
+        self.files = header['files']
+    
+    @staticmethod
+    def shard_of(file_name, shards):
+        """
+        依檔名前 4 碼（銷貨單號序號，例：58790723001 → 5879）決定分片
+        - 使用 CRC32 而非 hash()，各機器、每次執行的分法都相同
+        """
+        key = os.path.splitext(file_name)[0][:4]
+        return zlib.crc32(key.encode('utf-8')) % shards
+    
+    @classmethod
+    def write(cls, path, shard, shards, files, records):
+        """
+        寫出部分結果，回傳寫入的檔案數
+        - files 為整個資料夾依相對路徑排序的檔案清單
+        - records 依序產生 (序號, 檔名, 輸出資料列, 特殊客供商記錄)
+        - 先寫入暫存檔再取代，中斷時不會留下不完整的部分結果
+        """
+        output_dir = os.path.dirname(path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        
+        count = 0
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                dump = functools.partial(pickle.dump, file=f, protocol=pickle.HIGHEST_PROTOCOL)
+                dump({
+                    'format': cls.FORMAT, 'version': cls.VERSION,
+                    'shard': shard, 'shards': shards, 'files': list(files),
+                })
+                # 每筆獨立序列化，讀取時可逐筆載入
+                for seq, file_name, file_rows, file_special_dates in records:
+                    dump((seq, file_name, [tuple(row) for row in file_rows], file_special_dates))
+                    count += 1
+                dump({'file_count': count})
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        return count
+    
+    def records(self):
+        """依序產生 (序號, 檔名, 輸出資料列, 特殊客供商記錄)"""
+        count = 0
+        while True:
+            try:
+                record = pickle.load(self._file)
+            except (EOFError, pickle.UnpicklingError):
+                raise ValueError(f"部分結果不完整: {self.path}") from None
+            if isinstance(record, dict):
+                if record.get('file_count') != count:
+                    raise ValueError(f"部分結果不完整: {self.path}")
+                return
+            count += 1
+            seq, file_name, file_rows, file_special_dates = record
+            yield seq, file_name, [StatisticsRow(*values) for values in file_rows], file_special_dates
+    
+    @staticmethod
+    def check(partials):
+        """確認各部分結果來自同一個資料夾與分片數，且每個分片剛好一份"""
+        if not partials:
+            raise ValueError("沒有要合併的部分結果")
+        first = partials[0]
+        for partial in partials[1:]:
+            if partial.shards != first.shards:
+                raise ValueError(f"分片數不一致: {first.path}（{first.shards}）與 {partial.path}（{partial.shards}）")
+            if partial.files != first.files:
+                differences = sorted(set(first.files) ^ set(partial.files))
+                raise ValueError(
+                    f"檔案清單不一致: {first.path}（{len(first.files)} 個）與 {partial.path}（{len(partial.files)} 個），"
+                    f"例如 {', '.join(differences[:3])}；各分片需處理內容相同的資料夾"
+                )
+        shards = collections.Counter(partial.shard for partial in partials)
+        duplicated = sorted(shard for shard, count in shards.items() if count > 1)
+        if duplicated:
+            raise ValueError(f"分片重複: {', '.join(map(str, duplicated))}")
+        missing = sorted(set(range(first.shards)) - set(shards))
+        if missing:
+            raise ValueError(f"缺少分片: {', '.join(map(str, missing))}（共 {first.shards} 個）")
+    
+    def close(self):
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Instrumentation:
+    """
+    處理過程的量測記錄
+    - 每個檔案的讀取與轉換時間、輸出列數、查不到產品代號與傳票類別的次數（逐檔明細記錄在除錯層級）
+    - 各階段的耗時，啟用 trace_memory 時另記錄 tracemalloc 記憶體高峰（巢狀階段各自計算）
+    - 指定 profile_dir 時以 cProfile 剖析每個檔案，只保留最慢的 profile_top 個檔案的剖析結果
+    - 只保留彙總數字與最慢的幾個檔案，記憶體用量不隨檔案數增加
+    """
+    
+    SLOWEST_FILES = 10
+    
+    def __init__(self, trace_memory=False, profile_dir=None, profile_top=5):
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.profile_top = profile_top
+        self.stages = {}
+        self.totals = {
+            'files': 0, 'rows': 0, 'empty_files': 0, 'errors': 0,
+            'read_seconds': 0.0, 'transform_seconds': 0.0,
+            'product_misses': 0, 'voucher_misses': 0,
+        }
+        self.last_record = None
+        self._slowest = []
+        self._profiles = []
+        self._sequence = 0
+        self._peak_stack = []
+        self._owns_tracing = False
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        """量測一個處理階段的耗時（與記憶體高峰）"""
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._owns_tracing = True
+            if self._peak_stack:
+                self._peak_stack[-1] = max(self._peak_stack[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._peak_stack.append(0)
+        
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            record = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            record['seconds'] += elapsed
+            record['calls'] += 1
+            
+            if self.trace_memory:
+                peak = max(self._peak_stack.pop(), tracemalloc.get_traced_memory()[1])
+                record['tracemalloc_peak_mb'] = max(record.get('tracemalloc_peak_mb', 0), round(peak / 2**20, 2))
+                if self._peak_stack:
+                    self._peak_stack[-1] = max(self._peak_stack[-1], peak)
+                elif self._owns_tracing:
+                    tracemalloc.stop()
+                    self._owns_tracing = False
+            
+            logger.debug("階段 %s: %.3f 秒", name, elapsed,
+                         extra={'metrics': {'stage': name, 'seconds': round(elapsed, 4)}})
+    
+    @contextlib.contextmanager
+    def profile_file(self, file_name):
+        """以 cProfile 剖析單一檔案的處理，只保留最慢的幾個"""
+        if not self.profile_dir:
+            yield
+            return
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            self._sequence += 1
+            entry = (elapsed, self._sequence, file_name, profiler)
+            if len(self._profiles) < self.profile_top:
+                heapq.heappush(self._profiles, entry)
+            elif self._profiles and elapsed > self._profiles[0][0]:
+                heapq.heapreplace(self._profiles, entry)
+    
+    def record_file(self, file_name, rows, read_seconds=0.0, transform_seconds=0.0, error=None):
+        """記錄單一檔案的量測結果，回傳該檔的記錄"""
+        prefix = "未查到此商品("
+        record = {
+            'file': file_name,
+            'rows': len(rows),
+            'read_seconds': round(read_seconds, 6),
+            'transform_seconds': round(transform_seconds, 6),
+            'product_misses': sum(1 for row in rows if row.product_code.startswith(prefix)),
+            'voucher_misses': sum(1 for row in rows if row.voucher_type == "未查到"),
+        }
+        if error is not None:
+            record['error'] = error
+        self.add_record(record)
+        logger.debug(
+            "[%s] 讀取 %.3f 秒、轉換 %.3f 秒、%d 筆、查無產品代號 %d 筆、查無傳票類別 %d 筆",
+            file_name, read_seconds, transform_seconds, record['rows'],
+            record['product_misses'], record['voucher_misses'],
+            extra={'metrics': record}
+        )
+        return record
+    
+    def add_record(self, record):
+        """累計一個檔案的記錄（也用於合併工作程序傳回的記錄）"""
+        totals = self.totals
+        totals['files'] += 1
+        totals['rows'] += record['rows']
+        totals['read_seconds'] += record['read_seconds']
+        totals['transform_seconds'] += record['transform_seconds']
+        totals['product_misses'] += record['product_misses']
+        totals['voucher_misses'] += record['voucher_misses']
+        if record['rows'] == 0:
+            totals['empty_files'] += 1
+        if 'error' in record:
+            totals['errors'] += 1
+        self.last_record = record
+        self._add_slowest(record)
+    
+    def _add_slowest(self, record):
+        self._sequence += 1
+        entry = (record['read_seconds'] + record['transform_seconds'], self._sequence, record)
+        if len(self._slowest) < self.SLOWEST_FILES:
+            heapq.heappush(self._slowest, entry)
+        elif entry[0] > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+    
+    def snapshot(self):
+        """可跨程序傳遞的量測資料（各階段、累計數字與最慢的檔案），由主程序以 merge 合併"""
+        return {
+            'stages': {name: dict(record) for name, record in self.stages.items()},
+            'totals': dict(self.totals),
+            'slowest': [record for _, _, record in self._slowest],
+        }
+    
+    def merge(self, snapshot):
+        """合併另一個程序的 snapshot（各階段時間與累計數字相加）"""
+        for name, record in snapshot['stages'].items():
+            target = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            target['seconds'] += record['seconds']
+            target['calls'] += record['calls']
+            if 'tracemalloc_peak_mb' in record:
+                target['tracemalloc_peak_mb'] = max(target.get('tracemalloc_peak_mb', 0), record['tracemalloc_peak_mb'])
+        for key, value in snapshot['totals'].items():
+            self.totals[key] += value
+        for record in snapshot['slowest']:
+            self._add_slowest(record)
+    
+    def summary(self):
+        """彙總結果（可直接寫成 JSON）"""
+        totals = dict(self.totals)
+        totals['read_seconds'] = round(totals['read_seconds'], 4)
+        totals['transform_seconds'] = round(totals['transform_seconds'], 4)
+        busy = totals['read_seconds'] + totals['transform_seconds']
+        return {
+            'totals': totals,
+            'files_per_sec': round(totals['files'] / busy, 2) if busy else None,
+            'rows_per_sec': round(totals['rows'] / busy, 2) if busy else None,
+            'stages': {
+                name: dict(record, seconds=round(record['seconds'], 4)) for name, record in self.stages.items()
+            },
+            'slowest_files': [record for _, _, record in sorted(self._slowest, reverse=True)],
+        }
+    
+    def log_summary(self):
+        totals = self.totals
+        logger.info(
+            f"處理 {totals['files']} 個檔案、{totals['rows']} 筆，"
+            f"讀取 {totals['read_seconds']:.2f} 秒、轉換 {totals['transform_seconds']:.2f} 秒；"
+            f"查無產品代號 {totals['product_misses']} 筆、查無傳票類別 {totals['voucher_misses']} 筆、"
+            f"錯誤 {totals['errors']} 個檔案",
+            extra={'metrics': self.summary()}
+        )
+        for name, record in self.stages.items():
+            memory = f"、記憶體高峰 {record['tracemalloc_peak_mb']} MB" if 'tracemalloc_peak_mb' in record else ""
+            logger.info(f"階段 {name}: {record['seconds']:.2f} 秒{memory}")
+    
+    def dump_profiles(self):
+        """將最慢檔案的剖析結果寫成 .prof（可用 pstats 或 snakeviz 開啟），回傳檔案路徑"""
+        if not self.profile_dir or not self._profiles:
+            return []
+        os.makedirs(self.profile_dir, exist_ok=True)
+        paths = []
+        for rank, (elapsed, _, file_name, profiler) in enumerate(sorted(self._profiles, reverse=True), 1):
+            path = os.path.join(self.profile_dir, f"{rank:02d}_{os.path.splitext(file_name)[0]}.prof")
+            profiler.dump_stats(path)
+            paths.append(path)
+            logger.info(f"剖析結果（{elapsed:.3f} 秒）: {path}")
+        return paths
+
+
+def _iter_bounded(submit, items, window):
+    """
+    依序提交工作並依提交順序產生 submit 的回傳值
+    - 尚未被取用的工作最多 window 個，前面的結果取走後才提交後面的工作
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(submit(item))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+class _IsolatedWorkerPool:
+    """
+    隔離執行用的工作程序：每個程序一次只處理一個檔案，可個別終止並補上新的程序
+    - 超過時間的檔案只終止處理它的程序，其他程序繼續處理，整體速度不受影響
+    - memory_limit 為每個工作程序的記憶體上限（位元組，限制位址空間，僅 Unix 支援）
+    """
+    
+    def __init__(self, size, initargs, timeout=None, memory_limit=None):
+        self.initargs = initargs
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.idle = []
+        # 連線 → (程序, 序號, 檔案, 期限)
+        self._busy = {}
+        for _ in range(size):
+            self._spawn()
+    
+    def _spawn(self):
+        import multiprocessing
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_isolated_worker_main, args=(child_conn, self.initargs, self.memory_limit), daemon=True
+        )
+        process.start()
+        child_conn.close()
+        self.idle.append((process, conn))
+    
+    def _replace(self, process, conn):
+        """終止工作程序並補上新的程序"""
+        process.kill()
+        process.join()
+        conn.close()
+        self._spawn()
+    
+    def submit(self, index, file, task):
+        """交給一個閒置的工作程序處理（呼叫前需確認有閒置程序）"""
+        process, conn = self.idle.pop()
+        conn.send(task)
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        self._busy[conn] = (process, index, file, deadline)
+    
+    def collect(self):
+        """
+        等到至少一個檔案處理完成或超過時間，回傳 [(序號, 檔案, 結果, 失敗原因)]
+        - 處理完成時結果為工作程序傳回的 (輸出資料, 量測記錄, 錯誤)，失敗原因為 None
+        - 超過時間或工作程序異常結束時結果為 None
+        """
+        from multiprocessing.connection import wait
+        
+        deadlines = [deadline for _, _, _, deadline in self._busy.values() if deadline is not None]
+        wait_seconds = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+        
+        finished = []
+        for conn in wait(list(self._busy), timeout=wait_seconds):
+            process, index, file, _ = self._busy.pop(conn)
+            try:
+                payload = conn.recv()
+            except (EOFError, OSError):
+                # 程序被系統終止（例如記憶體不足）或異常結束
+                process.join(1)
+                finished.append((index, file, None, f"工作程序異常結束（結束代碼 {process.exitcode}）"))
+                self._replace(process, conn)
+                continue
+            # 發生記憶體不足的程序狀態不可靠，換成新的程序
+            if payload[2] == 'MemoryError':
+                self._replace(process, conn)
+            else:
+                self.idle.append((process, conn))
+            finished.append((index, file, payload, None))
+        
+        now = time.monotonic()
+        for conn, (process, index, file, deadline) in list(self._busy.items()):
+            if deadline is not None and now >= deadline:
+                del self._busy[conn]
+                finished.append((index, file, None, f"處理超過 {self.timeout:g} 秒"))
+                self._replace(process, conn)
+        return finished
+    
+    def close(self):
+        for process, conn in self.idle + [(process, conn) for conn, (process, *_) in self._busy.items()]:
+            with contextlib.suppress(OSError):
+                conn.send(None)
+            conn.close()
+            process.join(1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.idle = []
+        self._busy = {}
+
+
+class SalesDataProcessor:
+    # 逐檔處理時預先讀取的檔案數
+    PREFETCH_FILES = 4
+    # 掃描標題列時同時讀取的檔案數
+    SCAN_THREADS = 8
+    
+    def __init__(self, workers=1, cache_dir=None, memory_cache_bytes=64 * 1024 * 1024,
+                 cache_max_bytes=512 * 1024 * 1024):
+        """
+        初始化銷售數據處理器
+        - cache_dir 為解析結果快取資料夾，未指定時不使用快取；cache_max_bytes 為其容量上限
+        - memory_cache_bytes 為程序內解析結果快取的容量上限，0 或 None 代表不使用
+        """
         self.folder_path = ""
         self.statistics_output_path = ""
         self.account_query_file_path = ""
@@ -33,10 +2205,59 @@ class SalesDataProcessor:
         
         self.product_mapping = {}
         self.account_mapping = {}
+        self.customer_mapping = {}
+        self.reference_data = None
+        self.product_index = None
+        
+        # 歷次統計資料的彙總資料庫，未指定時不記錄
+        self.history_store = None
+        
+        # 每個工作表（.xlsx）或檔案（.csv）的資料列數上限，未指定時使用 Excel 上限
+        self.max_rows_per_sheet = None
+        
+        # 查不到產品代號時列出的候選數（0 代表不輸出候選報表）
+        self.candidate_count = 0
+        
+        # 是否另外輸出依產品代號、客供商代號、傳票類別與銷貨日期的彙總工作表
+        self.rollups = False
+        
+        # 平行處理的程序數（1 代表逐檔處理）
+        self.workers = workers
+        
+        # 解析結果的磁碟快取
+        self.parse_cache = ParsedFileCache(cache_dir, cache_max_bytes) if cache_dir else None
+        
+        # 解析結果的記憶體快取（預覽與統計、同一工作階段重複處理時共用，在磁碟快取之前查詢）
+        self.table_cache = ParsedTableLRU(memory_cache_bytes) if memory_cache_bytes else None
+        
+        # 處理過程的量測記錄，未指定時不量測
+        self.instrumentation = None
+        
+        # 付款方式分類器（付款方式與關鍵字可由批次設定檔調整）
+        self.payment_classifier = PaymentClassifier()
+        
+        # 稅額計算（稅率可由批次設定檔或命令列調整）
+        self.tax_engine = TaxEngine()
+        
+        # 隔離執行：每個檔案的處理秒數與工作程序記憶體上限（位元組），皆未指定時不隔離
+        self.file_timeout = None
+        self.file_memory_limit = None
+        # 隔離的檔案移到此資料夾（未指定時只列入隔離清單）
+        self.quarantine_dir = None
+        # 隔離清單 [{'name', 'path', 'original_path', 'folder', 'reason', 'time'}]
+        self.quarantine = []
+        # 讀取失敗或格式無法辨識時拋出例外而不是當作空檔（隔離執行的工作程序使用，讓檔案列入隔離清單）
+        self.strict_read = False
+        
+    def _stage(self, name):
+        """量測處理階段（未啟用量測時不做任何事）"""
+        if self.instrumentation is None:
+            return contextlib.nullcontext()
+        return self.instrumentation.stage(name)
         
     def setup_paths(self):
         """設定檔案路徑"""
-        print("=== 銷售數據處理器設定 ===")
+        logger.info("=== 銷售數據處理器設定 ===")
         
         # 輸入各種檔案路徑
         self.folder_path = input("請輸入要掃描試算表的資料夾路徑：").strip().strip('"').strip("'")
@@ -49,234 +2270,1061 @@ class SalesDataProcessor:
         if not os.path.exists(self.folder_path):
             raise ValueError(f"資料夾路徑不存在: {self.folder_path}")
         
-        print("所有路徑設定完成")
+        logger.info("所有路徑設定完成")
+        
+    def iter_excel_files(self, folder_path=None):
+        """
+        逐一產生資料夾內的 Excel 檔案 {'name', 'path'}，順序與 get_excel_files 相同
+        - folder_path 為 .zip、.tar.gz 壓縮檔時列出壓縮檔內的 Excel 檔案，不需先解壓縮
+        - 依檔案在資料夾內的相對路徑排序，整批處理、分片合併與各機器的檔案順序都相同，不受檔案系統列舉順序影響
+        """
+        folder_path = self.folder_path if folder_path is None else folder_path
+        if InputArchive.is_archive(folder_path):
+            yield from self._iter_archive_files(folder_path)
+            return
+        
+        # 支援多種 Excel 格式
+        file_paths = []
+        for pattern in ['*.xlsx', '*.xls', '*.xlsm']:
+            file_paths.extend(glob.iglob(os.path.join(folder_path, pattern)))
+        for file_path in sorted(file_paths, key=lambda path: self.relative_path(path, folder_path)):
+            yield {
+                'name': os.path.basename(file_path),
+                'path': file_path
+            }
+    
+    @staticmethod
+    def relative_path(file_path, folder_path):
+        """檔案在資料夾（或壓縮檔）內的相對路徑，以 / 分隔"""
+        return os.path.relpath(file_path, folder_path).replace(os.sep, '/')
+        
+    def _iter_archive_files(self, archive_path):
+        """逐一產生壓縮檔內的 Excel 檔案（包含子資料夾內的檔案，依相對路徑排序；與 glob 相同，略過 . 開頭的檔案）"""
+        names = InputArchive.open(archive_path).names()
+        selected = [
+            name for name in names
+            if not posixpath.basename(name).startswith('.')
+            and any(fnmatch.fnmatch(posixpath.basename(name), pattern) for pattern in ['*.xlsx', '*.xls', '*.xlsm'])
+        ]
+        for name in sorted(selected):
+            yield {
+                'name': posixpath.basename(name),
+                'path': os.path.join(archive_path, *name.split('/'))
+            }
         
     def get_excel_files(self) -> List[Dict[str, str]]:
         """取得資料夾內的所有 Excel 檔案"""
         try:
-            # 支援多種 Excel 格式
-            excel_patterns = ['*.xlsx', '*.xls', '*.xlsm']
-            files = []
-            
-            for pattern in excel_patterns:
-                full_pattern = os.path.join(self.folder_path, pattern)
-                matched_files = glob.glob(full_pattern)
-                
-                for file_path in matched_files:
-                    file_name = os.path.basename(file_path)
-                    files.append({
-                        'name': file_name,
-                        'path': file_path
-                    })
+            files = list(self.iter_excel_files())
             
             if not files:
                 raise ValueError("指定的資料夾內沒有 Excel 試算表")
             
-            print(f"資料夾內 Excel 試算表數量: {len(files)}")
-            print("試算表列表：")
+            logger.info(f"資料夾內 Excel 試算表數量: {len(files)}")
             for file in files:
-                print(f"- {file['name']}")
+                logger.debug("試算表: %s", file['name'])
                 
             return files
             
         except Exception as e:
-            print(f"掃描資料夾時發生錯誤: {str(e)}")
+            logger.error(f"掃描資料夾時發生錯誤: {str(e)}")
             raise
 
     def normalize_product_name(self, name):
-        """
-        標準化商品名稱：
-        - 移除所有空白（半形、全形）
-        - 將中文括號替換為英文括號
-        - 去除不可見字元
-        - 轉為小寫（便於比對）
-        """
-        name = name.strip()
-        name = name.replace(" ", "").replace("\u3000", "")  # 半形空格、全形空格
-        name = name.replace("（", "(").replace("）", ")")    # 中文括號轉英文
-        name = re.sub(r"[\u200b\u200e\u202c]", "", name)    # 隱藏字元
-        return name.lower()
+        """標準化商品名稱（見模組層級的 normalize_product_name）"""
+        return normalize_product_name(name)
 
-    def load_product_code_mapping(self):
-        """載入產品代號對照表"""
+    def load_product_code_mapping(self, source=None):
+        """載入產品代號對照表（source 為已開啟的 SourceFile，未指定時開啟檔案）"""
         try:
-            # 先嘗試讀取 Sheet2
-            df = pd.DataFrame()
-            
-            # 檢查檔案是否為 HTML 格式
-            try:
-                with open(self.product_code_file_path, 'rb') as f:
-                    first_bytes = f.read(20)
-                    if b'<html' in first_bytes.lower() or b'<!doctype' in first_bytes.lower():
-                        # HTML 檔案，讀取所有表格並找到 Sheet2 相關的
-                        tables = pd.read_html(self.product_code_file_path, encoding='utf-8')
-                        if len(tables) >= 2:
-                            df = tables[1]  # 第二個表格可能對應 Sheet2
-                        elif len(tables) >= 1:
-                            df = tables[0]  # 只有一個表格就用第一個
-                    else:
-                        # 真正的 Excel 檔案，讀取 Sheet2
-                        file_ext = os.path.splitext(self.product_code_file_path)[1].lower()
-                        if file_ext == '.xls':
-                            df = pd.read_excel(self.product_code_file_path, sheet_name='Sheet2', engine='xlrd')
-                        else:
-                            df = pd.read_excel(self.product_code_file_path, sheet_name='Sheet2', engine='openpyxl')
-            except Exception as e:
-                print(f"讀取 Sheet2 失敗，嘗試讀取第一個工作表: {str(e)}")
-                df = self.read_excel_sheet(self.product_code_file_path)
+            source = source or SourceFile(self.product_code_file_path)
+            # 以唯讀模式只讀取 Sheet2 的 B、C 欄，格式不支援時改用 pandas 讀取整張表
+            projected = self._read_workbook_columns(
+                self.product_code_file_path, [1, 2], sheet_name='Sheet2', source=source
+            )
+            if projected is None:
+                projected = self._frame_columns(self._read_product_code_frame(source), [1, 2])
+            column_names, rows = projected
             
             mapping = {}
             
-            print(f"產品代號表欄位: {list(df.columns)}")
-            print(f"產品代號表資料筆數: {len(df)}")
+            logger.debug("產品代號表欄位: %s", column_names)
+            logger.debug("產品代號表資料筆數: %d", len(rows))
             
             # 根據您的截圖，B欄是代號，C欄是品名
-            if len(df.columns) >= 3:
-                for idx, row in df.iterrows():
-                    # B欄(索引1)是代號，C欄(索引2)是品名
-                    if pd.notna(row.iloc[1]) and pd.notna(row.iloc[2]):
-                        code = str(row.iloc[1]).strip()  # B欄代號
-                        name = str(row.iloc[2]).strip()  # C欄品名
-                        normalized_name = self.normalize_product_name(name)
-                        mapping[normalized_name] = code
-                        
-                        # 除錯：顯示前幾筆資料
-                        if idx < 5:
-                            print(f"  {name} -> {normalized_name} -> {code}")
+            entries = [
+                (idx, code_value.strip(), name_value.strip())
+                for idx, (code_value, name_value) in enumerate(rows)
+                if code_value is not None and name_value is not None
+            ]
+            normalized_names = normalize_product_names([name for _, _, name in entries])
+            for (idx, code, name), normalized_name in zip(entries, normalized_names):
+                mapping[normalized_name] = code
+                
+                # 除錯：顯示前幾筆資料
+                if idx < 5:
+                    logger.debug("  %s -> %s -> %s", name, normalized_name, code)
             
             self.product_mapping = mapping
-            print(f"載入產品代號對照表完成，共 {len(mapping)} 筆")
+            logger.info(f"載入產品代號對照表完成，共 {len(mapping)} 筆")
             
             # 特別檢查服務費
-            service_fee_key = self.normalize_product_name("[服務費]")
-            if service_fee_key in mapping:
-                print(f"找到服務費對應代號: {mapping[service_fee_key]}")
+            if _SERVICE_FEE_KEY in mapping:
+                logger.debug("找到服務費對應代號: %s", mapping[_SERVICE_FEE_KEY])
             else:
-                print(f"未找到服務費，標準化後的鍵值: '{service_fee_key}'")
-                print("對照表中的前10個鍵值:")
-                for i, key in enumerate(list(mapping.keys())[:10]):
-                    print(f"  '{key}'")
+                logger.warning(f"產品代號表中未找到服務費，標準化後的鍵值: '{_SERVICE_FEE_KEY}'")
+                logger.debug("對照表中的前10個鍵值: %s", list(mapping.keys())[:10])
             
             return mapping
             
         except Exception as e:
-            print(f"載入產品代號表失敗: {str(e)}")
+            logger.error(f"載入產品代號表失敗: {str(e)}")
             self.product_mapping = {}
             return {}
 
-    def load_account_mapping(self):
-        """載入掛帳傳票對照表"""
+    def _read_product_code_frame(self, source=None) -> "pd.DataFrame":
+        """以 pandas 讀取產品代號表（HTML、.xls 或沒有 Sheet2 時使用）"""
+        import pandas as pd
+        source = source or SourceFile(self.product_code_file_path)
+        # 先嘗試讀取 Sheet2
+        df = pd.DataFrame()
+        
+        # 依檔案內容判斷格式
         try:
-            df = pd.read_excel(self.account_query_file_path)
-            mapping = {}
-            
+            if source.kind == 'html':
+                # HTML 檔案，讀取所有表格並找到 Sheet2 相關的
+                tables = pd.read_html(source.stream(), encoding='utf-8')
+                if len(tables) >= 2:
+                    df = tables[1]  # 第二個表格可能對應 Sheet2
+                elif len(tables) >= 1:
+                    df = tables[0]  # 只有一個表格就用第一個
+            else:
+                # 真正的 Excel 檔案，讀取 Sheet2
+                df = pd.read_excel(source.stream(), sheet_name='Sheet2', engine=self._excel_engine(source))
+        except Exception as e:
+            logger.warning(f"讀取 Sheet2 失敗，嘗試讀取第一個工作表: {str(e)}")
+            df = self.read_excel_sheet(self.product_code_file_path, source)
+        
+        return df
+
+    def load_account_mapping(self, source=None):
+        """載入掛帳傳票對照表（source 為已開啟的 SourceFile，未指定時開啟檔案）"""
+        try:
+            source = source or SourceFile(self.account_query_file_path)
             # 假設 B 欄是帳號，J 欄是傳票類別
-            if len(df.columns) >= 10:
-                for _, row in df.iterrows():
-                    if pd.notna(row.iloc[1]) and pd.notna(row.iloc[9]):  # B, J 欄
-                        account_id = str(row.iloc[1]).strip().zfill(6)  # 補滿六位
-                        voucher_type = str(row.iloc[9]).strip()
-                        mapping[account_id] = voucher_type
+            projected = self._read_workbook_columns(self.account_query_file_path, [1, 9], source=source)
+            if projected is None:
+                import pandas as pd
+                projected = self._frame_columns(
+                    pd.read_excel(source.stream(), engine=self._excel_engine(source)), [1, 9]
+                )
+            _, rows = projected
+            
+            mapping = {}
+            for account_value, voucher_value in rows:
+                if account_value is not None and voucher_value is not None:  # B, J 欄
+                    account_id = account_value.strip().zfill(6)  # 補滿六位
+                    voucher_type = voucher_value.strip()
+                    mapping[account_id] = voucher_type
             
             self.account_mapping = mapping
-            print(f"載入掛帳傳票對照表完成，共 {len(mapping)} 筆")
+            logger.info(f"載入掛帳傳票對照表完成，共 {len(mapping)} 筆")
             return mapping
             
         except Exception as e:
-            print(f"載入挂帳傳票對照表失敗: {str(e)}")
+            logger.error(f"載入挂帳傳票對照表失敗: {str(e)}")
             self.account_mapping = {}
             return {}
 
-    def read_excel_sheet(self, file_path: str) -> pd.DataFrame:
-        """讀取 Excel 檔案的第一個工作表"""
+    def load_customer_mapping(self, source=None):
+        """
+        載入客戶供應商代號對照表（優先讀取 Sheet2）
+        - A 欄代號、C 欄簡稱、D 欄全稱、F 欄傳票類別（空白時改用 H 欄）
+        - source 為已開啟的 SourceFile，未指定時開啟檔案
+        """
         try:
-            # 首先檢查檔案是否為 HTML 格式
-            with open(file_path, 'rb') as f:
-                first_bytes = f.read(20)
-                if b'<html' in first_bytes.lower() or b'<!doctype' in first_bytes.lower():
-                    # 這是 HTML 檔案，使用 pandas 的 HTML 讀取功能
-                    try:
-                        tables = pd.read_html(file_path, encoding='utf-8')
-                        if tables:
-                            return tables[0]  # 返回第一個表格
-                        else:
-                            print(f"HTML 檔案中沒有找到表格: {file_path}")
-                            return pd.DataFrame()
-                    except Exception as html_error:
-                        print(f"讀取 HTML 格式失敗 {file_path}: {str(html_error)}")
-                        return pd.DataFrame()
-            
-            # 根據副檔名選擇適當的引擎讀取真正的 Excel 檔案
-            file_ext = os.path.splitext(file_path)[1].lower()
+            source = source or SourceFile(self.customer_code_file_path)
+            columns = [0, 2, 3, 5, 7]
+            projected = (
+                self._read_workbook_columns(self.customer_code_file_path, columns, sheet_name='Sheet2', source=source)
+                or self._read_workbook_columns(self.customer_code_file_path, columns, source=source)
+            )
+            if projected is None:
+                import pandas as pd
+                excel_file = pd.ExcelFile(source.stream(), engine=self._excel_engine(source))
+                sheet_name = 'Sheet2' if 'Sheet2' in excel_file.sheet_names else 0
+                projected = self._frame_columns(excel_file.parse(sheet_name), columns)
+            _, rows = projected
             
-            if file_ext == '.xls':
-                # 舊版 Excel 格式使用 xlrd 引擎
-                df = pd.read_excel(file_path, sheet_name=0, engine='xlrd')
-            elif file_ext in ['.xlsx', '.xlsm']:
-                # 新版 Excel 格式使用 openpyxl 引擎
-                df = pd.read_excel(file_path, sheet_name=0, engine='openpyxl')
-            else:
-                # 預設嘗試自動偵測
-                df = pd.read_excel(file_path, sheet_name=0)
+            mapping = {}
+            for code_value, short_name, full_name, voucher_type, alt_voucher_type in rows:
+                if code_value is None:
+                    continue
+                mapping[code_value.strip()] = {
+                    'short_name': (short_name or "").strip(),
+                    'full_name': (full_name or "").strip(),
+                    'voucher_type': (voucher_type or alt_voucher_type or "").strip()
+                }
             
-            return df
+            self.customer_mapping = mapping
+            logger.info(f"載入客戶供應商對照表完成，共 {len(mapping)} 筆")
+            return mapping
             
         except Exception as e:
-            print(f"讀取檔案失敗 {file_path}: {str(e)}")
-            return pd.DataFrame()
+            logger.error(f"載入客戶供應商對照表失敗: {str(e)}")
+            self.customer_mapping = {}
+            return {}
 
-    def extract_filtered_column_from_sheets(self, files, target_column_name="品　種", time_column_name="時間"):
-        """從試算表中提取並篩選指定欄位的資料"""
-        skip_keywords = {
-            self.normalize_product_name(k) for k in [
-                "現金", "MASTER", "VISA", "挂帳", "Visa", "AE", "Master", "挂帳",
-                "jcb", "匯款", "訂金", "銀聯"
-            ]
-        }
+    def load_reference_data(self, snapshot_dir=None):
+        """
+        載入產品、掛帳與客戶供應商對照表
+        - 指定 snapshot_dir（未指定時使用解析快取資料夾）時，將編譯後的對照表存成快照
+        - 快照以來源檔案的內容雜湊為鍵，來源未變更時直接載入快照
+        """
+        if snapshot_dir is None and self.parse_cache is not None:
+            snapshot_dir = self.parse_cache.cache_dir
         
-        for file in files:
-            file_path = file['path']
-            file_name = file['name']
-            
+        sources = [self.product_code_file_path, self.account_query_file_path, self.customer_code_file_path]
+        with contextlib.ExitStack() as stack:
+            # 每個對照表只讀取一次，快照雜湊與載入共用同一份內容
+            files = [stack.enter_context(SourceFile(path)) if path else None for path in sources]
+            return self._load_reference_data(sources, files, snapshot_dir)
+    
+    def _load_reference_data(self, sources, files, snapshot_dir):
+        """load_reference_data 的實作"""
+        snapshot_path = None
+        
+        if snapshot_dir:
+            source_key = ReferenceData.source_key(sources, files)
+            snapshot_path = os.path.join(snapshot_dir, f"reference_{source_key}.pickle")
+            if os.path.exists(snapshot_path):
+                try:
+                    reference = ReferenceData.load(snapshot_path)
+                except Exception as e:
+                    logger.warning(f"讀取對照表快照失敗，重新載入對照表: {str(e)}")
+                else:
+                    missing_index = self.candidate_count > 0 and not reference.has_product_index
+                    self._apply_reference_data(reference)
+                    logger.info(f"已載入對照表快照: 產品 {len(reference.product_mapping)} 筆、"
+                          f"掛帳 {len(reference.account_mapping)} 筆、客戶供應商 {len(reference.customer_mapping)} 筆")
+                    if missing_index:
+                        # 快照沒有候選索引，已於套用時建立，更新快照讓下次直接取用
+                        try:
+                            reference.save(snapshot_path)
+                        except OSError as e:
+                            logger.warning(f"儲存對照表快照失敗: {str(e)}")
+                    return reference
+        
+        product_file, account_file, customer_file = files
+        self.load_product_code_mapping(product_file)
+        self.load_account_mapping(account_file)
+        if self.customer_code_file_path:
+            self.load_customer_mapping(customer_file)
+        
+        reference = ReferenceData(self.product_mapping, self.account_mapping, self.customer_mapping,
+                                  build_index=self.candidate_count > 0)
+        self._apply_reference_data(reference)
+        
+        # 有對照表載入失敗時不保存快照，避免下次沿用空的對照表
+        loaded = [
+            mapping for path, mapping in zip(
+                sources, [self.product_mapping, self.account_mapping, self.customer_mapping]
+            ) if path
+        ]
+        if snapshot_path and all(loaded):
             try:
-                df = self.read_excel_sheet(file_path)
-                
-                if df.empty:
-                    print(f"[{file_name}] 沒有資料")
-                    continue
-                
-                if target_column_name not in df.columns or time_column_name not in df.columns:
-                    print(f"[{file_name}] 缺少 '{target_column_name}' 或 '{time_column_name}' 欄位")
-                    continue
-                
-                print(f"\n[{file_name}] 的篩選後「{target_column_name}」欄位資料如下：")
-                
-                for _, row in df.iterrows():
-                    if pd.notna(row[target_column_name]) and pd.notna(row[time_column_name]):
-                        variety = str(row[target_column_name]).strip()
-                        time_val = str(row[time_column_name]).strip()
-                        
-                        if self.normalize_product_name(variety) in skip_keywords:
+                reference.save(snapshot_path)
+            except OSError as e:
+                logger.warning(f"儲存對照表快照失敗: {str(e)}")
+        
+        return reference
+
+    def clear_cache(self):
+        """清空解析結果快取與對照表快照，回傳刪除的快照數"""
+        if self.parse_cache is None:
+            return 0
+        self.parse_cache.invalidate()
+        removed = 0
+        for path in glob.glob(os.path.join(self.parse_cache.cache_dir, "reference_*.pickle")):
+            os.remove(path)
+            removed += 1
+        return removed
+
+    def missing_reference_tables(self):
+        """有指定路徑但載入失敗（檔案不存在、無法讀取或沒有任何資料）的對照表，回傳 [(名稱, 路徑)]"""
+        tables = [
+            ("產品代號表", self.product_code_file_path, self.product_mapping),
+            ("掛帳傳票對照表", self.account_query_file_path, self.account_mapping),
+            ("客戶供應商對照表", self.customer_code_file_path, self.customer_mapping),
+        ]
+        return [(name, path) for name, path, mapping in tables if path and not mapping]
+
+    def _apply_reference_data(self, reference):
+        """套用對照表快照"""
+        self.reference_data = reference
+        self.product_mapping = reference.product_mapping
+        self.account_mapping = reference.account_mapping
+        self.customer_mapping = reference.customer_mapping
+        # 只有輸出候選報表時才需要（建立）候選索引
+        self.product_index = reference.product_index if self.candidate_count > 0 else None
+
+    def _read_workbook_columns(self, file_path, column_indexes, sheet_name=None, source=None):
+        """
+        以 openpyxl 唯讀模式只讀取指定欄位（欄位索引從 0 起算，第一列為標題）
+        - 回傳 (標題列, 資料列)，儲存格轉為與 pandas 讀取後 str(value) 相同的字串，空值為 None
+        - 內容不是 .xlsx/.xlsm、找不到工作表或 pandas 會整欄轉型的情況回傳 None，由呼叫端改用 pandas
+        """
+        try:
+            import openpyxl
+        except ImportError:
+            return None
+        
+        try:
+            source = source or SourceFile(file_path)
+            if source.kind != 'ooxml':
+                return None
+            workbook = openpyxl.load_workbook(source.stream(), read_only=True, data_only=True)
+        except Exception:
+            return None
+        
+        try:
+            if sheet_name is None:
+                worksheet = workbook.worksheets[0]
+            elif sheet_name in workbook.sheetnames:
+                worksheet = workbook[sheet_name]
+            else:
+                return None
+            
+            header = list(next(worksheet.iter_rows(max_row=1, values_only=True), None) or [])
+            # 與 pandas 相同，去掉標題列尾端的空白儲存格
+            while header and (header[-1] is None or header[-1] == ""):
+                header.pop()
+            if not header:
+                return None
+            column_names = [
+                f"Unnamed: {i}" if value is None or value == "" else _excel_cell_value(value)
+                for i, value in enumerate(header)
+            ]
+            
+            first_col = min(column_indexes)
+            values = [[] for _ in column_indexes]
+            for row in worksheet.iter_rows(
+                min_row=2, min_col=first_col + 1, max_col=max(column_indexes) + 1, values_only=True
+            ):
+                for target, index in zip(values, column_indexes):
+                    target.append(_excel_cell_value(row[index - first_col]))
+        finally:
+            workbook.close()
+        
+        columns = [_pandas_like_excel_column(column) for column in values]
+        if any(column is None for column in columns):
+            return None
+        
+        rows = [list(row) for row in zip(*columns)]
+        # 去掉尾端的空白列
+        while rows and all(value is None for value in rows[-1]):
+            rows.pop()
+        return column_names, rows
+
+    def _frame_columns(self, df, column_indexes):
+        """從 DataFrame 取出指定位置的欄位，格式與 _read_workbook_columns 相同"""
+        import pandas as pd
+        width = len(df.columns)
+        columns = []
+        for index in column_indexes:
+            if index < width:
+                columns.append([None if pd.isna(value) else str(value) for value in df.iloc[:, index].tolist()])
+            else:
+                columns.append([None] * len(df))
+        return list(df.columns), [list(row) for row in zip(*columns)]
+
+    @staticmethod
+    def _excel_engine(source):
+        """依檔案內容選擇 pandas 的 Excel 讀取引擎，無法判斷時由 pandas 自動偵測"""
+        return {'biff': 'xlrd', 'ooxml': 'openpyxl'}.get(source.kind)
+
+    def read_excel_sheet(self, file_path: str, source=None, raise_errors=False) -> "pd.DataFrame":
+        """
+        讀取 Excel 檔案的第一個工作表（source 為已開啟的 SourceFile，未指定時開啟檔案）
+        - 讀取失敗或格式無法辨識時記錄警告並回傳空的 DataFrame；raise_errors 時改為拋出例外
+        """
+        import pandas as pd
+        try:
+            source = source or SourceFile(file_path)
+            # 首先檢查檔案是否為 HTML 格式
+            if source.kind == 'html':
+                # 這是 HTML 檔案，使用 pandas 的 HTML 讀取功能
+                try:
+                    tables = pd.read_html(source.stream(), encoding='utf-8')
+                    if tables:
+                        return tables[0]  # 返回第一個表格
+                    elif raise_errors:
+                        raise ValueError("HTML 檔案中沒有找到表格")
+                    else:
+                        logger.warning(f"HTML 檔案中沒有找到表格: {file_path}")
+                        return pd.DataFrame()
+                except Exception as html_error:
+                    if raise_errors:
+                        raise
+                    logger.warning(f"讀取 HTML 格式失敗 {file_path}: {str(html_error)}")
+                    return pd.DataFrame()
+            
+            # 依內容選擇引擎讀取真正的 Excel 檔案：舊版格式使用 xlrd，新版格式使用 openpyxl
+            return pd.read_excel(source.stream(), sheet_name=0, engine=self._excel_engine(source))
+            
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.warning(f"讀取檔案失敗 {file_path}: {str(e)}")
+            return pd.DataFrame()
+
+    def read_pos_html_table(self, file_path: str, columns=None, source=None) -> Optional[PosTable]:
+        """
+        以 lxml 串流解析 POS 匯出的 HTML 格式 .xls 檔
+        - 只讀取第一個表格中指定的欄位，回傳 PosTable
+        - 字串內容與 read_excel_sheet 讀取後 str(value).strip() 相同
+        - 遇到無法辨識的格式時回傳 None，由呼叫端改用 read_excel_sheet
+        """
+        etree = _lxml_etree()
+        if etree is None:
+            return None
+        
+        columns = POS_EXPORT_COLUMNS if columns is None else columns
+        
+        try:
+            source = source or SourceFile(file_path)
+            data = source.data
+            if not _is_pos_export_head(data[:1024]):
+                return None
+            
+            chunks = (data[offset:offset + 65536] for offset in range(0, len(data), 65536))
+            names, rows = self._parse_pos_html_rows(chunks, columns)
+            
+            return PosTable(
+                {
+                    name: _pandas_like_column([row[position] for row in rows])
+                    for position, name in enumerate(names)
+                },
+                len(rows)
+            )
+        except (_UnrecognizedPosExport, ValueError, OSError, etree.LxmlError):
+            return None
+
+    def _parse_pos_html_rows(self, chunks, columns, header_only=False):
+        """
+        將檔案內容逐段餵給 lxml，讀完第一個表格即停止，回傳 (找到的欄位名稱, 只含這些欄位的資料列)
+        - header_only 時讀完標題列即停止，回傳 (標題列的所有欄位名稱, [])
+        """
+        parser = _lxml_etree().HTMLPullParser(events=("start", "end"), encoding="utf-8")
+        
+        def iter_events():
+            for chunk in chunks:
+                parser.feed(chunk)
+                yield from parser.read_events()
+            parser.close()
+            yield from parser.read_events()
+        
+        table = None
+        names = None
+        positions = []
+        header_width = 0
+        rows = []
+        
+        for event, element in iter_events():
+            tag = element.tag
+            
+            if event == "start":
+                if tag == "table":
+                    if table is not None:
+                        raise _UnrecognizedPosExport("表格內含巢狀表格")
+                    table = element
+                elif tag in ("thead", "tbody", "tfoot") and table is not None:
+                    raise _UnrecognizedPosExport(f"不支援的表格結構: {tag}")
+                continue
+            
+            if table is None:
+                continue
+            if tag == "table":
+                break
+            if tag != "tr":
+                continue
+            
+            if element.getparent() is not table:
+                raise _UnrecognizedPosExport("資料列不在表格第一層")
+            
+            texts = []
+            all_th = True
+            for cell in element:
+                if cell.tag not in ("td", "th"):
+                    continue
+                if cell.tag != "th":
+                    all_th = False
+                if int(cell.get("rowspan") or 1) > 1:
+                    raise _UnrecognizedPosExport("不支援跨列儲存格")
+                texts.extend([_html_cell_text(cell)] * int(cell.get("colspan") or 1))
+            
+            # 釋放已處理的資料列，讓記憶體用量不隨檔案大小增加
+            element.clear()
+            while element.getprevious() is not None:
+                del table[0]
+            
+            if names is None:
+                if not all_th or not texts:
+                    raise _UnrecognizedPosExport("找不到標題列")
+                if header_only:
+                    return texts, []
+                header_width = len(texts)
+                names = [name for name in columns if name in texts]
+                positions = [texts.index(name) for name in names]
+                continue
+            
+            if all_th and not rows:
+                raise _UnrecognizedPosExport("不支援多列標題")
+            if len(texts) > header_width:
+                raise _UnrecognizedPosExport("資料列欄位數超過標題列")
+            
+            texts.extend([""] * (header_width - len(texts)))
+            rows.append([texts[position] for position in positions])
+        
+        if names is None:
+            raise _UnrecognizedPosExport("找不到標題列")
+        
+        return names, rows
+
+    def read_pos_columns(self, file_path: str, columns=None) -> Optional[PosTable]:
+        """
+        讀取 POS 匯出檔的指定欄位，回傳 PosTable
+        - 優先使用串流解析器，無法辨識時改用 read_excel_sheet 再轉為欄位資料
+        - 有設定 table_cache 時先查記憶體快取，未命中時再查 parse_cache（磁碟快取），未變更的檔案直接取用
+        - 檔案沒有資料時回傳 None
+        """
+        columns = POS_EXPORT_COLUMNS if columns is None else columns
+        table_cache = self.table_cache
+        
+        # 檔案內容只讀取一次，快取雜湊、格式判斷與解析共用
+        with SourceFile(file_path) as source:
+            parse_columns = columns
+            if table_cache is not None:
+                try:
+                    table = table_cache.get(file_path, source.stat(), columns)
+                except OSError:
+                    table_cache = None
+                else:
+                    if table is not None:
+                        return table
+                    # 一併解析其他標準欄位，之後以不同欄位讀取同一檔案（如預覽後統計）也能命中
+                    parse_columns = list(columns) + [name for name in POS_EXPORT_COLUMNS if name not in columns]
+            
+            if self.parse_cache is None:
+                table = self._parse_pos_columns(file_path, parse_columns, source)
+            else:
+                table, digest = self.parse_cache.lookup(file_path, parse_columns, source)
+                if table is None:
+                    table = self._parse_pos_columns(file_path, parse_columns, source)
+                    # 讀取失敗與空檔不寫入快取，下次重新讀取
+                    if table is not None:
+                        self.parse_cache.store(digest, parse_columns, table)
+            
+            if table is None or table_cache is None:
+                return table
+            # 記錄讀取內容時的檔案狀態
+            table_cache.put(file_path, source.stat(), table)
+            return table.select(columns)
+
+    def _parse_pos_columns(self, file_path, columns, source=None):
+        """解析 POS 匯出檔的指定欄位（不經過快取）；strict_read 時讀取失敗會拋出例外"""
+        source = source or SourceFile(file_path)
+        table = self.read_pos_html_table(file_path, columns, source)
+        if table is None:
+            import pandas as pd
+            df = self.read_excel_sheet(file_path, source, raise_errors=self.strict_read)
+            if df.empty:
+                return None
+            table = PosTable(
+                {
+                    name: [None if pd.isna(value) else str(value).strip() for value in df[name].tolist()]
+                    for name in columns if name in df.columns
+                },
+                len(df)
+            )
+        
+        if table.row_count == 0:
+            return None
+        return table
+
+    def read_pos_header(self, file_path):
+        """
+        只讀取試算表的標題列，回傳 (格式, 欄位名稱列表)
+        - 格式為 pos（POS 匯出的 HTML）、html、biff（舊版 .xls）、ooxml（.xlsx/.xlsm），無法辨識時為 None
+        - POS 匯出檔逐段讀取，解析到標題列即停止，不讀取整個檔案；.xlsx 以唯讀模式只讀第一列
+        - 其他格式交給 pandas 讀取；格式無法辨識或沒有標題列時欄位名稱為 None
+        """
+        source = SourceFile(file_path)
+        with source.open() as f:
+            head = f.read(1024)
+            kind = SourceFile.sniff(head)
+            
+            if kind == 'html' and _is_pos_export_head(head) and _lxml_etree() is not None:
+                def chunks():
+                    yield head
+                    yield from iter(lambda: f.read(65536), b'')
+                try:
+                    names, _ = self._parse_pos_html_rows(chunks(), None, header_only=True)
+                    return 'pos', names
+                except (_UnrecognizedPosExport, ValueError, _lxml_etree().LxmlError):
+                    pass  # 不符合 POS 格式時與一般 HTML 相同，交給 pandas 讀取
+        
+        if kind is None:
+            return None, None
+        
+        if kind == 'ooxml':
+            import openpyxl
+            workbook = openpyxl.load_workbook(
+                file_path if source.member is None else source.stream(), read_only=True, data_only=True
+            )
+            try:
+                header = next(workbook.worksheets[0].iter_rows(max_row=1, values_only=True), None)
+            finally:
+                workbook.close()
+            if not header:
+                return kind, None
+            return kind, [str(value).strip() for value in header if value is not None]
+        
+        df = self.read_excel_sheet(file_path)
+        if df.empty and not len(df.columns):
+            return kind, None
+        return kind, [str(name).strip() for name in df.columns]
+
+    def scan_files(self, files, target_column_name="品　種", time_column_name="時間"):
+        """
+        只讀取標題列，檢查每個試算表能否處理，回傳 [{'name', 'path', 'format', 'date', 'problems'}]
+        - 檢查檔案格式、必要欄位與檔名中的日期（4 碼序號 + 月日）
+        - 以多個執行緒同時讀取，適合在完整處理前先檢查大量檔案
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        
+        def scan(file):
+            problems = []
+            spreadsheet_date = ""
+            m = re.search(r'^.{4}(\d{4})', file['name'])
+            if m is None:
+                problems.append("檔名沒有日期（4 碼序號 + 月日）")
+            else:
+                month, day = int(m.group(1)[:2]), int(m.group(1)[2:])
+                try:
+                    datetime.date(2000, month, day)  # 閏年，接受 2 月 29 日
+                    spreadsheet_date = f"114/{m.group(1)[:2]}/{m.group(1)[2:]}"
+                except ValueError:
+                    problems.append(f"檔名日期不正確: {m.group(1)}")
+            
+            kind = None
+            try:
+                kind, header = self.read_pos_header(file['path'])
+                if kind is None:
+                    problems.append("無法辨識的檔案格式")
+                elif header is None:
+                    problems.append("找不到標題列")
+                else:
+                    missing = [name for name in (target_column_name, time_column_name) if name not in header]
+                    if missing:
+                        problems.append(f"缺少欄位: {', '.join(missing)}")
+            except Exception as e:
+                problems.append(f"讀取失敗: {str(e)}")
+            
+            return {
+                'name': file['name'],
+                'path': file['path'],
+                'format': kind or "",
+                'date': spreadsheet_date,
+                'problems': problems,
+            }
+        
+        with self._stage('scan'), ThreadPoolExecutor(max_workers=self.SCAN_THREADS) as executor:
+            results = list(executor.map(scan, files))
+        
+        bad = [result for result in results if result['problems']]
+        for result in bad:
+            logger.warning(f"[{result['name']}] {'；'.join(result['problems'])}")
+        formats = collections.Counter(result['format'] or "無法辨識" for result in results)
+        logger.info(
+            f"掃描 {len(results)} 個檔案，{len(bad)} 個有問題；格式: "
+            + "、".join(f"{kind} {count}" for kind, count in sorted(formats.items()))
+        )
+        return results
+
+    def scan_folder(self, folder_path):
+        """掃描單一資料夾內所有試算表的標題列（不需載入對照表），回傳 scan_files 的結果"""
+        if not os.path.isdir(folder_path) and not InputArchive.is_archive(folder_path):
+            raise ValueError(f"資料夾路徑不存在: {folder_path}")
+        return self.scan_files(list(self.iter_excel_files(folder_path)))
+
+    @staticmethod
+    def write_scan_report(results, report_path):
+        """將掃描結果寫成 CSV（UTF-8 含 BOM，可直接以 Excel 開啟）"""
+        with open(report_path, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['檔名', '路徑', '格式', '銷貨日期', '問題'])
+            for result in results:
+                writer.writerow([result['name'], result['path'], result['format'], result['date'],
+                                 '；'.join(result['problems'])])
+
+    def extract_filtered_column_from_sheets(self, files, target_column_name="品　種", time_column_name="時間"):
+        """
+        從試算表中提取並篩選指定欄位的資料
+        - 回傳 {檔名: 篩選後的品種列表}，逐筆內容只在除錯層級記錄
+        """
+        filtered = {}
+        for file in files:
+            file_path = file['path']
+            file_name = file['name']
+            
+            try:
+                table = self.read_pos_columns(file_path, [target_column_name, time_column_name])
+                
+                if table is None:
+                    logger.info(f"[{file_name}] 沒有資料")
+                    continue
+                
+                if target_column_name not in table or time_column_name not in table:
+                    logger.warning(f"[{file_name}] 缺少 '{target_column_name}' 或 '{time_column_name}' 欄位")
+                    continue
+                
+                varieties = filtered[file_name] = []
+                normalized = normalize_product_names(table[target_column_name])
+                for variety, key, time_val in zip(table[target_column_name], normalized, table[time_column_name]):
+                    if variety is not None and time_val is not None:
+                        if self.payment_classifier.is_skipped(key):
                             continue
                         if time_val == "" or time_val == "nan":
                             continue
                         
-                        print(f"- {variety}")
+                        varieties.append(variety)
+                        logger.debug("[%s] %s", file_name, variety)
+                
+                logger.info(f"[{file_name}] 篩選後「{target_column_name}」共 {len(varieties)} 筆")
                         
             except Exception as e:
-                print(f"讀取 [{file_name}] 時發生錯誤: {str(e)}")
-
-    def collect_statistics_data(self, files, target_column_name="品　種", time_column_name="時間"):
-        """收集統計資料"""
-        skip_keywords = {
-            self.normalize_product_name(k) for k in [
-                "現金", "MASTER", "VISA", "挂帳", "Visa", "AE", "Master", "挂帳",
-                "jcb", "匯款", "訂金", "銀聯"
-            ]
+                logger.warning(f"讀取 [{file_name}] 時發生錯誤: {str(e)}")
+        
+        return filtered
+
+    def collect_statistics_data(self, files, target_column_name="品　種", time_column_name="時間", workers=None):
+        """
+        收集統計資料
+        - workers 為平行處理的程序數，未指定時使用 self.workers
+        - 1 代表逐檔處理，0 或負數代表使用全部 CPU 核心
+        - 不論是否平行處理，輸出順序皆與檔案列表順序相同
+        """
+        special_vendor_dates = []
+        with self._stage('collect'):
+            output_rows = list(self.iter_statistics_rows(
+                files, special_vendor_dates, None, target_column_name, time_column_name, workers
+            ))
+        return output_rows, special_vendor_dates
+
+    def iter_statistics_rows(self, files, special_vendor_dates, unmatched=None,
+                             target_column_name="品　種", time_column_name="時間", workers=None):
+        """
+        逐列產生統計資料，檔案可以是邊找邊產生的迭代器
+        - 特殊客供商記錄附加到 special_vendor_dates
+        - 指定 unmatched 時同時累計查不到產品代號的品名
+        """
+        return self._iter_result_rows(
+            self.iter_file_statistics(files, target_column_name, time_column_name, workers),
+            special_vendor_dates, unmatched
+        )
+
+    def _iter_result_rows(self, file_results, special_vendor_dates, unmatched=None):
+        """將各檔的 (輸出資料列, 特殊客供商記錄) 依序展開為資料列"""
+        file_count = 0
+        for file_rows, file_special_dates in file_results:
+            file_count += 1
+            special_vendor_dates.extend(file_special_dates)
+            if unmatched is not None:
+                self._tally_unmatched_products(file_rows, unmatched)
+            yield from file_rows
+        logger.info(f"已處理試算表數量: {file_count}")
+
+    def iter_file_statistics(self, files, target_column_name="品　種", time_column_name="時間", workers=None):
+        """
+        依檔案順序逐一產生各檔的 (輸出資料列, 特殊客供商記錄)
+        - 平行處理時同時進行中的檔案數有上限，不會一次把所有檔案送進程序池
+        - 逐檔處理時由讀取執行緒預先讀取後面幾個檔案，與轉換重疊進行
+        """
+        workers = self.workers if workers is None else workers
+        if workers is not None and workers <= 0:
+            workers = os.cpu_count() or 1
+        
+        if hasattr(files, '__len__'):
+            if len(files) <= 1:
+                workers = 1
+            elif workers:
+                workers = min(workers, len(files))
+        
+        if self.file_timeout or self.file_memory_limit:
+            yield from self._collect_statistics_isolated(
+                files, target_column_name, time_column_name, max(workers or 1, 1)
+            )
+            return
+        
+        if workers and workers > 1:
+            yield from self._collect_statistics_parallel(files, target_column_name, time_column_name, workers)
+            return
+        
+        # 剖析時在同一個執行緒讀取，剖析結果才包含解析的部分
+        if self.instrumentation is not None and self.instrumentation.profile_dir:
+            for file in files:
+                yield self.collect_file_statistics(file, target_column_name, time_column_name)
+            return
+        
+        columns = [target_column_name, time_column_name] + POS_EXPORT_COLUMNS[2:]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            submit = lambda file: (file, reader.submit(self._read_pos_columns_timed, file['path'], columns))
+            for file, table_future in _iter_bounded(submit, files, self.PREFETCH_FILES):
+                yield self.collect_file_statistics(
+                    file, target_column_name, time_column_name, table_future=table_future
+                )
+
+    def _read_pos_columns_timed(self, file_path, columns):
+        """讀取欄位資料並回傳 (欄位資料, 讀取秒數)"""
+        start = time.perf_counter()
+        table = self.read_pos_columns(file_path, columns)
+        return table, time.perf_counter() - start
+
+    def _collect_statistics_parallel(self, files, target_column_name, time_column_name, workers):
+        """以多個程序平行處理檔案，依檔案列表順序回傳各檔結果"""
+        from concurrent.futures import ProcessPoolExecutor
+        # 對照表只在工作程序啟動時傳送一次
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_collect_worker,
+            initargs=(self.product_mapping, self.account_mapping, self.parse_cache, 0, None,
+                      self.instrumentation is not None, self.payment_classifier, self.tax_engine)
+        ) as executor:
+            submit = lambda file: executor.submit(
+                _collect_file_worker, (file, target_column_name, time_column_name)
+            )
+            # 依提交順序取回結果，每個程序最多同時排入四個檔案
+            for future in _iter_bounded(submit, files, workers * 4):
+                result, record = future.result()
+                if record is not None and self.instrumentation is not None:
+                    self.instrumentation.add_record(record)
+                yield result
+
+    def _collect_statistics_isolated(self, files, target_column_name, time_column_name, workers):
+        """
+        隔離執行：每個檔案在工作程序中處理，限制處理時間與記憶體，依檔案列表順序回傳各檔結果
+        - 超過時間、超出記憶體、工作程序異常結束、讀取失敗或格式無法辨識的檔案列入隔離清單，不輸出該檔的資料
+        - 只終止出問題的工作程序並補上新的程序，其他檔案繼續處理
+        """
+        pool = _IsolatedWorkerPool(
+            workers,
+            (self.product_mapping, self.account_mapping, self.parse_cache, 0, None,
+             self.instrumentation is not None, self.payment_classifier, self.tax_engine),
+            timeout=self.file_timeout,
+            memory_limit=self.file_memory_limit,
+        )
+        files = iter(files)
+        results = {}
+        submitted = 0
+        next_index = 0
+        exhausted = False
+        try:
+            while True:
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+                
+                # 有閒置程序就送出下一個檔案；尚未依序取走的結果最多每個程序四個
+                while not exhausted and pool.idle and submitted - next_index < workers * 4:
+                    file = next(files, None)
+                    if file is None:
+                        exhausted = True
+                        break
+                    pool.submit(submitted, file, (file, target_column_name, time_column_name))
+                    submitted += 1
+                if exhausted and next_index == submitted:
+                    break
+                
+                for index, file, payload, reason in pool.collect():
+                    result = ([], [])
+                    if payload is not None:
+                        file_result, record, error = payload
+                        if record is not None and self.instrumentation is not None:
+                            self.instrumentation.add_record(record)
+                        if error is None:
+                            result = file_result
+                        elif error == 'MemoryError':
+                            reason = f"超出記憶體上限（{self.file_memory_limit // (1024 * 1024)} MB）"
+                        else:
+                            reason = f"處理錯誤: {error}"
+                    elif self.instrumentation is not None:
+                        self.instrumentation.record_file(file['name'], [], error=reason)
+                    if reason is not None:
+                        self.quarantine_file(file, reason)
+                    results[index] = result
+        finally:
+            pool.close()
+
+    def quarantine_file(self, file, reason):
+        """將檔案列入隔離清單；有設定隔離資料夾時一併移過去（壓縮檔內的檔案只列入清單），回傳隔離記錄"""
+        entry = {
+            'name': file['name'],
+            'path': os.path.abspath(file['path']),
+            'original_path': os.path.abspath(file['path']),
+            'folder': os.path.abspath(self.folder_path) if self.folder_path else "",
+            'reason': reason,
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
         }
+        if self.quarantine_dir and InputArchive.split(file['path']) is None:
+            import shutil
+            os.makedirs(self.quarantine_dir, exist_ok=True)
+            target = os.path.join(self.quarantine_dir, file['name'])
+            stem, ext = os.path.splitext(file['name'])
+            suffix = 1
+            while os.path.exists(target):
+                target = os.path.join(self.quarantine_dir, f"{stem}_{suffix}{ext}")
+                suffix += 1
+            try:
+                shutil.move(file['path'], target)
+                entry['path'] = os.path.abspath(target)
+            except OSError as e:
+                logger.warning(f"[{file['name']}] 無法移到隔離資料夾: {str(e)}")
+        logger.warning(f"[{file['name']}] 已隔離: {reason}")
+        self.quarantine.append(entry)
+        return entry
+
+    @staticmethod
+    def write_failure_manifest(entries, manifest_path):
+        """將隔離清單寫成 JSON（供 --retry 只重新處理這些檔案）"""
+        manifest_dir = os.path.dirname(manifest_path)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'count': len(entries),
+                'files': list(entries),
+            }, f, ensure_ascii=False, indent=2)
+
+    @staticmethod
+    def load_failure_manifest(manifest_path):
+        """讀取隔離清單，回傳隔離記錄列表"""
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if not isinstance(manifest, dict) or not isinstance(manifest.get('files'), list):
+            raise ValueError(f"不是隔離清單: {manifest_path}")
+        return manifest['files']
+
+    def retry_quarantined(self, entries, output_path):
+        """
+        只重新處理隔離清單中的檔案並寫入統計資料檔案（對照表需先載入），回傳是否寫入成功
+        - 檔案已移到隔離資料夾時從隔離資料夾讀取；仍失敗的檔案再次列入隔離清單
+        """
+        self.statistics_output_path = output_path
+        files = []
+        for entry in entries:
+            try:
+                SourceFile(entry['path']).stat()
+            except (OSError, ValueError):
+                logger.warning(f"[{entry['name']}] 找不到檔案: {entry['path']}")
+                continue
+            files.append({'name': entry['name'], 'path': entry['path']})
+        if not files:
+            raise ValueError("隔離清單中沒有可重新處理的檔案")
+        
+        # 重新處理時不再移動檔案，隔離記錄仍指向目前位置
+        quarantine_dir, self.quarantine_dir = self.quarantine_dir, None
+        try:
+            logger.info(f"重新處理 {len(files)} 個隔離的檔案...")
+            return self._write_file_results(self.iter_file_statistics(files), output_path)
+        finally:
+            self.quarantine_dir = quarantine_dir
+
+    def collect_file_statistics(self, file, target_column_name="品　種", time_column_name="時間",
+                                table_future=None):
+        """
+        收集單一檔案的統計資料，回傳 (輸出資料列, 特殊客供商記錄)
+        - table_future 為讀取執行緒預先讀取的結果 (欄位資料, 讀取秒數)，未指定時在此讀取
+        - 啟用量測時記錄讀取與轉換時間、列數與對照表查無次數
+        """
+        if self.instrumentation is None:
+            return self._collect_file_statistics(file, target_column_name, time_column_name, table_future)
         
+        timings = {}
+        with self.instrumentation.profile_file(file['name']):
+            result = self._collect_file_statistics(
+                file, target_column_name, time_column_name, table_future, timings
+            )
+        self.instrumentation.record_file(file['name'], result[0], **timings)
+        return result
+
+    def _collect_file_statistics(self, file, target_column_name, time_column_name, table_future=None,
+                                 timings=None):
+        """collect_file_statistics 的實作，timings 不是 None 時填入讀取與轉換時間"""
         output_rows = []
         special_vendor_dates = []
+        
+        file_path = file['path']
+        file_name = file['name']
+        
+        try:
+            # 從檔名提取日期 (例：23210225002 -> 0225)
+            m = re.search(r'^.{4}(\d{4})', file_name)
+            if m:
+                month_day = m.group(1)
+                month = month_day[:2]
+                day = month_day[2:]
+                spreadsheet_date = f"114/{month}/{day}"
+            else:
+                spreadsheet_date = ""
+        except:
+            spreadsheet_date = ""
+        
+        try:
+            if table_future is not None:
+                table, read_seconds = table_future.result()
+            else:
+                table, read_seconds = self._read_pos_columns_timed(
+                    file_path,
+                    [target_column_name, time_column_name] + POS_EXPORT_COLUMNS[2:]
+                )
+            if timings is not None:
+                timings['read_seconds'] = read_seconds
+            
+            if table is None:
+                return output_rows, special_vendor_dates
+            
+            if target_column_name not in table or time_column_name not in table:
+                logger.warning(f"[{file_name}] 缺少 '{target_column_name}' 或 '{time_column_name}' 欄位")
+                return output_rows, special_vendor_dates
+            
+            start = time.perf_counter()
+            try:
+                self._transform_pos_table(
+                    file_name, spreadsheet_date, table, target_column_name, time_column_name,
+                    output_rows, special_vendor_dates
+                )
+            finally:
+                if timings is not None:
+                    timings['transform_seconds'] = time.perf_counter() - start
+            
+        except Exception as e:
+            logger.warning(f"[{file_name}] 錯誤: {str(e) or type(e).__name__}")
+            if timings is not None:
+                # MemoryError 等沒有訊息的例外以例外名稱記錄
+                timings['error'] = str(e) or type(e).__name__
+        
+        return output_rows, special_vendor_dates
+
+    def _transform_pos_table(self, file_name, spreadsheet_date, table, target_column_name, time_column_name,
+                             output_rows, special_vendor_dates):
+        """
+        將單一檔案的欄位資料轉為輸出資料列
+        - 先對整欄計算付款方式、掛帳代號、總金額、發票與篩選遮罩，每欄只掃描一次
+        - 再逐筆組出商品資料列，依序加入 output_rows
+        """
         special_vendor_codes = {'52', '53', '54', '55'}
         
         def process_vendor_code(code):
@@ -292,431 +3340,998 @@ class SalesDataProcessor:
                 return "2"
             return "6"
         
-        for file in files:
-            file_path = file['path']
-            file_name = file['name']
-            first_entry_written = False
-            
-            try:
-                # 從檔名提取日期 (例：23210225002 -> 0225)
-                m = re.search(r'^.{4}(\d{4})', file_name)
-                if m:
-                    month_day = m.group(1)
-                    month = month_day[:2]
-                    day = month_day[2:]
-                    spreadsheet_date = f"114/{month}/{day}"
-                else:
-                    spreadsheet_date = ""
-            except:
-                spreadsheet_date = ""
-            
-            try:
-                df = self.read_excel_sheet(file_path)
-                
-                if df.empty:
+        products = table[target_column_name]
+        times = table[time_column_name]
+        unit_prices = table.get('單價')
+        categories = table.get('類別')
+        quantities = table.get('數量')
+        amounts = table.get('金額')
+        invoices = table.get('發票')
+        reasons = table.get('贈送原因')
+        
+        # 統計付款方式種類（不分大小寫），同時標記付款與結帳列
+        normalized_products = normalize_product_names(products)
+        all_methods_detected, skip_mask = self.payment_classifier.classify(products, normalized_products)
+        
+        # 設定付款方式邏輯
+        if len(all_methods_detected) == 1:
+            payment_method = next(iter(all_methods_detected))
+        else:
+            payment_method = "多種"
+        
+        # 掛帳處理（抓取客戶代號）
+        default_vendor_code = "000999"
+        vendor_code_lookup = None
+        
+        if "挂帳" in all_methods_detected and categories is not None:
+            for product, category in zip(products, categories):
+                if product == "挂帳" and category is not None:
+                    default_vendor_code = process_vendor_code(category)
+                    vendor_code_lookup = default_vendor_code
+                    if category in special_vendor_codes:
+                        special_vendor_dates.append({
+                            'date': spreadsheet_date,
+                            'vendor_code': category,
+                            'spreadsheet_name': file_name
+                        })
+                    break
+        
+        # 取得總金額
+        total_amount_value = ""
+        if amounts is not None:
+            for product, amount in zip(products, amounts):
+                if product == "結帳 小計":
+                    if amount is not None:
+                        total_amount_value = amount
+                    break
+        
+        # 發票號碼與發票金額（整欄掃描一次）
+        all_invoice_numbers = []
+        invoice_amounts = []
+        if invoices is not None:
+            for invoice_str in invoices:
+                if invoice_str is None:
                     continue
-                
-                if target_column_name not in df.columns or time_column_name not in df.columns:
+                m_amt = _INVOICE_AMOUNT_RE.search(invoice_str)
+                if m_amt:
+                    invoice_amounts.append(int(m_amt.group(1)))
+                if "發票金額:0" in invoice_str:
                     continue
-                
-                # 取得各欄位的索引
-                required_columns = {
-                    'product': target_column_name,
-                    'time': time_column_name,
-                    'unit_price': '單價',
-                    'category': '類別',
-                    'quantity': '數量',
-                    'amount': '金額',
-                    'invoice': '發票',
-                    'reason': '贈送原因'
-                }
-                
-                # 檢查欄位是否存在
-                available_columns = {}
-                for key, col_name in required_columns.items():
-                    available_columns[key] = col_name if col_name in df.columns else None
-                
-                # 分析付款方式
-                all_product_raws = []
-                for _, row in df.iterrows():
-                    if pd.notna(row.get(target_column_name, "")):
-                        all_product_raws.append(str(row[target_column_name]).strip())
-                
-                # 統計付款方式種類（不分大小寫）
-                all_methods_detected = set()
-                for p in all_product_raws:
-                    pl = p.lower()
-                    if "現金" in pl:
-                        all_methods_detected.add("現金")
-                    elif "挂帳" in pl or "挂帳" in pl:
-                        all_methods_detected.add("挂帳")
-                    elif any(k in pl for k in ["visa", "master", "ae", "jcb", "銀聯"]):
-                        all_methods_detected.add("信用卡")
-                    elif "匯款" in pl or "訂金" in pl:
-                        all_methods_detected.add("匯款")
-                
-                # 設定付款方式邏輯
-                if len(all_methods_detected) == 1:
-                    payment_method = list(all_methods_detected)[0]
-                else:
-                    payment_method = "多種"
-                
-                # 掛帳處理（抓取客戶代號）
-                default_vendor_code = "000999"
-                vendor_code_lookup = None
-                
-                if "挂帳" in all_methods_detected and available_columns['category']:
-                    for _, row in df.iterrows():
-                        if pd.notna(row.get(target_column_name, "")) and pd.notna(row.get(available_columns['category'], "")):
-                            if str(row[target_column_name]).strip() in ["挂帳", "挂帳"]:
-                                vendor_code_raw = str(row[available_columns['category']]).strip()
-                                default_vendor_code = process_vendor_code(vendor_code_raw)
-                                vendor_code_lookup = default_vendor_code
-                                if vendor_code_raw in special_vendor_codes:
-                                    special_vendor_dates.append({
-                                        'date': spreadsheet_date,
-                                        'vendor_code': vendor_code_raw,
-                                        'spreadsheet_name': file_name
-                                    })
-                                break
-                
-                # 取得總金額
-                total_amount_value = ""
-                if available_columns['amount']:
-                    for _, row in df.iterrows():
-                        if pd.notna(row.get(target_column_name, "")) and str(row[target_column_name]).strip() == "結帳 小計":
-                            if pd.notna(row.get(available_columns['amount'], "")):
-                                total_amount_value = str(row[available_columns['amount']]).strip()
-                            break
-                
-                # 處理每一筆商品資料
-                first_entry = True
-                for _, row in df.iterrows():
-                    if not pd.notna(row.get(target_column_name, "")) or not pd.notna(row.get(time_column_name, "")):
-                        continue
-                    
-                    product_raw = str(row[target_column_name]).strip()
-                    time_raw = str(row[time_column_name]).strip()
-                    
-                    if self.normalize_product_name(product_raw) in skip_keywords or time_raw == "" or time_raw == "nan":
-                        continue
-                    
-                    # 檢查單價和贈送原因
-                    current_vendor_code = default_vendor_code
-                    is_pr_item = False
-                    
-                    # 檢查是否為公關品
-                    if available_columns['reason'] and pd.notna(row.get(available_columns['reason'], "")):
-                        is_pr_item = str(row[available_columns['reason']]).strip() == "公關品"
-                    
-                    is_service_fee = self.normalize_product_name(product_raw) == self.normalize_product_name("[服務費]")
-                    
-                    # 檢查單價
-                    unit_price = 0.0
-                    if available_columns['unit_price'] and pd.notna(row.get(available_columns['unit_price'], "")):
-                        try:
-                            unit_price_str = str(row[available_columns['unit_price']]).replace(",", "").strip()
-                            if unit_price_str == "" or unit_price_str == "nan":
+                m = _INVOICE_NUMBER_RE.search(invoice_str)
+                if m:
+                    all_invoice_numbers.append(m.group(1))
+        
+        # 篩選遮罩：排除付款方式列與沒有時間的列
+        item_rows = [
+            i for i, (key, skipped, time_raw) in enumerate(zip(normalized_products, skip_mask, times))
+            if key is not None and time_raw is not None
+            and not skipped and time_raw != "" and time_raw != "nan"
+        ]
+        if not item_rows:
+            return
+        
+        # 只寫在第一筆的欄位：總金額、發票號碼、備註、總稅額
+        tax_engine = self.tax_engine
+        total_amount_numeric = tax_engine.parse_amount(total_amount_value)
+        total_amount = "" if total_amount_numeric is None else str(round(total_amount_numeric)).zfill(8)
+        
+        if payment_method == "多種":
+            invoice_number_for_output = ""
+            remarks_m250 = "_".join(all_invoice_numbers) if all_invoice_numbers else ""
+        else:
+            invoice_number_for_output = all_invoice_numbers[0] if all_invoice_numbers else ""
+            remarks_m250 = ""
+        
+        total_tax = tax_engine.tax(sum(invoice_amounts)) if invoices is not None else None
+        
+        # 處理銷貨單號 - 去除副檔名
+        sales_order_number = os.path.splitext(file_name)[0]
+        
+        # 設定傳票類別
+        if payment_method == "多種":
+            payment_voucher_type = "S994"
+        elif payment_method == "挂帳" and vendor_code_lookup:
+            payment_voucher_type = self.account_mapping.get(vendor_code_lookup, "未查到")
+        else:
+            payment_voucher_type = self.payment_classifier.voucher_type(payment_method)
+        
+        # 付現或刷卡金額欄依付款方式設定（多種付款兩欄都不填）
+        amount_column = None if payment_method == "多種" else self.payment_classifier.amount_column(payment_method)
+        
+        # 商品列的金額整欄解析一次，批次計算取整金額（未稅金額欄）與稅額
+        if amounts is not None:
+            item_amounts = tax_engine.parse_amounts([amounts[i] for i in item_rows])
+        else:
+            item_amounts = [None] * len(item_rows)
+        rounded_amounts, tax_amounts = tax_engine.split(item_amounts)
+        
+        # 處理每一筆商品資料
+        entry_index = 0
+        for position, i in enumerate(item_rows):
+            product_raw = products[i]
+            product_key = normalized_products[i]
+            
+            # 檢查單價和贈送原因
+            current_vendor_code = default_vendor_code
+            
+            # 檢查是否為公關品
+            is_pr_item = reasons is not None and reasons[i] == "公關品"
+            is_service_fee = product_key == _SERVICE_FEE_KEY
+            
+            # 檢查單價
+            unit_price = 0.0
+            if unit_prices is not None and unit_prices[i] is not None:
+                try:
+                    unit_price_str = unit_prices[i].replace(",", "").strip()
+                    if unit_price_str == "" or unit_price_str == "nan":
+                        if is_service_fee:
+                            unit_price = 0.0
+                        else:
+                            continue
+                    else:
+                        unit_price = float(unit_price_str)
+                        
+                        if unit_price == 0:
+                            if not is_pr_item:
                                 if is_service_fee:
                                     unit_price = 0.0
                                 else:
                                     continue
                             else:
-                                unit_price = float(unit_price_str)
-                                
-                                if unit_price == 0:
-                                    if not is_pr_item:
-                                        if is_service_fee:
-                                            unit_price = 0.0
-                                        else:
-                                            continue
-                                    else:
-                                        current_vendor_code = "000995"
-                                else:
-                                    if is_pr_item:
-                                        current_vendor_code = "000995"
-                                    elif payment_method == "挂帳":
-                                        current_vendor_code = default_vendor_code
-                                    else:
-                                        current_vendor_code = "000999"
-                        except ValueError:
-                            if is_service_fee:
-                                unit_price = 0.0
+                                current_vendor_code = "000995"
+                        else:
+                            if is_pr_item:
+                                current_vendor_code = "000995"
+                            elif payment_method == "挂帳":
+                                current_vendor_code = default_vendor_code
                             else:
-                                continue
-                    
-                    # 取得其他欄位資料
-                    product_key = self.normalize_product_name(product_raw)
-                    product_code = self.product_mapping.get(product_key, f"未查到此商品({product_raw})")
-                    
-                    if product_raw.strip() == "[服務費]":
-                        quantity = "1"
-                    elif available_columns['quantity'] and pd.notna(row.get(available_columns['quantity'], "")):
-                        quantity = str(row[available_columns['quantity']]).strip()
-                    else:
-                        quantity = ""
-                    
-                    amount = ""
-                    if available_columns['amount'] and pd.notna(row.get(available_columns['amount'], "")):
-                        amount = str(row[available_columns['amount']]).strip().replace(",", "")
-                    
-                    # 設定傳票類別
-                    if payment_method == "多種":
-                        voucher_type = "S994"
-                    elif payment_method == "挂帳" and vendor_code_lookup:
-                        voucher_type = self.account_mapping.get(vendor_code_lookup, "未查到")
-                    else:
-                        voucher_type = {"現金": "S998", "信用卡": "S997", "匯款": "S996"}.get(payment_method, "S996")
-                    
-                    # 檢查是否為公關品並設定相應的傳票類別
-                    if is_pr_item:
-                        voucher_type = ""
-                    
-                    # 根據傳票類別和發票狀況設定稅別
-                    if voucher_type == 'S998':  # 現金付款
-                        # 檢查是否有發票號碼
-                        has_invoice = bool(invoice_number_for_output.strip() if not first_entry else False)
-                        tax_code = "2" if has_invoice else "6"
-                    else:
-                        tax_code = get_tax_code(voucher_type)
-                    
-                    # 設定現金/刷卡金額
-                    if payment_method == "現金":
-                        cash_amount = amount
-                        card_amount = ""
-                    elif payment_method == "信用卡":
-                        cash_amount = ""
-                        card_amount = amount
+                                current_vendor_code = "000999"
+                except ValueError:
+                    if is_service_fee:
+                        unit_price = 0.0
                     else:
-                        cash_amount = ""
-                        card_amount = ""
-                    
-                    # 處理總金額和發票相關資料
-                    total_amount = ""
-                    invoice_number_for_output = ""
-                    has_invoice_for_output = False
-                    
-                    if first_entry:
-                        # 發票號碼處理
-                        all_invoice_numbers = []
-                        if available_columns['invoice']:
-                            for _, invoice_row in df.iterrows():
-                                if pd.notna(invoice_row.get(available_columns['invoice'], "")):
-                                    invoice_str = str(invoice_row[available_columns['invoice']]).strip()
-                                    m = re.search(r"發票號:(\w+)", invoice_str)
-                                    if "發票金額:0" in invoice_str:
-                                        continue
-                                    elif m:
-                                        all_invoice_numbers.append(m.group(1))
-                        
-                        has_invoice_for_output = bool(all_invoice_numbers)
-                        
-                        # 格式化總金額
-                        try:
-                            amount_numeric = round(float(total_amount_value.replace(",", "")))
-                            total_amount = str(amount_numeric).zfill(8)
-                        except:
-                            total_amount = ""
-                        
-                        # 發票和備註處理
-                        if payment_method == "多種":
-                            invoice_number_for_output = ""
-                            remarks_m250 = "_".join(all_invoice_numbers) if all_invoice_numbers else ""
-                            has_invoice_for_output = False
-                        else:
-                            invoice_number_for_output = all_invoice_numbers[0] if all_invoice_numbers else ""
-                            remarks_m250 = ""
-                            has_invoice_for_output = invoice_number_for_output != ""
-                    
-                    first_entry = False
-                    
-                    # 開發票判斷
-                    has_invoice = False
-                    if available_columns['invoice'] and pd.notna(row.get(available_columns['invoice'], "")):
-                        invoice_str = str(row[available_columns['invoice']]).strip()
-                        has_invoice = not invoice_str.startswith("發票金額:0")
-                    
-                    # 未稅邏輯計算
-                    untaxed_price = ""
-                    untaxed_amount = ""
-                    tax_amount = ""
-                    
-                    if unit_price > 0:
-                        untaxed_price = str(round(unit_price))
-                    
-                    if amount:
-                        try:
-                            amt = float(amount.replace(",", ""))
-                            untaxed_amount = str(round(amt))
-                            tax_amount = str(round(amt - amt / 1.05))
-                        except:
-                            untaxed_amount = ""
-                            tax_amount = ""
-                    
-                    # 備註和發票號碼（只在第一筆寫入）
-                    remarks_to_write = remarks_m250 if not first_entry_written else ""
-                    invoice_number_to_write = invoice_number_for_output if not first_entry_written else ""
-                    
-                    # 計算總稅額
-                    total_tax = ""
-                    if not first_entry_written and available_columns['invoice']:
-                        invoice_amounts = []
-                        for _, tax_row in df.iterrows():
-                            if pd.notna(tax_row.get(available_columns['invoice'], "")):
-                                invoice_str = str(tax_row[available_columns['invoice']]).strip()
-                                m_amt = re.search(r"發票金額:(\d+)", invoice_str)
-                                if m_amt:
-                                    invoice_amounts.append(int(m_amt.group(1)))
-                        
-                        try:
-                            total_invoice_amt = sum(invoice_amounts)
-                            total_tax = str(round(total_invoice_amt - total_invoice_amt / 1.05))
-                        except:
-                            total_tax = ""
-                    
-                    # 處理銷貨單號 - 去除副檔名
-                    sales_order_number = os.path.splitext(file_name)[0]
-                    
-                    # 處理數量 - 轉為整數
-                    formatted_quantity = ""
-                    if quantity:
-                        try:
-                            qty_float = float(str(quantity).replace(",", ""))
-                            formatted_quantity = str(int(qty_float))
-                        except (ValueError, TypeError):
-                            formatted_quantity = quantity
-                    
-                    # 組織輸出資料
-                    output_rows.append([
-                        sales_order_number,       # B 銷貨單號（檔名，不含副檔名）
-                        product_code,             # E 產品代號
-                        spreadsheet_date,         # G 銷貨日期
-                        payment_method,           # R 付款方式
-                        current_vendor_code,      # C 客供商代號
-                        voucher_type,             # Z 傳票類別
-                        formatted_quantity,       # F 數量（整數）
-                        tax_code,                 # S 稅別
-                        cash_amount,              # T 付現金額
-                        card_amount,              # U 刷卡金額
-                        total_amount,             # V 含稅總金額
-                        untaxed_price,            # AA 未稅單價
-                        untaxed_amount,           # AB 未稅金額
-                        tax_amount,               # AC 稅額
-                        invoice_number_to_write,  # AK 發票號碼
-                        remarks_to_write,         # AW 備註
-                        total_tax if not first_entry_written else "",  # W 欄（總稅額）
-                    ])
-                    
-                    first_entry_written = True
-                    
-            except Exception as e:
-                print(f"[{file_name}] 錯誤: {str(e)}")
-        
-        return output_rows, special_vendor_dates
+                        continue
+            
+            # 取得其他欄位資料
+            product_code = self.product_mapping.get(product_key, f"未查到此商品({product_raw})")
+            
+            if product_raw == "[服務費]":
+                quantity = "1"
+            elif quantities is not None and quantities[i] is not None:
+                quantity = quantities[i]
+            else:
+                quantity = ""
+            
+            # 公關品不設定傳票類別
+            voucher_type = "" if is_pr_item else payment_voucher_type
+            
+            # 根據傳票類別和發票狀況設定稅別
+            if voucher_type == 'S998':  # 現金付款
+                # 只有第二筆會參考第一筆的發票號碼
+                has_invoice = entry_index == 1 and bool(invoice_number_for_output.strip())
+                tax_code = "2" if has_invoice else "6"
+            else:
+                tax_code = get_tax_code(voucher_type)
+            
+            # 未稅邏輯計算
+            untaxed_price = round(unit_price) if unit_price > 0 else None
+            amount_value = item_amounts[position]
+            untaxed_amount = rounded_amounts[position]
+            tax_amount = tax_amounts[position]
+            
+            # 設定現金/刷卡金額
+            cash_amount = amount_value if amount_column == "cash" else None
+            card_amount = amount_value if amount_column == "card" else None
+            
+            # 處理數量 - 轉為整數（無法轉換時保留原本的文字）
+            formatted_quantity = None
+            if quantity:
+                try:
+                    formatted_quantity = int(float(str(quantity).replace(",", "")))
+                except (ValueError, TypeError):
+                    formatted_quantity = quantity
+            
+            # 總金額、發票號碼、備註和總稅額只在第一筆寫入
+            first_entry = entry_index == 0
+            
+            # 組織輸出資料
+            output_rows.append(StatisticsRow(
+                sales_order_number,       # B 銷貨單號（檔名，不含副檔名）
+                product_code,             # E 產品代號
+                spreadsheet_date,         # G 銷貨日期
+                payment_method,           # R 付款方式
+                current_vendor_code,      # C 客供商代號
+                voucher_type,             # Z 傳票類別
+                formatted_quantity,       # F 數量（整數）
+                tax_code,                 # S 稅別
+                cash_amount,              # T 付現金額
+                card_amount,              # U 刷卡金額
+                total_amount if first_entry else "",              # V 含稅總金額
+                untaxed_price,            # AA 未稅單價
+                untaxed_amount,           # AB 未稅金額
+                tax_amount,               # AC 稅額
+                invoice_number_for_output if first_entry else "",  # AK 發票號碼
+                remarks_m250 if first_entry else "",              # AW 備註
+                total_tax if first_entry else None,               # W 欄（總稅額）
+            ))
+            
+            entry_index += 1
 
-    def write_to_excel(self, statistics_data, special_vendor_dates):
-        """將統計資料寫入 Excel 檔案"""
+    def build_unmatched_product_report(self, statistics_data, k=None):
+        """
+        整理查不到產品代號的品名，並以 n-gram 索引列出候選產品
+        - 回傳 DataFrame：品名、出現次數、第一筆銷貨單號與前 k 個候選代號、品名、分數
+        """
+        unmatched = {}
+        self._tally_unmatched_products(statistics_data, unmatched)
+        return self._unmatched_product_report(unmatched, k)
+    
+    @staticmethod
+    def _tally_unmatched_products(rows, unmatched):
+        """累計查不到產品代號的品名：{品名: [第一筆銷貨單號, 出現次數]}"""
+        prefix = "未查到此商品("
+        for row in rows:
+            product_code = row.product_code
+            if product_code.startswith(prefix):
+                name = product_code[len(prefix):-1]
+                if name in unmatched:
+                    unmatched[name][1] += 1
+                else:
+                    unmatched[name] = [row.sales_order, 1]
+    
+    def _unmatched_product_report(self, unmatched, k=None):
+        """依累計的品名產生候選報表"""
+        import pandas as pd
+        k = self.candidate_count if k is None else k
+        if self.product_index is None or len(self.product_index) != len(self.product_mapping):
+            reference = self.reference_data
+            if reference is not None and reference.product_mapping is self.product_mapping:
+                self.product_index = reference.product_index
+            else:
+                self.product_index = ProductCandidateIndex(self.product_mapping)
+        
+        columns = ['品名', '出現次數', '銷貨單號']
+        for rank in range(1, k + 1):
+            columns += [f'候選{rank}代號', f'候選{rank}品名', f'候選{rank}分數']
+        
+        report = []
+        for name, (sales_order, count) in unmatched.items():
+            row_out = [name, count, sales_order]
+            for code, candidate_name, score in self.product_index.candidates(name, k):
+                row_out += [code, candidate_name, score]
+            row_out += [""] * (len(columns) - len(row_out))
+            report.append(row_out)
+        
+        return pd.DataFrame(report, columns=columns)
+    
+    def write_to_excel(self, statistics_data, special_vendor_dates, unmatched_report=None, summary_tables=None):
+        """
+        將統計資料寫入 Excel 檔案，回傳是否寫入成功
+        - statistics_data 可以是逐列產生資料的迭代器，寫出時才取用
+        - unmatched_report 為查不到產品代號的候選報表，有資料時另寫一個工作表；
+          也可以是統計資料寫完後才呼叫的函式（串流處理時使用）
+        - summary_tables 為統計資料寫完後才呼叫的函式，回傳要另外寫出的彙總表格 [(名稱, 欄位名稱, 資料列)]
+        - 依輸出檔案副檔名寫成 .xlsx、.csv 或 .parquet，資料逐列寫出不整批留在記憶體
+        """
         try:
             # 檢查並創建輸出資料夾
             output_dir = os.path.dirname(self.statistics_output_path)
             if output_dir and not os.path.exists(output_dir):
                 os.makedirs(output_dir)
-                print(f"已創建輸出資料夾: {output_dir}")
-            
-            # 準備統計資料
-            aligned_data = []
-            for row in statistics_data:
-                row_out = [""] * 49  # 足夠的欄位數
-                row_out[1] = row[0]   # B欄：銷貨單號
-                row_out[2] = row[4]   # C欄：客供商代號
-                row_out[4] = row[1]   # E欄：產品代號
-                row_out[5] = row[6]   # F欄：數量
-                row_out[6] = row[2]   # G欄：銷貨日期
-                row_out[18] = row[7]  # S欄：稅別
-                row_out[21] = row[10] # V欄：總含稅金額
-                row_out[28] = row[13] # AC欄：稅額
-                row_out[36] = row[14] # AK欄：發票號碼
-                row_out[48] = row[15] # AW欄：備註M250
-                row_out[25] = row[5]  # Z欄：傳票類別
-                row_out[26] = row[11] # AA欄：未稅單價
-                row_out[27] = row[12] # AB欄：未稅金額
-                row_out[22] = row[16] # W欄：總稅額
-                
-                aligned_data.append(row_out)
+                logger.info(f"已創建輸出資料夾: {output_dir}")
             
-            # 創建 Excel 檔案
-            with pd.ExcelWriter(self.statistics_output_path, engine='openpyxl') as writer:
-                # 寫入統計資料 - 從第二列開始寫入
-                df_stats = pd.DataFrame(aligned_data)
-                df_stats.to_excel(writer, sheet_name='統計資料', index=False, header=False, startrow=1)
+            # 逐列寫出統計資料（第一列空白，從第二列開始）
+            with self._stage('write'), StatisticsWriter(self.statistics_output_path, self.max_rows_per_sheet) as writer:
+                writer.write_rows(statistics_data)
                 
-                # 寫入特殊客供商記錄
+                # 寫入特殊客供商記錄（串流處理時，寫完統計資料後才完整）
                 if special_vendor_dates:
-                    special_data = []
-                    for entry in special_vendor_dates:
-                        special_data.append([
-                            entry['date'],
-                            entry['vendor_code'],
-                            entry['spreadsheet_name']
-                        ])
-                    
-                    df_special = pd.DataFrame(special_data, columns=['日期', '客供商代號', '銷貨單號'])
-                    df_special.to_excel(writer, sheet_name='特殊客供商記錄', index=False)
-            
-            print(f"✅ 成功寫入統計資料，共 {len(statistics_data)} 筆")
-            print(f"✅ 檔案已儲存至: {self.statistics_output_path}")
+                    writer.add_table('特殊客供商記錄', ['日期', '客供商代號', '銷貨單號'], (
+                        [entry['date'], entry['vendor_code'], entry['spreadsheet_name']]
+                        for entry in special_vendor_dates
+                    ))
+                
+                # 寫入查不到產品代號的候選報表
+                if callable(unmatched_report):
+                    unmatched_report = unmatched_report()
+                if unmatched_report is not None and len(unmatched_report):
+                    writer.add_table('未查到商品候選', unmatched_report.columns, unmatched_report.values.tolist())
+                
+                # 寫入彙總工作表
+                if summary_tables is not None:
+                    for name, columns, rows in summary_tables():
+                        writer.add_table(name, columns, rows)
+            
+            if writer.part_count > 1:
+                unit = "個工作表" if writer.format == 'xlsx' else "個檔案"
+                logger.info(f"資料超過列數上限，統計資料已分成 {writer.part_count} {unit}")
+            
+            logger.info(f"✅ 成功寫入統計資料，共 {writer.row_count} 筆")
+            logger.info(f"✅ 檔案已儲存至: {self.statistics_output_path}")
+            return True
             
         except PermissionError:
-            print(f"❌ 權限錯誤：無法寫入檔案 {self.statistics_output_path}")
-            print("可能的原因：")
-            print("1. 檔案正在 Excel 中開啟，請關閉檔案後重試")
-            print("2. 沒有寫入該資料夾的權限")
-            print("3. 檔案被其他程式鎖定")
-            print("\n建議解決方案：")
-            print("1. 關閉所有開啟該檔案的程式（如 Excel）")
-            print("2. 確認資料夾路徑存在且有寫入權限")
-            print("3. 嘗試使用不同的檔案名稱")
+            logger.error(
+                f"❌ 權限錯誤：無法寫入檔案 {self.statistics_output_path}\n"
+                "可能的原因：\n"
+                "1. 檔案正在 Excel 中開啟，請關閉檔案後重試\n"
+                "2. 沒有寫入該資料夾的權限\n"
+                "3. 檔案被其他程式鎖定\n"
+                "建議解決方案：\n"
+                "1. 關閉所有開啟該檔案的程式（如 Excel）\n"
+                "2. 確認資料夾路徑存在且有寫入權限\n"
+                "3. 嘗試使用不同的檔案名稱"
+            )
         except FileNotFoundError:
-            print(f"❌ 檔案路徑錯誤：找不到目標資料夾")
-            print(f"路徑: {self.statistics_output_path}")
-            print("請確認資料夾路徑是否正確")
+            logger.error(
+                f"❌ 檔案路徑錯誤：找不到目標資料夾\n"
+                f"路徑: {self.statistics_output_path}\n"
+                "請確認資料夾路徑是否正確"
+            )
+        except ImportError as e:
+            logger.error(f"❌ 無法寫出統計資料: {str(e)}")
         except Exception as e:
-            print(f"❌ 寫入 Excel 檔案時發生未預期錯誤: {str(e)}")
-            print("請檢查檔案路徑和權限設定")
+            logger.error(f"❌ 寫入 Excel 檔案時發生未預期錯誤: {str(e)}，請檢查檔案路徑和權限設定")
+        return False
+
+    def process_folder(self, folder_path, output_path):
+        """
+        處理單一資料夾並寫入統計資料檔案（對照表需先載入），回傳是否寫入成功
+        - 以串流方式處理：找到檔案 → 讀取 → 轉換 → 寫出，統計資料不整批留在記憶體
+        """
+        self.folder_path = folder_path
+        self.statistics_output_path = output_path
+        
+        # 先確認資料夾內有試算表，避免產生空的輸出檔案
+        logger.info("掃描 Excel 檔案...")
+        with self._stage('discover'):
+            files = self.iter_excel_files()
+            first_file = next(files, None)
+        if first_file is None:
+            raise ValueError("指定的資料夾內沒有 Excel 試算表")
+        files = itertools.chain([first_file], files)
+        
+        # 邊處理邊寫出
+        logger.info("處理銷售數據並寫入結果...")
+        return self._write_file_results(self.iter_file_statistics(files), output_path)
+
+    def _write_file_results(self, file_results, output_path):
+        """將各檔的 (輸出資料列, 特殊客供商記錄) 依序寫入統計資料檔案，並記錄到彙總庫"""
+        special_vendor_dates = []
+        unmatched = {} if self.candidate_count > 0 else None
+        rows = self._iter_result_rows(file_results, special_vendor_dates, unmatched)
+        if self.history_store is not None:
+            rows = self.history_store.record(HistoryStore.period_of(output_path), rows)
+        rollup = None
+        if self.rollups:
+            # 寫出時逐列累計彙總
+            rollup = RollupAggregator()
+            rows = rollup.consume(rows)
+        
+        def unmatched_report():
+            # 統計資料寫完後才整理候選報表
+            if unmatched is None:
+                return None
+            report = self._unmatched_product_report(unmatched)
+            logger.info(f"查不到產品代號的品名: {len(report)} 種")
+            return report
+        
+        with self._stage('process'):
+            return self.write_to_excel(rows, special_vendor_dates, unmatched_report,
+                                       rollup.tables if rollup is not None else None)
+
+    def merge_rollups(self, input_paths, output_path):
+        """
+        合併多個輸出檔案的彙總明細（例如每週合併成每月），寫成只含彙總工作表的 .xlsx，回傳合併後的 RollupAggregator
+        - 各檔案需以 --rollups 輸出（含「彙總明細」），不需重新處理原始檔案
+        """
+        if os.path.splitext(output_path)[1].lower() != '.xlsx':
+            raise ValueError(f"彙總合併只支援輸出 .xlsx: {output_path}")
+        rollup = RollupAggregator()
+        with self._stage('merge_rollups'):
+            for path in input_paths:
+                rollup.merge(RollupAggregator.load(path))
+                logger.info(f"已讀取彙總明細: {path}")
+            
+            import openpyxl
+            output_dir = os.path.dirname(output_path)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            workbook = openpyxl.Workbook(write_only=True)
+            for name, columns, rows in rollup.tables():
+                sheet = workbook.create_sheet(name)
+                sheet.append(columns)
+                for row in rows:
+                    sheet.append([None if value == "" else value for value in row])
+            # 先寫到暫存檔再取代，與統計資料輸出相同
+            temp_path = os.path.join(output_dir, f".~{os.path.basename(output_path)}")
+            workbook.save(temp_path)
+            os.replace(temp_path, output_path)
+        logger.info(f"✅ 已合併 {len(input_paths)} 個檔案的彙總（{len(rollup)} 組），儲存至: {output_path}")
+        return rollup
+
+    def process_shard(self, folder_path, output_path, shard, shards):
+        """
+        分片處理：只處理資料夾內屬於指定分片的檔案，寫出部分結果（對照表需先載入）
+        - 各機器以相同的分片數分別處理不同分片，再以 merge_partials 合併
+        - 檔案順序與 iter_excel_files 相同（依在資料夾內的相對路徑排序），各機器的列舉順序不同
+          （例如複製到本機的資料夾）時分法與合併結果仍相同
+        - 回傳寫入的檔案數
+        """
+        if shards < 1 or not 0 <= shard < shards:
+            raise ValueError(f"分片編號超出範圍: {shard}/{shards}")
+        self.folder_path = folder_path
+        
+        with self._stage('discover'):
+            files = list(self.iter_excel_files(folder_path))
+        if not files:
+            raise ValueError("指定的資料夾內沒有 Excel 試算表")
+        relative_paths = [self.relative_path(file['path'], folder_path) for file in files]
+        selected = [
+            (seq, file) for seq, file in enumerate(files)
+            if PartialResult.shard_of(file['name'], shards) == shard
+        ]
+        logger.info(f"分片 {shard}/{shards}: {len(selected)} 個檔案（資料夾共 {len(files)} 個）")
+        
+        file_results = self.iter_file_statistics([file for _, file in selected])
+        records = (
+            (seq, file['name'], file_rows, file_special_dates)
+            for (seq, file), (file_rows, file_special_dates) in zip(selected, file_results)
+        )
+        with self._stage('process'):
+            count = PartialResult.write(output_path, shard, shards, relative_paths, records)
+        logger.info(f"✅ 部分結果已儲存至: {output_path}")
+        return count
+
+    def merge_partials(self, partial_paths, output_path):
+        """
+        合併各分片的部分結果並寫入統計資料檔案，回傳是否寫入成功
+        - 依檔案相對路徑排序後的序號做 k 路合併，輸出與單一程序以 process_folder 處理整個資料夾逐列相同
+        - 每個部分結果同時只讀取一個檔案的資料
+        """
+        self.statistics_output_path = output_path
+        with contextlib.ExitStack() as stack:
+            partials = [stack.enter_context(PartialResult(path)) for path in partial_paths]
+            PartialResult.check(partials)
+            logger.info(f"合併 {len(partials)} 個分片，資料夾共 {len(partials[0].files)} 個檔案")
+            merged = heapq.merge(*(partial.records() for partial in partials), key=operator.itemgetter(0))
+            file_results = ((file_rows, file_special_dates) for _, _, file_rows, file_special_dates in merged)
+            return self._write_file_results(file_results, output_path)
+
+    def watch_folder(self, folder_path, output_path, interval=5.0, settle_seconds=2.0, idle_exit=None):
+        """
+        監看資料夾，新增或修改的試算表一出現就處理並更新輸出檔案（對照表需先載入）
+        - 以輪詢比對檔案大小與修改時間，只處理有變動的檔案，其他檔案沿用已轉換的結果
+        - 修改時間在 settle_seconds 秒內的檔案視為仍在寫入，留到下一輪處理
+        - 輸出依檔案掃描順序寫出，內容與整批處理相同
+        - 輸出檔案寫入失敗（例如正在 Excel 中開啟）時，之後每一輪都重新寫入直到成功
+        - idle_exit 秒內沒有任何變動時結束；未指定時持續執行，按 Ctrl+C 結束
+        """
+        self.folder_path = folder_path
+        self.statistics_output_path = output_path
+        
+        # 檔案路徑 → (檔案大小與修改時間, 輸出資料列, 特殊客供商記錄)
+        results = {}
+        # 上次寫入輸出檔案失敗，尚未寫入最新結果
+        write_pending = False
+        last_change = time.monotonic()
+        logger.info(f"開始監看資料夾: {folder_path}（每 {interval} 秒檢查一次，按 Ctrl+C 結束）")
+        
+        try:
+            while True:
+                changed, write_pending = self._watch_cycle(results, settle_seconds, write_pending)
+                if changed or write_pending:
+                    last_change = time.monotonic()
+                elif idle_exit is not None and time.monotonic() - last_change >= idle_exit:
+                    logger.info(f"{idle_exit} 秒內沒有新的試算表，結束監看")
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            logger.info("停止監看")
+        
+        return results
+
+    def _watch_cycle(self, results, settle_seconds, write_pending=False):
+        """
+        監看的一輪檢查：處理有變動的檔案並更新輸出，回傳 (是否有變動, 是否仍待寫入)
+        - write_pending 為上一輪寫入失敗時，即使沒有變動也重新寫入
+        """
+        files = list(self.iter_excel_files())
+        now = time.time()
+        changed = []
+        for file in files:
+            try:
+                stat = SourceFile(file['path']).stat()
+            except (OSError, ValueError):
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = results.get(file['path'])
+            if previous is not None and previous[0] == signature:
+                continue
+            if now - stat.st_mtime < settle_seconds:
+                continue
+            changed.append((file, signature))
+        
+        current_paths = {file['path'] for file in files}
+        removed = [path for path in results if path not in current_paths]
+        for path in removed:
+            del results[path]
+            logger.info(f"試算表已移除: {os.path.basename(path)}")
+        
+        if not changed and not removed and not write_pending:
+            return False, False
+        
+        changed_files = [file for file, _ in changed]
+        for (file, signature), (file_rows, file_special_dates) in zip(
+            changed, self.iter_file_statistics(changed_files)
+        ):
+            results[file['path']] = (signature, file_rows, file_special_dates)
+            logger.info(f"已處理 {file['name']}: {len(file_rows)} 筆")
+        
+        # 依掃描順序重新組合所有檔案的結果並寫出
+        ordered = [results[file['path']] for file in files if file['path'] in results]
+        special_vendor_dates = [entry for _, _, file_special_dates in ordered for entry in file_special_dates]
+        rows = (row for _, file_rows, _ in ordered for row in file_rows)
+        if self.history_store is not None:
+            rows = self.history_store.record(HistoryStore.period_of(self.statistics_output_path), rows)
+        
+        unmatched_report = None
+        if self.candidate_count > 0:
+            unmatched = {}
+            for _, file_rows, _ in ordered:
+                self._tally_unmatched_products(file_rows, unmatched)
+            unmatched_report = self._unmatched_product_report(unmatched)
+        
+        rollup = None
+        if self.rollups:
+            rollup = RollupAggregator()
+            rows = rollup.consume(rows)
+        
+        written = self.write_to_excel(rows, special_vendor_dates, unmatched_report,
+                                      rollup.tables if rollup is not None else None)
+        if not written:
+            logger.warning("輸出檔案寫入失敗，下一輪檢查時重新寫入")
+        return bool(changed or removed), not written
+
+    def run_batch(self, jobs, concurrent_jobs=1):
+        """
+        批次處理多個資料夾，對照表只需載入一次
+        - jobs 為 [{'folder': 資料夾路徑, 'output': 輸出檔案路徑}]
+        - concurrent_jobs 大於 1 時以多個程序同時處理不同資料夾（各資料夾內逐檔處理）
+        - 回傳 [{'folder', 'output', 'success', 'elapsed'}]，順序與 jobs 相同
+        """
+        if concurrent_jobs > 1 and len(jobs) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(
+                max_workers=min(concurrent_jobs, len(jobs)),
+                initializer=_init_collect_worker,
+                initargs=(self.product_mapping, self.account_mapping, self.parse_cache, self.candidate_count,
+                          self.history_store, self.instrumentation is not None, self.payment_classifier,
+                          self.tax_engine, (self.file_timeout, self.file_memory_limit, self.quarantine_dir),
+                          self.rollups, self.max_rows_per_sheet)
+            ) as executor:
+                results = list(executor.map(_process_job_worker, jobs))
+            # 合併各工作程序的量測記錄
+            for result in results:
+                snapshot = result.pop('instrumentation', None)
+                if snapshot is not None and self.instrumentation is not None:
+                    self.instrumentation.merge(snapshot)
+        else:
+            results = [self._run_job(job) for job in jobs]
+        
+        logger.info("=== 批次處理結果 ===")
+        for result in results:
+            status = "✅" if result['success'] else "❌"
+            logger.info(f"{status} {result['folder']} → {result['output']} ({result['elapsed']:.1f} 秒)")
+        return results
+
+    def _run_job(self, job):
+        """
+        執行單一批次工作，錯誤只記錄不中斷其他工作
+        - 工作指定 shard（(分片編號, 分片數)）時只處理該分片，輸出為部分結果
+        - 回傳結果的 quarantined 為此工作隔離的檔案
+        """
+        start = time.perf_counter()
+        quarantine_start = len(self.quarantine)
+        logger.info(f"=== 處理 {job['folder']} ===")
+        try:
+            if job.get('shard'):
+                self.process_shard(job['folder'], job['output'], *job['shard'])
+                success = True
+            else:
+                success = self.process_folder(job['folder'], job['output'])
+        except Exception as e:
+            logger.error(f"[{job['folder']}] 處理失敗: {str(e)}")
+            success = False
+        return {
+            'folder': job['folder'],
+            'output': job['output'],
+            'success': bool(success),
+            'elapsed': time.perf_counter() - start,
+            'quarantined': self.quarantine[quarantine_start:],
+        }
 
     def run(self):
         """執行主程式"""
         try:
-            print("=== 銷售數據處理器 ===")
+            logger.info("=== 銷售數據處理器 ===")
             
             # 設定檔案路徑
             self.setup_paths()
             
             # 載入對照表
-            print("\n載入對照表...")
-            self.load_product_code_mapping()
-            self.load_account_mapping()
-            
-            # 取得 Excel 檔案列表
-            print("\n掃描 Excel 檔案...")
-            files = self.get_excel_files()
-            
-            # 收集統計資料
-            print("\n處理銷售數據...")
-            statistics_data, special_vendor_dates = self.collect_statistics_data(files)
+            logger.info("載入對照表...")
+            with self._stage('load_mappings'):
+                self.load_reference_data()
             
-            # 寫入結果
-            print("\n寫入結果...")
-            self.write_to_excel(statistics_data, special_vendor_dates)
+            self.process_folder(self.folder_path, self.statistics_output_path)
             
-            print("\n=== 處理完成 ===")
+            if self.table_cache is not None:
+                self.table_cache.log_stats()
+            logger.info("=== 處理完成 ===")
             
         except Exception as e:
-            print(f"執行過程中發生錯誤: {str(e)}")
+            logger.error(f"執行過程中發生錯誤: {str(e)}")
             raise
 
-def main():
-    """主函式"""
+# 平行處理時，每個工作程序各自持有的處理器實例
+_worker_processor = None
+
+def _init_collect_worker(product_mapping, account_mapping, parse_cache=None, candidate_count=0,
+                         history_store=None, instrumented=False, payment_classifier=None, tax_engine=None,
+                         isolation=None, rollups=False, max_rows_per_sheet=None):
+    """
+    工作程序初始化：建立處理器並載入主程序傳來的對照表與快取設定
+    - isolation 為 (每檔處理秒數, 記憶體上限, 隔離資料夾)，批次工作在工作程序中隔離執行時使用
+    """
+    global _worker_processor
+    # 工作程序只處理分配到的檔案，不會重複讀取，不使用記憶體快取
+    _worker_processor = SalesDataProcessor(memory_cache_bytes=None)
+    if payment_classifier is not None:
+        _worker_processor.payment_classifier = payment_classifier
+    if tax_engine is not None:
+        _worker_processor.tax_engine = tax_engine
+    _worker_processor.product_mapping = product_mapping
+    _worker_processor.account_mapping = account_mapping
+    _worker_processor.parse_cache = parse_cache
+    _worker_processor.candidate_count = candidate_count
+    _worker_processor.history_store = history_store
+    _worker_processor.rollups = rollups
+    _worker_processor.max_rows_per_sheet = max_rows_per_sheet
+    if isolation is not None:
+        _worker_processor.file_timeout, _worker_processor.file_memory_limit, _worker_processor.quarantine_dir = isolation
+    if instrumented:
+        _worker_processor.instrumentation = Instrumentation()
+
+def _collect_file_worker(task):
+    """工作程序執行的單檔處理函式"""
+    file, target_column_name, time_column_name = task
+    result = _worker_processor.collect_file_statistics(file, target_column_name, time_column_name)
+    # 量測記錄隨結果傳回主程序彙總
+    instrumentation = _worker_processor.instrumentation
+    return result, (instrumentation.last_record if instrumentation is not None else None)
+
+def _isolated_worker_main(conn, initargs, memory_limit=None):
+    """隔離執行的工作程序：逐一接收檔案處理，回傳 (輸出資料, 量測記錄, 錯誤)，收到 None 時結束"""
+    if memory_limit:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        except (ImportError, ValueError, OSError) as e:
+            logger.warning(f"此系統無法限制工作程序記憶體: {str(e)}")
+    _init_collect_worker(*initargs)
+    _worker_processor.strict_read = True
+    
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        file, target_column_name, time_column_name = task
+        timings = {}
+        result = _worker_processor._collect_file_statistics(
+            file, target_column_name, time_column_name, timings=timings
+        )
+        record = None
+        instrumentation = _worker_processor.instrumentation
+        if instrumentation is not None:
+            record = instrumentation.record_file(file['name'], result[0], **timings)
+        conn.send((result, record, timings.get('error')))
+
+def _process_job_worker(job):
+    """工作程序執行的批次工作（處理一個資料夾），量測記錄隨結果傳回主程序彙總"""
+    if _worker_processor.instrumentation is None:
+        return _worker_processor._run_job(job)
+    # 同一工作程序會處理多個工作，每個工作各自量測
+    _worker_processor.instrumentation = Instrumentation()
+    result = _worker_processor._run_job(job)
+    result['instrumentation'] = _worker_processor.instrumentation.snapshot()
+    return result
+
+def _load_batch_config(config_path):
+    """讀取批次設定檔（JSON），設定檔中的相對路徑以設定檔所在資料夾為準"""
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+    
+    def resolve(path):
+        return os.path.join(base_dir, path) if path else path
+    
+    for key in ('product_code_file', 'account_query_file', 'customer_code_file', 'cache_dir', 'history_db',
+                'quarantine_dir', 'failure_manifest'):
+        if config.get(key):
+            config[key] = resolve(config[key])
+    config['jobs'] = [
+        {'folder': resolve(job['folder']), 'output': resolve(job['output'])}
+        for job in config.get('jobs', [])
+    ]
+    return config
+
+def _build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="銷售數據處理器：未指定參數時以互動方式輸入路徑，指定參數或設定檔時批次處理多個資料夾"
+    )
+    parser.add_argument('--version', action='version', version=f"%(prog)s {__version__}")
+    parser.add_argument('--config', help="批次設定檔（JSON），列出對照表路徑與各資料夾的輸出檔案")
+    parser.add_argument('--job', nargs=2, action='append', metavar=('FOLDER', 'OUTPUT'),
+                        help="要處理的資料夾與輸出檔案，可重複指定")
+    parser.add_argument('--product', help="產品代號試算表檔案路徑")
+    parser.add_argument('--account', help="查詢挂帳試算表檔案路徑")
+    parser.add_argument('--customer', help="客戶供應商代號和傳票類別試算表檔案路徑")
+    parser.add_argument('--workers', type=int, help="每個資料夾平行處理的程序數（0 代表全部 CPU 核心）")
+    parser.add_argument('--jobs', type=int, dest='concurrent_jobs',
+                        help="同時處理的資料夾數（預設 1，依序處理）")
+    parser.add_argument('--cache-dir', help="解析結果與對照表快照的快取資料夾")
+    parser.add_argument('--cache-max-mb', type=int, metavar='MB',
+                        help="解析結果快取的容量上限（MB，預設 512），超過時淘汰最久未使用的項目")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="處理前清空解析結果快取與對照表快照（未指定工作時清空後結束）")
+    parser.add_argument('--memory-cache', type=int, metavar='MB',
+                        help="程序內解析結果快取的容量（MB，預設 0 不使用；同一檔案會被讀取多次時使用）")
+    parser.add_argument('--max-rows', type=int,
+                        help="每個工作表（.xlsx）或檔案（.csv）的資料列數上限，超過時換到續頁或續檔")
+    parser.add_argument('--history', help="歷次統計資料的彙總資料庫（SQLite），處理結果會同時寫入")
+    parser.add_argument('--import-history', nargs='+', metavar='XLSX',
+                        help="將既有的統計資料檔案匯入彙總資料庫（需同時指定 --history）")
+    parser.add_argument('--watch', action='store_true',
+                        help="監看模式：持續監看資料夾（只能指定一個工作），有新的試算表就更新輸出")
+    parser.add_argument('--interval', type=float, default=5.0, help="監看模式的檢查間隔秒數（預設 5）")
+    parser.add_argument('--idle-exit', type=float,
+                        help="監看模式下，超過指定秒數沒有新的試算表時結束")
+    parser.add_argument('-v', '--verbose', action='store_true', help="列出每個檔案的量測明細（除錯層級日誌）")
+    parser.add_argument('-q', '--quiet', action='store_true', help="只輸出警告與錯誤")
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help="日誌格式（json 為每行一筆）")
+    parser.add_argument('--log-file', help="日誌同時寫入的檔案（標準錯誤仍照常輸出）")
+    parser.add_argument('--metrics', help="將量測彙總（各階段時間、檔案數、列數、查無次數）寫入 JSON 檔案")
+    parser.add_argument('--trace-memory', action='store_true', help="以 tracemalloc 記錄各階段的記憶體高峰（會變慢）")
+    parser.add_argument('--profile-dir', help="以 cProfile 剖析每個檔案，將最慢檔案的結果寫入此資料夾（逐檔處理）")
+    parser.add_argument('--profile-top', type=int, default=5, help="保留剖析結果的最慢檔案數（預設 5）")
+    parser.add_argument('--candidates', type=int, help="查不到產品代號時列出的候選數（0 代表不輸出）")
+    parser.add_argument('--tax-rate', help="營業稅率（預設 0.05）")
+    parser.add_argument('--allow-missing-reference', action='store_true',
+                        help="指定的對照表無法載入時仍繼續處理（預設結束並回傳 1，避免產生全部查不到的報表）")
+    parser.add_argument('--file-timeout', type=float,
+                        help="隔離執行：每個檔案的處理秒數上限，超過時終止並隔離該檔案")
+    parser.add_argument('--file-memory', type=int, metavar='MB',
+                        help="隔離執行：每個工作程序的記憶體上限（MB，僅 Unix），超過時隔離該檔案")
+    parser.add_argument('--quarantine-dir', help="隔離的檔案移到此資料夾（未指定時只列入隔離清單）")
+    parser.add_argument('--failure-manifest', help="將隔離清單（檔案與原因）寫入 JSON 檔案")
+    parser.add_argument('--retry', nargs=2, metavar=('MANIFEST', 'OUTPUT'),
+                        help="只重新處理隔離清單中的檔案，結果寫入 OUTPUT")
+    parser.add_argument('--rollups', action='store_true',
+                        help="另外輸出依產品代號、客供商代號、傳票類別與銷貨日期的彙總工作表（含可合併的彙總明細）")
+    parser.add_argument('--merge-rollups', nargs='+', metavar=('OUTPUT', 'INPUT'),
+                        help="合併以 --rollups 輸出的檔案的彙總（例如每週合併成每月），寫入 OUTPUT（.xlsx）")
+    parser.add_argument('--shard', nargs=2, type=int, metavar=('INDEX', 'COUNT'),
+                        help="分片處理：依檔名前 4 碼將檔案分成 COUNT 份，只處理第 INDEX 份（從 0 起算），"
+                             "各工作的輸出檔案為部分結果")
+    parser.add_argument('--merge', nargs='+', metavar=('OUTPUT', 'PARTIAL'),
+                        help="合併各分片的部分結果寫入 OUTPUT，輸出與不分片處理相同")
+    parser.add_argument('--scan', nargs='*', metavar='FOLDER',
+                        help="只讀取標題列，檢查資料夾內的檔案格式、必要欄位與檔名日期後結束"
+                             "（未指定資料夾時檢查各工作的資料夾）")
+    parser.add_argument('--scan-report', help="將掃描結果寫入 CSV 檔案（需同時指定 --scan）")
+    return parser
+
+def run_cli(argv=None):
+    """命令列批次模式，回傳結束代碼（全部成功為 0）"""
+    parser = _build_arg_parser()
+    args = parser.parse_args(argv)
+    
+    level = logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO
+    configure_logging(level, json_format=args.log_format == 'json', log_file=args.log_file)
+    
+    config = _load_batch_config(args.config) if args.config else {}
+    jobs = list(config.get('jobs', []))
+    jobs += [{'folder': folder, 'output': output} for folder, output in (args.job or [])]
+    
+    def option(value, key, default=None):
+        if value is not None:
+            return value
+        return config.get(key, default)
+    
+    history_path = option(args.history, 'history_db')
+    history_store = HistoryStore(history_path) if history_path else None
+    
+    if args.import_history:
+        if history_store is None:
+            parser.error("--import-history 需要同時指定 --history")
+        paths = sorted({path for pattern in args.import_history for path in glob.glob(pattern)})
+        for period, count in history_store.import_workbooks(paths).items():
+            logger.info(f"已匯入 {period}: {count} 筆")
+        if not jobs:
+            return 0
+    
+    if args.merge_rollups is not None:
+        if len(args.merge_rollups) < 2:
+            parser.error("--merge-rollups 需要指定輸出檔案與至少一個輸入檔案")
+        output_path, patterns = args.merge_rollups[0], args.merge_rollups[1:]
+        paths = sorted({path for pattern in patterns for path in (glob.glob(pattern) or [pattern])})
+        try:
+            SalesDataProcessor().merge_rollups(paths, output_path)
+        except (ValueError, OSError) as e:
+            logger.error(f"彙總合併失敗: {str(e)}")
+            return 1
+        return 0
+    
+    if args.scan_report and args.scan is None:
+        parser.error("--scan-report 需要同時指定 --scan")
+    if args.scan is not None:
+        folders = args.scan or [job['folder'] for job in jobs]
+        if not folders:
+            parser.error("請以 --scan 或 --job、--config 指定要檢查的資料夾")
+        return _run_scan(folders, args.scan_report)
+    
+    cache_dir = option(args.cache_dir, 'cache_dir')
+    cache_max = option(args.cache_max_mb, 'cache_max_mb', 512)
+    if cache_max <= 0:
+        parser.error("--cache-max-mb 必須大於 0")
+    if args.clear_cache:
+        if not cache_dir:
+            parser.error("--clear-cache 需要同時指定 --cache-dir（或設定檔的 cache_dir）")
+        removed = SalesDataProcessor(cache_dir=cache_dir, memory_cache_bytes=None).clear_cache()
+        logger.info(f"已清空快取: {cache_dir}（含 {removed} 個對照表快照）")
+        if args.merge is None and args.retry is None and not jobs:
+            return 0
+    
+    if args.merge is not None and len(args.merge) < 2:
+        parser.error("--merge 需要指定輸出檔案與至少一個部分結果")
+    if args.merge is None and args.retry is None and not jobs:
+        parser.error("請以 --job 或 --config 指定至少一個要處理的資料夾")
+    
+    shard = option(args.shard, 'shard')
+    if shard:
+        shard = tuple(shard)
+        if len(shard) != 2 or shard[1] < 1 or not 0 <= shard[0] < shard[1]:
+            parser.error(f"分片編號超出範圍: {shard}")
+        jobs = [dict(job, shard=shard) for job in jobs]
+    
+    memory_cache = option(args.memory_cache, 'memory_cache_mb', 0)
+    processor = SalesDataProcessor(
+        workers=option(args.workers, 'workers', 1),
+        cache_dir=cache_dir,
+        memory_cache_bytes=memory_cache * 1024 * 1024,
+        cache_max_bytes=cache_max * 1024 * 1024,
+    )
+    processor.product_code_file_path = option(args.product, 'product_code_file', "")
+    processor.account_query_file_path = option(args.account, 'account_query_file', "")
+    processor.customer_code_file_path = option(args.customer, 'customer_code_file', "")
+    processor.candidate_count = option(args.candidates, 'candidates', 0)
+    processor.rollups = bool(args.rollups or config.get('rollups'))
+    processor.max_rows_per_sheet = option(args.max_rows, 'max_rows')
+    processor.history_store = history_store
+    processor.file_timeout = option(args.file_timeout, 'file_timeout')
+    file_memory = option(args.file_memory, 'file_memory_mb')
+    processor.file_memory_limit = file_memory * 1024 * 1024 if file_memory else None
+    processor.quarantine_dir = option(args.quarantine_dir, 'quarantine_dir')
+    failure_manifest = option(args.failure_manifest, 'failure_manifest')
+    tax_rate = option(args.tax_rate, 'tax_rate')
+    if tax_rate is not None:
+        try:
+            processor.tax_engine = TaxEngine(tax_rate)
+        except ValueError as e:
+            parser.error(str(e))
+    if config.get('payment_methods') or config.get('skip_keywords'):
+        try:
+            processor.payment_classifier = PaymentClassifier(
+                config.get('payment_methods'), config.get('skip_keywords', ())
+            )
+        except ValueError as e:
+            parser.error(str(e))
+    processor.instrumentation = Instrumentation(
+        trace_memory=args.trace_memory, profile_dir=args.profile_dir, profile_top=args.profile_top
+    )
+    
+    if args.watch and len(jobs) != 1:
+        parser.error("監看模式只能指定一個資料夾")
+    if args.watch and shard:
+        parser.error("監看模式不能與分片處理同時使用")
+    
+    # 合併部分結果時只有候選報表需要產品代號表
+    if args.merge is None or processor.candidate_count > 0:
+        logger.info("載入對照表...")
+        with processor._stage('load_mappings'):
+            processor.load_reference_data()
+        # 無人值守執行時，對照表載入失敗會產生每個商品都查不到的報表，預設直接結束
+        missing = processor.missing_reference_tables()
+        if missing and not (args.allow_missing_reference or config.get('allow_missing_reference')):
+            for name, path in missing:
+                logger.error(f"無法載入{name}: {path}")
+            logger.error("對照表載入失敗，未處理任何資料夾（確定要繼續時指定 --allow-missing-reference）")
+            return 1
+    
+    try:
+        if args.merge is not None:
+            output_path, patterns = args.merge[0], args.merge[1:]
+            paths = sorted({path for pattern in patterns for path in (glob.glob(pattern) or [pattern])})
+            try:
+                return 0 if processor.merge_partials(paths, output_path) else 1
+            except (ValueError, OSError) as e:
+                logger.error(f"合併失敗: {str(e)}")
+                return 1
+        
+        if args.watch:
+            processor.watch_folder(jobs[0]['folder'], jobs[0]['output'],
+                                   interval=args.interval, idle_exit=args.idle_exit)
+            return 0
+        
+        if args.retry is not None:
+            manifest_path, output_path = args.retry
+            try:
+                entries = processor.load_failure_manifest(manifest_path)
+                success = processor.retry_quarantined(entries, output_path)
+            except (ValueError, OSError) as e:
+                logger.error(f"重新處理失敗: {str(e)}")
+                return 1
+            quarantined = processor.quarantine
+        else:
+            results = processor.run_batch(jobs, concurrent_jobs=option(args.concurrent_jobs, 'concurrent_jobs', 1))
+            success = all(result['success'] for result in results)
+            quarantined = [entry for result in results for entry in result['quarantined']]
+        
+        if quarantined:
+            logger.warning(f"共隔離 {len(quarantined)} 個檔案")
+        if failure_manifest:
+            processor.write_failure_manifest(quarantined, failure_manifest)
+            logger.info(f"隔離清單已儲存至: {failure_manifest}")
+        return 0 if success and not quarantined else 1
+    finally:
+        _report_instrumentation(processor.instrumentation, args.metrics, processor.table_cache)
+
+def _run_scan(folders, report_path=None):
+    """掃描模式：檢查各資料夾的試算表標題列，全部正常時回傳 0"""
+    processor = SalesDataProcessor()
+    results = []
+    for folder in folders:
+        try:
+            results.extend(processor.scan_folder(folder))
+        except ValueError as e:
+            logger.error(str(e))
+            return 1
+    if report_path:
+        processor.write_scan_report(results, report_path)
+    return 1 if any(result['problems'] for result in results) else 0
+
+def _report_instrumentation(instrumentation, metrics_path=None, table_cache=None):
+    """輸出量測彙總、剖析結果、記憶體快取命中統計與量測 JSON"""
+    instrumentation.log_summary()
+    instrumentation.dump_profiles()
+    if table_cache is not None:
+        table_cache.log_stats()
+    if metrics_path:
+        summary = instrumentation.summary()
+        if table_cache is not None:
+            summary['table_cache'] = table_cache.stats()
+        with open(metrics_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+def main(argv=None):
+    """主函式：沒有命令列參數時以互動方式執行，否則進入批次模式"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        sys.exit(run_cli(argv))
     processor = SalesDataProcessor()
     processor.run()
 
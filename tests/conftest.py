@@ -0,0 +1,64 @@
+import glob
+import os
+import shutil
+import sys
+
+import pytest
+
+# 讓測試可以直接匯入專案根目錄的 sales_data_processor
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+SAMPLE_FOLDER = os.path.join(ROOT, "0722-0728")
+REFERENCE_FILES = {
+    'product': os.path.join(ROOT, "產品代號表.xlsx"),
+    'account': os.path.join(ROOT, "掛帳客戶供應商對照表(包含傳票類別).xlsx"),
+    'customer': os.path.join(ROOT, "客戶供應商代號和傳票類別.xlsx"),
+}
+
+
+def sheet_rows(path):
+    """讀取輸出檔案第一個工作表（統計資料）的所有列"""
+    import openpyxl
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return [list(row) for row in workbook.worksheets[0].iter_rows(values_only=True)]
+    finally:
+        workbook.close()
+
+
+@pytest.fixture
+def reference_args():
+    """命令列的對照表參數"""
+    return [
+        '--product', REFERENCE_FILES['product'],
+        '--account', REFERENCE_FILES['account'],
+        '--customer', REFERENCE_FILES['customer'],
+    ]
+
+
+@pytest.fixture
+def make_processor():
+    """建立已載入對照表的 SalesDataProcessor"""
+    from sales_data_processor import SalesDataProcessor
+    
+    def make(**kwargs):
+        processor = SalesDataProcessor(**kwargs)
+        processor.product_code_file_path = REFERENCE_FILES['product']
+        processor.account_query_file_path = REFERENCE_FILES['account']
+        processor.customer_code_file_path = REFERENCE_FILES['customer']
+        processor.load_product_code_mapping()
+        processor.load_account_mapping()
+        return processor
+    return make
+
+
+@pytest.fixture
+def sample_folder(tmp_path):
+    """複製部分範例檔案到暫存資料夾（隔離等會移動檔案的測試不影響原始範例）"""
+    folder = tmp_path / "0722-0728"
+    folder.mkdir()
+    for path in sorted(glob.glob(os.path.join(SAMPLE_FOLDER, "*.xls")))[:12]:
+        shutil.copy(path, folder)
+    return str(folder)
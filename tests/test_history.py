@@ -0,0 +1,49 @@
+"""HistoryStore 匯入既有統計資料檔案的回歸測試"""
+import logging
+import os
+import shutil
+
+from sales_data_processor import HistoryStore
+
+from conftest import ROOT
+
+
+def _period_count(store, period):
+    return len(store.query(period=period))
+
+
+def test_import_replaces_period(tmp_path, sample_folder, make_processor):
+    output = str(tmp_path / "0722-0728.xlsx")
+    assert make_processor().process_folder(sample_folder, output)
+    
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    imported = store.import_workbooks([output])
+    assert imported['0722-0728'] > 0
+    assert _period_count(store, '0722-0728') == imported['0722-0728']
+    # 重新匯入同一期間取代而不是重複寫入
+    store.import_workbooks([output])
+    assert _period_count(store, '0722-0728') == imported['0722-0728']
+
+
+def test_empty_or_unreadable_workbook_keeps_stored_period(tmp_path, sample_folder, make_processor, caplog):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"))
+    processor = make_processor()
+    processor.history_store = store
+    assert processor.process_folder(sample_folder, str(tmp_path / "out" / "0722-0728.xlsx"))
+    stored = _period_count(store, '0722-0728')
+    assert stored > 0
+    
+    # 專案內附的空白輸出檔案（只有空白的第一列）
+    empty = tmp_path / "empty" / "0722-0728.xlsx"
+    empty.parent.mkdir()
+    shutil.copy(os.path.join(ROOT, "統計資料", "0722-0728.xlsx"), empty)
+    broken = tmp_path / "broken" / "0722-0728.xlsx"
+    broken.parent.mkdir()
+    broken.write_bytes(b"not a workbook")
+    
+    with caplog.at_level(logging.WARNING):
+        imported = store.import_workbooks([str(empty), str(broken)])
+    
+    assert imported == {}
+    assert _period_count(store, '0722-0728') == stored
+    assert sum(record.levelno == logging.WARNING for record in caplog.records) == 2
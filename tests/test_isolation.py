@@ -0,0 +1,68 @@
+"""隔離執行、隔離清單與重新處理的回歸測試"""
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from conftest import ROOT, SAMPLE_FOLDER, sheet_rows
+
+SCRIPT = os.path.join(ROOT, "sales_data_processor.py")
+
+
+def _run(args, cwd):
+    return subprocess.run([sys.executable, SCRIPT, '-q'] + args, cwd=cwd, capture_output=True, text=True)
+
+
+def test_retry_manifest_from_another_cwd(tmp_path, sample_folder, reference_args):
+    bad_name = "99990799001.xls"
+    with open(os.path.join(sample_folder, bad_name), 'wb') as f:
+        f.write(b"\x00 not a spreadsheet \x00" * 64)
+    
+    # 以相對路徑指定隔離資料夾與隔離清單
+    work = tmp_path / "work"
+    work.mkdir()
+    result = _run(['--job', sample_folder, str(tmp_path / "out.xlsx"), '--file-timeout', '60',
+                   '--quarantine-dir', "隔離", '--failure-manifest', "隔離/清單.json"] + reference_args, work)
+    assert result.returncode == 1, result.stderr
+    
+    manifest_path = work / "隔離" / "清單.json"
+    entries = json.loads(manifest_path.read_text(encoding='utf-8'))['files']
+    assert [entry['name'] for entry in entries] == [bad_name]
+    entry = entries[0]
+    assert os.path.isabs(entry['path'])
+    assert os.path.samefile(entry['path'], work / "隔離" / bad_name)
+    assert not os.path.exists(os.path.join(sample_folder, bad_name))
+    
+    # 修正檔案後從其他資料夾重新處理
+    shutil.copy(sorted(glob.glob(os.path.join(SAMPLE_FOLDER, "*.xls")))[0], entry['path'])
+    other = tmp_path / "other"
+    other.mkdir()
+    retry_output = tmp_path / "retry.xlsx"
+    result = _run(['--retry', str(manifest_path), str(retry_output)] + reference_args, other)
+    assert result.returncode == 0, result.stderr
+    assert any(any(row) for row in sheet_rows(retry_output))
+
+
+def test_isolated_run_quarantines_only_bad_files(tmp_path, sample_folder, reference_args):
+    clean_output = tmp_path / "clean.xlsx"
+    result = _run(['--job', sample_folder, str(clean_output)] + reference_args, tmp_path)
+    assert result.returncode == 0, result.stderr
+    
+    # 無法辨識的檔案與沒有表格的 HTML 都應隔離，其他檔案照常處理
+    with open(os.path.join(sample_folder, "99990799001.xls"), 'wb') as f:
+        f.write(os.urandom(2048))
+    with open(os.path.join(sample_folder, "99990799002.xls"), 'w', encoding='utf-8') as f:
+        f.write("<html><body>沒有表格</body></html>")
+    isolated_output = tmp_path / "isolated.xlsx"
+    manifest = tmp_path / "清單.json"
+    result = _run(['--job', sample_folder, str(isolated_output), '--workers', '2', '--file-timeout', '60',
+                   '--failure-manifest', str(manifest)] + reference_args, tmp_path)
+    assert result.returncode == 1, result.stderr
+    
+    entries = json.loads(manifest.read_text(encoding='utf-8'))['files']
+    assert sorted(entry['name'] for entry in entries) == ["99990799001.xls", "99990799002.xls"]
+    # 未指定隔離資料夾時不移動檔案
+    assert all(os.path.exists(entry['path']) for entry in entries)
+    assert sheet_rows(isolated_output) == sheet_rows(clean_output)
@@ -0,0 +1,59 @@
+"""ParsedFileCache 的回歸測試"""
+import glob
+import os
+import sqlite3
+import subprocess
+import sys
+
+import sales_data_processor as sdp
+from sales_data_processor import ParsedFileCache, POS_EXPORT_COLUMNS
+
+from conftest import ROOT
+
+
+def _rows(processor, folder):
+    processor.folder_path = folder
+    files = sorted(processor.get_excel_files(), key=lambda file: file['path'])
+    rows, special = processor.collect_statistics_data(files)
+    return [list(row) for row in rows], special
+
+
+def test_cache_written_by_script_is_readable_by_module(tmp_path, sample_folder, reference_args, make_processor):
+    # 以 python sales_data_processor.py 執行時模組名稱為 __main__，快取內容不能依賴它
+    cache_dir = str(tmp_path / "cache")
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "sales_data_processor.py"), '-q',
+         '--job', sample_folder, str(tmp_path / "out.xlsx"), '--cache-dir', cache_dir] + reference_args,
+        capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    
+    cache = ParsedFileCache(cache_dir)
+    for path in glob.glob(os.path.join(sample_folder, "*.xls")):
+        table, _ = cache.lookup(path, POS_EXPORT_COLUMNS)
+        assert table is not None, path
+        assert table.row_count > 0
+    cache.close()
+    
+    expected = _rows(make_processor(), sample_folder)
+    cached = _rows(make_processor(cache_dir=cache_dir), sample_folder)
+    assert cached == expected
+    assert len(cached[0]) > 0
+
+
+def test_unreadable_entry_is_a_miss_and_removed(tmp_path, sample_folder):
+    cache = ParsedFileCache(str(tmp_path / "cache"))
+    path = sorted(glob.glob(os.path.join(sample_folder, "*.xls")))[0]
+    table = sdp.SalesDataProcessor().read_pos_html_table(path, POS_EXPORT_COLUMNS)
+    _, digest = cache.lookup(path, POS_EXPORT_COLUMNS)
+    cache.store(digest, POS_EXPORT_COLUMNS, table)
+    assert cache.lookup(path, POS_EXPORT_COLUMNS)[0] == table
+    
+    cache.close()
+    with sqlite3.connect(cache.db_path) as conn:
+        conn.execute("UPDATE tables SET data = ?", (b"not a pickle",))
+    
+    assert cache.lookup(path, POS_EXPORT_COLUMNS) == (None, digest)
+    count = cache._connect().execute("SELECT COUNT(*) FROM tables").fetchone()[0]
+    assert count == 0
+    cache.close()
@@ -0,0 +1,114 @@
+"""POS 匯出檔讀取的回歸測試：串流讀取與原本 pandas 讀取的結果必須相同"""
+import glob
+import hashlib
+import io
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import sales_data_processor as sdp
+from sales_data_processor import SalesDataProcessor, TaxEngine, POS_EXPORT_COLUMNS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_FOLDER = os.path.join(ROOT, "0722-0728")
+SAMPLE_FILES = sorted(glob.glob(os.path.join(SAMPLE_FOLDER, "*.xls")))
+
+# 改寫前（pandas 逐列讀取）版本對範例資料輸出的統計列（金額欄統一為數值）排序後的 SHA-256
+SAMPLE_ROWS_SHA256 = "66785fd547eb789f518d757d1681bb986a6ba0ebaa4f7a4d91ac03fbb3cd3d55"
+SAMPLE_ROW_COUNT = 222
+
+
+def _pandas_strings(values):
+    return [None if not pd.notna(v) else str(v).strip() for v in values]
+
+
+def _make_processor():
+    processor = SalesDataProcessor()
+    processor.folder_path = SAMPLE_FOLDER
+    processor.product_code_file_path = os.path.join(ROOT, "產品代號表.xlsx")
+    processor.account_query_file_path = os.path.join(ROOT, "掛帳客戶供應商對照表(包含傳票類別).xlsx")
+    processor.customer_code_file_path = os.path.join(ROOT, "客戶供應商代號和傳票類別.xlsx")
+    processor.load_product_code_mapping()
+    processor.load_account_mapping()
+    return processor
+
+
+def _sample_files(processor):
+    return sorted(processor.get_excel_files(), key=lambda file: file['path'])
+
+
+def _normalized(rows):
+    return [["" if v is None else str(v) for v in row] for row in rows]
+
+
+def _amounts_normalized(rows):
+    """付現／刷卡金額（索引 8、9）原本為浮點數文字（1500.0），改寫後為整數，比對前統一為數值"""
+    rows = _normalized(rows)
+    for row in rows:
+        for index in (8, 9):
+            if row[index]:
+                row[index] = str(TaxEngine.parse_amount(row[index]))
+    return rows
+
+
+@pytest.mark.parametrize("cells", [
+    ["1", "2", "3"],
+    ["1,234", "5", "-7"],
+    ["1.5", "2"],
+    ["1.", "2"],
+    ["1", ""],
+    ["", ""],
+    ["abc", "1"],
+    ["1,234", "abc"],
+    ["000010", "000020"],
+    ["00012100", ""],
+    ["NA", "3"],
+    ["-1.25", "1,000.5"],
+])
+def test_pandas_like_column_matches_read_html(cells):
+    # 加上序號欄，避免 pandas 丟棄整列皆空的列
+    body = "".join(f"<tr><td>{cell}</td><td>k{i}</td></tr>" for i, cell in enumerate(cells))
+    html = f"<table><tr><th>c</th><th>k</th></tr>{body}</table>"
+    expected = _pandas_strings(pd.read_html(io.StringIO(html))[0]["c"].tolist())
+    assert sdp._pandas_like_column(cells) == expected
+
+
+@pytest.mark.skipif(not SAMPLE_FILES, reason="沒有範例資料")
+@pytest.mark.parametrize("path", SAMPLE_FILES, ids=os.path.basename)
+def test_streaming_reader_matches_pandas(path):
+    processor = SalesDataProcessor()
+    fast = processor.read_pos_html_table(path)
+    assert fast is not None
+    df = processor.read_excel_sheet(path)
+    for column in POS_EXPORT_COLUMNS:
+        if column not in df.columns:
+            assert column not in fast
+            continue
+        assert fast[column] == _pandas_strings(df[column].tolist()), column
+
+
+@pytest.mark.skipif(not SAMPLE_FILES, reason="沒有範例資料")
+def test_statistics_rows_match_pandas_path(monkeypatch):
+    processor = _make_processor()
+    rows, special = processor.collect_statistics_data(_sample_files(processor))
+    
+    # 串流讀取回傳 None 時退回 pandas 讀取
+    monkeypatch.setattr(SalesDataProcessor, "read_pos_html_table", lambda self, *args, **kwargs: None)
+    fallback = _make_processor()
+    pandas_rows, pandas_special = fallback.collect_statistics_data(_sample_files(fallback))
+    
+    assert _normalized(rows) == _normalized(pandas_rows)
+    assert special == pandas_special
+
+
+@pytest.mark.skipif(not SAMPLE_FILES, reason="沒有範例資料")
+def test_statistics_rows_match_original_output():
+    processor = _make_processor()
+    rows, special = processor.collect_statistics_data(_sample_files(processor))
+    rows = sorted(_amounts_normalized(rows))
+    digest = hashlib.sha256(json.dumps(rows, ensure_ascii=False).encode()).hexdigest()
+    assert len(rows) == SAMPLE_ROW_COUNT
+    assert digest == SAMPLE_ROWS_SHA256
+    assert special == []
@@ -0,0 +1,94 @@
+"""對照表快照（ReferenceData）的回歸測試"""
+import glob
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+import openpyxl
+
+from sales_data_processor import ReferenceData, SalesDataProcessor
+
+from conftest import REFERENCE_FILES, ROOT
+
+
+def _copy_references(folder):
+    folder.mkdir()
+    paths = {}
+    for key, path in REFERENCE_FILES.items():
+        paths[key] = str(folder / os.path.basename(path))
+        shutil.copy(path, paths[key])
+    return paths
+
+
+def _load(paths, snapshot_dir, candidate_count=0):
+    processor = SalesDataProcessor()
+    processor.product_code_file_path = paths['product']
+    processor.account_query_file_path = paths['account']
+    processor.customer_code_file_path = paths['customer']
+    processor.candidate_count = candidate_count
+    return processor, processor.load_reference_data(snapshot_dir)
+
+
+def _snapshots(snapshot_dir):
+    return sorted(glob.glob(os.path.join(snapshot_dir, "reference_*.pickle")))
+
+
+def test_candidate_index_only_built_when_needed(tmp_path):
+    snapshot_dir = str(tmp_path / "cache")
+    
+    processor, reference = _load(REFERENCE_FILES, snapshot_dir)
+    assert not reference.has_product_index
+    assert processor.product_index is None
+    [snapshot] = _snapshots(snapshot_dir)
+    assert not ReferenceData.load(snapshot).has_product_index
+    
+    # 需要候選報表時由快照建立索引並更新快照
+    processor, reference = _load(REFERENCE_FILES, snapshot_dir, candidate_count=3)
+    assert reference.has_product_index
+    assert processor.product_index is reference.product_index
+    assert _snapshots(snapshot_dir) == [snapshot]
+    assert ReferenceData.load(snapshot).has_product_index
+
+
+def test_save_only_prunes_snapshots_of_same_sources(tmp_path):
+    snapshot_dir = str(tmp_path / "cache")
+    first = _copy_references(tmp_path / "first")
+    second = _copy_references(tmp_path / "second")
+    
+    _load(first, snapshot_dir)
+    _load(second, snapshot_dir)
+    assert len(_snapshots(snapshot_dir)) == 2
+    # 交替使用兩組對照表時直接取用各自的快照
+    _load(first, snapshot_dir)
+    assert len(_snapshots(snapshot_dir)) == 2
+    
+    # 第一組的產品代號表更新後，只取代第一組的舊快照
+    before = set(_snapshots(snapshot_dir))
+    workbook = openpyxl.load_workbook(first['product'])
+    workbook.worksheets[0].append(["測試新增商品", "ZZ99999"])
+    workbook.save(first['product'])
+    _load(first, snapshot_dir)
+    after = set(_snapshots(snapshot_dir))
+    assert len(after) == 2
+    assert len(before & after) == 1
+
+
+def test_snapshot_written_by_script_is_readable_by_module(tmp_path, sample_folder, reference_args, caplog):
+    # 以 python sales_data_processor.py 執行時模組名稱為 __main__，快照內容不能依賴它
+    snapshot_dir = str(tmp_path / "cache")
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "sales_data_processor.py"), '-q', '--candidates', '2',
+         '--job', sample_folder, str(tmp_path / "out.xlsx"), '--cache-dir', snapshot_dir] + reference_args,
+        capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    [snapshot] = _snapshots(snapshot_dir)
+    
+    with caplog.at_level(logging.WARNING):
+        processor, reference = _load(REFERENCE_FILES, snapshot_dir, candidate_count=2)
+    assert not caplog.records
+    assert reference.has_product_index
+    assert len(processor.product_mapping) > 0
+    assert _snapshots(snapshot_dir) == [snapshot]
@@ -0,0 +1,60 @@
+"""彙總（--rollups）讀回與合併的回歸測試"""
+import glob
+import os
+import shutil
+
+import pytest
+
+from sales_data_processor import RollupAggregator
+
+
+def _expected_rollup(processor, folder):
+    processor.folder_path = folder
+    rows, _ = processor.collect_statistics_data(processor.get_excel_files())
+    rollup = RollupAggregator()
+    for _ in rollup.consume(rows):
+        pass
+    return rollup
+
+
+@pytest.mark.parametrize("extension", [".xlsx", ".csv"])
+def test_rollup_read_back_matches_processing(tmp_path, sample_folder, make_processor, extension):
+    processor = make_processor()
+    processor.rollups = True
+    output = str(tmp_path / f"0722-0728{extension}")
+    assert processor.process_folder(sample_folder, output)
+    
+    expected = _expected_rollup(make_processor(), sample_folder)
+    assert len(expected) > 0
+    assert RollupAggregator.load(output).detail_rows() == expected.detail_rows()
+
+
+def test_merge_rollups_matches_single_run(tmp_path, sample_folder, make_processor):
+    # 將範例分成兩個資料夾分別處理，合併後應與整個資料夾一起處理相同
+    files = sorted(glob.glob(os.path.join(sample_folder, "*.xls")))
+    outputs = []
+    for index, part in enumerate([files[:len(files) // 2], files[len(files) // 2:]]):
+        folder = tmp_path / f"part{index}"
+        folder.mkdir()
+        for path in part:
+            shutil.copy(path, folder)
+        processor = make_processor()
+        processor.rollups = True
+        output = str(tmp_path / f"part{index}.xlsx")
+        assert processor.process_folder(str(folder), output)
+        outputs.append(output)
+    
+    merged_path = str(tmp_path / "merged.xlsx")
+    merged = make_processor().merge_rollups(outputs, merged_path)
+    expected = _expected_rollup(make_processor(), sample_folder)
+    assert merged.detail_rows() == expected.detail_rows()
+    assert RollupAggregator.load(merged_path).detail_rows() == expected.detail_rows()
+    for position in range(len(RollupAggregator.DIMENSIONS)):
+        assert merged.summary_rows(position) == expected.summary_rows(position)
+
+
+def test_load_without_detail_sheet(tmp_path, sample_folder, make_processor):
+    output = str(tmp_path / "plain.xlsx")
+    assert make_processor().process_folder(sample_folder, output)
+    with pytest.raises(ValueError):
+        RollupAggregator.load(output)
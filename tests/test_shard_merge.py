@@ -0,0 +1,40 @@
+"""分片處理與合併的回歸測試"""
+import glob
+
+import pytest
+
+import sales_data_processor as sdp
+
+from conftest import sheet_rows
+
+
+@pytest.fixture
+def reversed_glob(monkeypatch):
+    """讓檔案系統的列舉順序與檔名順序相反"""
+    iglob = glob.iglob
+    monkeypatch.setattr(sdp.glob, 'iglob', lambda pattern: iter(sorted(iglob(pattern), reverse=True)))
+
+
+@pytest.mark.parametrize("shards", [1, 3])
+def test_merge_matches_process_folder_row_for_row(tmp_path, sample_folder, make_processor, reversed_glob, shards):
+    single = str(tmp_path / "single.xlsx")
+    assert make_processor().process_folder(sample_folder, single)
+    
+    partials = []
+    for shard in range(shards):
+        partial = str(tmp_path / f"out.part{shard}")
+        make_processor().process_shard(sample_folder, partial, shard, shards)
+        partials.append(partial)
+    merged = str(tmp_path / "merged.xlsx")
+    # 分片順序與合併結果無關
+    assert make_processor().merge_partials(list(reversed(partials)), merged)
+    
+    expected = sheet_rows(single)
+    assert len(expected) > 2
+    assert sheet_rows(merged) == expected
+
+
+def test_files_are_listed_by_relative_path(sample_folder, reversed_glob):
+    files = list(sdp.SalesDataProcessor().iter_excel_files(sample_folder))
+    names = [file['name'] for file in files]
+    assert names == sorted(names)
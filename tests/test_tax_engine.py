@@ -0,0 +1,75 @@
+"""TaxEngine 金額解析與稅額取整的回歸測試"""
+import decimal
+import fractions
+
+import pytest
+
+from sales_data_processor import TaxEngine
+
+
+@pytest.mark.parametrize("amount, expected", [
+    (1, 0),    # 0.5 → 0
+    (3, 2),    # 1.5 → 2
+    (5, 2),    # 2.5 → 2
+    (7, 4),    # 3.5 → 4
+    (-1, 0),   # -0.5 → 0
+    (-3, -2),  # -1.5 → -2
+    (-5, -2),  # -2.5 → -2
+    (0, 0),
+])
+def test_integer_half_even(amount, expected):
+    # 稅率 100% 時稅額為金額的一半，正好落在 .5
+    assert TaxEngine("1").tax(amount) == expected
+
+
+@pytest.mark.parametrize("amount, expected", [
+    (decimal.Decimal("10.5"), 0),    # 0.5 → 0
+    (decimal.Decimal("31.5"), 2),    # 1.5 → 2
+    (decimal.Decimal("-31.5"), -2),
+    (decimal.Decimal("52.5"), 2),    # 2.5 → 2
+    (decimal.Decimal("0.0"), 0),
+])
+def test_decimal_half_even(amount, expected):
+    assert TaxEngine().tax(amount) == expected
+
+
+@pytest.mark.parametrize("rate", ["0.05", "0.5", "1", "0"])
+def test_integer_path_matches_fraction(rate):
+    engine = TaxEngine(rate)
+    rate_fraction = fractions.Fraction(decimal.Decimal(rate))
+    tax_fraction = rate_fraction / (1 + rate_fraction)
+    for amount in range(-2000, 2001):
+        assert engine.tax(amount) == round(amount * tax_fraction), amount
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("1,200", 1200),
+    ("1200", 1200),
+    ("1200.", 1200),
+    ("1200.00", 1200),
+    ("-35", -35),
+    ("1200.50", decimal.Decimal("1200.50")),
+    ("abc", None),
+    ("nan", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_amount(text, expected):
+    value = TaxEngine.parse_amount(text)
+    assert value == expected
+    assert type(value) is type(expected)
+
+
+def test_split_keeps_none_and_rounds_half_even():
+    engine = TaxEngine()
+    amounts = engine.parse_amounts(["1,050", None, "10.5", "11.5", "x"])
+    assert amounts == [1050, None, decimal.Decimal("10.5"), decimal.Decimal("11.5"), None]
+    rounded, taxes = engine.split(amounts)
+    assert rounded == [1050, None, 10, 12, None]
+    assert taxes == [50, None, 0, 1, None]
+
+
+@pytest.mark.parametrize("rate", ["-0.05", "abc", "nan"])
+def test_invalid_rate(rate):
+    with pytest.raises(ValueError):
+        TaxEngine(rate)